@@ -2,28 +2,53 @@ __author__ = 'junz'
 
 import numpy as np
 import os
+import sys
+import copy
+import time
+import threading
+import hashlib
+import traceback
+import multiprocessing
+import h5py
+import sqlite3
+import json
 import scipy.ndimage as ni
 import scipy.sparse as sparse
+from scipy.sparse.csgraph import minimum_spanning_tree
 import math
 import matplotlib.pyplot as plt
-from itertools import combinations
+from itertools import combinations, product
 from operator import itemgetter
+from contextlib import contextmanager
 import skimage.morphology as sm
 import skimage.transform as tsfm
 import cv2
+import tifffile as tf
 import matplotlib.colors as col
 from matplotlib import cm
 
+try:
+    import resource
+except ImportError:  # not available on windows
+    resource = None
+
 from tools import FileTools as ft
 from tools import ImageAnalysis as ia
 from tools import PlottingTools as pt
 
 
-def loadTrial(trialPath):
+def loadTrial(trialPath, isLazy=True):
     """
     load single retinotopic mapping trial from database
+
+    :param trialPath: path of a pickled trial dictionary, or of a hdf5 trial file (extension '.h5' or '.hdf5', see
+                      saveTrialH5)
+    :param isLazy: only for hdf5 trial files, if True, maps and patches are loaded on first access
     """
 
+    if os.path.splitext(trialPath)[1].lower() in H5_EXTENSIONS:
+        return loadTrialH5(trialPath, isLazy=isLazy)
+
     trialDict = ft.loadFile(trialPath)
 
     trial = RetinotopicMappingTrial(mouseID=trialDict['mouseID'],  # str, mouseID
@@ -60,10 +85,7 @@ def loadTrial(trialPath):
         if isinstance(trialDict['finalPatches'].values()[0], dict):
             trial.finalPatches = {}
             for area, patchDict in trialDict['finalPatches'].iteritems():
-                try:
-                    trial.finalPatches.update({area: Patch(patchDict['array'], patchDict['sign'])})
-                except KeyError:
-                    trial.finalPatches.update({area: Patch(patchDict['sparseArray'], patchDict['sign'])})
+                trial.finalPatches.update({area: Patch.fromDict(patchDict)})
         else:
             pass
     except KeyError:
@@ -73,10 +95,7 @@ def loadTrial(trialPath):
         if isinstance(trialDict['finalPatchesMarked'].values()[0], dict):
             trial.finalPatchesMarked = {}
             for area, patchDict in trialDict['finalPatchesMarked'].iteritems():
-                try:
-                    trial.finalPatchesMarked.update({area: Patch(patchDict['array'], patchDict['sign'])})
-                except KeyError:
-                    trial.finalPatchesMarked.update({area: Patch(patchDict['sparseArray'], patchDict['sign'])})
+                trial.finalPatchesMarked.update({area: Patch.fromDict(patchDict)})
         else:
             pass
     except KeyError:
@@ -107,9 +126,377 @@ def loadTrial(trialPath):
     except KeyError:
         pass
 
+    try:
+        trial.processingReport = trialDict['processingReport']
+    except KeyError:
+        pass
+
     return trial
 
 
+H5_EXTENSIONS = ('.h5', '.hdf5')
+
+
+def _isPatchDict(value):
+    """
+    if value is a non-empty dictionary of patches (Patch objects or dictionaries generated by getPatchDict)
+    """
+    if not isinstance(value, dict) or not value:
+        return False
+    patch = value.values()[0]
+    return isinstance(patch, Patch) or (isinstance(patch, dict) and 'sign' in patch)
+
+
+def _getH5Attr(value):
+    if isinstance(value, str) and value == 'None':
+        return None
+    elif isinstance(value, np.generic):
+        return value.item()
+    else:
+        return value
+
+
+def saveTrialH5(trialDict, h5Path):
+    """
+    save a trial dictionary (generated by RetinotopicMappingTrial.generateTrialDict) into a hdf5 file
+
+    file structure:
+        attributes: mouseID, dateRecorded, comments
+        params: group, each parameter as an attribute
+        maps: group, each map as a gzip compressed chunked dataset. names of maps that are None are saved in the
+              attribute 'noneKeys'
+        patches: group, each patch dictionary (e.g. finalPatches) as a sub group, each patch as a group with
+                 attributes 'sign' and 'shape' and datasets 'rleStarts' and 'rleLengths' (see Patch.getDict)
+        json: group, other dictionaries (e.g. processingReport) as json string attributes
+    """
+
+    with h5py.File(h5Path, 'w') as f:
+
+        for key in ('mouseID', 'dateRecorded', 'comments'):
+            if key in trialDict:
+                value = trialDict[key]
+                f.attrs[key] = 'None' if value is None else value
+
+        paramGroup = f.create_group('params')
+        for key, value in trialDict.get('params', {}).iteritems():
+            paramGroup.attrs[key] = 'None' if value is None else value
+
+        mapGroup = f.create_group('maps')
+        patchGroup = f.create_group('patches')
+        noneKeys = []
+
+        for key, value in trialDict.iteritems():
+
+            if key in ('mouseID', 'dateRecorded', 'comments', 'params'):
+                continue
+
+            if value is None:
+                noneKeys.append(key)
+            elif _isPatchDict(value):
+                currPatchGroup = patchGroup.create_group(key)
+                for patchName, patch in value.iteritems():
+                    if not isinstance(patch, Patch):
+                        patch = Patch.fromDict(patch)
+                    patchDict = patch.getDict(isRLE=True)
+                    currGroup = currPatchGroup.create_group(patchName)
+                    currGroup.attrs['sign'] = patchDict['sign']
+                    currGroup.attrs['shape'] = patchDict['shape']
+                    currGroup.create_dataset('rleStarts', data=patchDict['rleStarts'])
+                    currGroup.create_dataset('rleLengths', data=patchDict['rleLengths'])
+            elif isinstance(value, dict):
+                jsonGroup = f.require_group('json')
+                jsonGroup.attrs[key] = json.dumps(value)
+            elif isinstance(value, np.ndarray):
+                if value.ndim > 0 and value.size > 0:
+                    mapGroup.create_dataset(key, data=value, compression='gzip', shuffle=True, chunks=True)
+                else:
+                    mapGroup.create_dataset(key, data=value)
+            else:
+                print 'saveTrialH5: can not save ' + key + ' of type ' + str(type(value)) + ', skip.'
+
+        mapGroup.attrs['noneKeys'] = ','.join(noneKeys)
+
+
+def _loadH5Value(f, key):
+    """
+    load a single map or patch dictionary from an open hdf5 trial file (h5py.File)
+    """
+
+    if key in f['maps']:
+        return f['maps'][key].value
+    elif key in f['patches']:
+        patches = {}
+        for patchName, patchGroup in f['patches'][key].iteritems():
+            patchDict = {'sign': int(patchGroup.attrs['sign']),
+                         'shape': tuple(patchGroup.attrs['shape'])}
+            for datasetName in patchGroup.keys():
+                patchDict.update({str(datasetName): patchGroup[datasetName].value})
+            patches.update({str(patchName): Patch.fromDict(patchDict)})
+        return patches
+    elif key in f['maps'].attrs['noneKeys'].split(','):
+        return None
+    else:
+        raise KeyError, 'can not find "' + key + '" in ' + f.filename + '!'
+
+
+def loadTrialH5(h5Path, isLazy=True):
+    """
+    load single retinotopic mapping trial from a hdf5 trial file (see saveTrialH5)
+
+    :param isLazy: if True, only attributes and parameters are loaded, each map or patch dictionary is read from the
+                   file on its first access. The file is kept open by the trial until all of them are read or the
+                   trial is saved or deleted
+    """
+
+    with h5py.File(h5Path, 'r') as f:
+        attrs = {key: _getH5Attr(value) for key, value in f.attrs.iteritems()}
+        params = {str(key): _getH5Attr(value) for key, value in f['params'].attrs.iteritems()}
+        keys = [str(key) for key in f['maps'].keys()] + [str(key) for key in f['patches'].keys()]
+        noneKeys = [key for key in f['maps'].attrs['noneKeys'].split(',') if key]
+        if 'json' in f:
+            jsonValues = {str(key): json.loads(value) for key, value in f['json'].attrs.iteritems()}
+        else:
+            jsonValues = {}
+        if not isLazy:
+            values = {key: _loadH5Value(f, key) for key in keys}
+
+    trial = RetinotopicMappingTrial(altPosMap=None,
+                                    aziPosMap=None,
+                                    altPowerMap=None,
+                                    aziPowerMap=None,
+                                    vasculatureMap=None,
+                                    mouseID=attrs.get('mouseID'),
+                                    dateRecorded=attrs.get('dateRecorded'),
+                                    comments=attrs.get('comments', ''),
+                                    params=params)
+
+    for key in noneKeys:
+        setattr(trial, key, None)
+
+    for key, value in jsonValues.iteritems():
+        setattr(trial, key, value)
+
+    if isLazy:
+        for key in keys:
+            trial.__dict__.pop(key, None)
+        trial._lazyKeys = set(keys)
+        trial._lazyPath = os.path.abspath(h5Path)
+    else:
+        for key in keys:
+            setattr(trial, key, values[key])
+
+    return trial
+
+
+def processTrialFile(trialPath, params=None, saveFolder=None, retryNum=0):
+    """
+    load a single retinotopic mapping trial, run processTrial on it and save the processed trial dictionary
+
+    :param trialPath: path of the trial file, same as the input of loadTrial
+    :param params: dictionary of segmentation parameters, if None, the parameters saved in the trial will be used
+    :param saveFolder: folder to save the processed trial dictionary (same file name as the original trial), if None,
+                       the processed trial will not be saved
+    :param retryNum: number of retries if processing fails
+    :return: summary dictionary of this trial
+    """
+
+    summary = {'trialPath': trialPath,
+               'trialName': os.path.splitext(os.path.basename(trialPath))[0],
+               'status': 'failed',
+               'attemptNum': 0,
+               'duration': np.nan,
+               'patchNum': 0,
+               'savePath': None,
+               'error': None}
+
+    while summary['attemptNum'] <= retryNum:
+        summary['attemptNum'] += 1
+        startTime = time.time()
+        try:
+            trial = loadTrial(trialPath)
+            if params is not None:
+                trial.params = dict(params)
+            trial.processTrial(isPlot=False)
+            summary['duration'] = time.time() - startTime
+            summary['patchNum'] = len(trial.finalPatches)
+
+            if saveFolder is not None:
+                savePath = os.path.join(saveFolder, os.path.basename(trialPath))
+                trialDict = trial.generateTrialDict()
+                trial._closeH5File()
+                if os.path.splitext(savePath)[1].lower() in H5_EXTENSIONS:
+                    saveTrialH5(trialDict, savePath)
+                else:
+                    ft.saveFile(savePath, trialDict)
+                summary['savePath'] = savePath
+
+            summary['status'] = 'done'
+            summary['error'] = None
+            break
+        except Exception:
+            summary['duration'] = time.time() - startTime
+            summary['error'] = traceback.format_exc().strip().split('\n')[-1]
+        finally:
+            # processTrial generates figures for split and merged patches
+            plt.close('all')
+
+    return summary
+
+
+def _splitPatchWorker(args):
+    """
+    check and split one patch for RetinotopicMappingTrial._splitPatches,
+    args: (patchName, patch, offset, altPosMapf, aziPosMapf, eccMapf, detMap, params)
+
+    the maps are crops of the full frame maps in the bounding box of the patch returned by
+    patch.getBoundingBox(margin=params['borderWidth'] + 2), offset is (rowStart, colStart) of this box. So only the
+    pixels around the patch are sent to the worker processes.
+
+    :return: (patchName, AU, AS, number of local minima, dictionary of new patches (empty if not split))
+    """
+
+    key, patch, offset, altPosMapf, aziPosMapf, eccMapf, detMap, params = args
+
+    rows = patch.sparseArray.row - offset[0]
+    cols = patch.sparseArray.col - offset[1]
+    cropArray = np.zeros(eccMapf.shape, dtype=np.int8)
+    cropArray[rows, cols] = 1
+    cropPatch = Patch(cropArray, patch.sign)
+
+    _, AU, _, _ = cropPatch.getVisualSpace(altPosMapf,
+                                           aziPosMapf,
+                                           pixelSize=params['visualSpacePixelSize'],
+                                           closeIter=params['visualSpaceCloseIter'])
+    AS = cropPatch.getSigmaArea(detMap)
+
+    NumOfMin = None
+    newPatches = {}
+
+    if AS / AU >= params['splitOverlapThr']:
+
+        patchEccMapf = np.zeros(eccMapf.shape)
+        patchEccMapf[:] = np.nan
+        patchEccMapf[rows, cols] = eccMapf[rows, cols]
+
+        minMarker = localMin(patchEccMapf, params['splitLocalMinCutStep'])
+        NumOfMin = np.amax(minMarker)
+
+        if NumOfMin > 1:
+            newPatches = patch.splitLocal(patchEccMapf,
+                                          patchName=key,
+                                          cutStep=params['splitLocalMinCutStep'],
+                                          borderWidth=params['borderWidth'],
+                                          isplot=False,
+                                          offset=offset,
+                                          minMarker=minMarker)
+
+    return key, AU, AS, NumOfMin, newPatches
+
+
+def _processTrialFileWorker(args):
+    """
+    wrapper of processTrialFile for multiprocessing.Pool, args: (trialPath, params, saveFolder, retryNum)
+    """
+    return processTrialFile(*args)
+
+
+def batchProcessTrials(trialPaths, params=None, saveFolder=None, processNum=None, retryNum=1, isSkipError=True,
+                       isVerbose=True):
+    """
+    process a list of retinotopic mapping trials across a process pool. Each processed trial is saved into
+    'saveFolder' as soon as it finishes.
+
+    :param trialPaths: list of trial file paths, same as the input of loadTrial
+    :param params: dictionary of segmentation parameters applied to every trial, if None, the parameters saved in
+                   each trial will be used
+    :param saveFolder: folder to save processed trials and the summary table 'batch_summary.txt', if None, nothing
+                       will be saved
+    :param processNum: number of worker processes, if None, use the number of cpus. if 1, process in current process
+    :param retryNum: number of retries for each trial if processing fails
+    :param isSkipError: if True, skip failed trials, if False, stop the batch and raise RuntimeError at the first
+                        failed trial
+    :param isVerbose: if True, print progress
+    :return: list of summary dictionaries (see processTrialFile), in the same order as trialPaths
+
+    raise ValueError if trialPaths contains duplicates, or, if saveFolder is not None, trials with the same file name
+    """
+
+    # each trial is saved as saveFolder/<file name of the trial>, different trials can not share a file name
+    outputNames = {}
+    for trialPath in trialPaths:
+        if saveFolder is None:
+            outputName = os.path.normcase(os.path.abspath(trialPath))
+        else:
+            outputName = os.path.normcase(os.path.basename(trialPath))
+        outputNames.setdefault(outputName, []).append(trialPath)
+    duplicates = [paths for paths in outputNames.values() if len(paths) > 1]
+    if duplicates:
+        raise ValueError('Trials should be unique and have unique file names (processed trials are saved by file '
+                         'name), duplicates: ' + '; '.join([', '.join(paths) for paths in duplicates]))
+
+    if saveFolder is not None and not os.path.isdir(saveFolder):
+        os.makedirs(saveFolder)
+
+    if processNum is None:
+        processNum = multiprocessing.cpu_count()
+
+    argsList = [(trialPath, params, saveFolder, retryNum) for trialPath in trialPaths]
+
+    if processNum == 1:
+        pool = None
+        results = (_processTrialFileWorker(args) for args in argsList)
+    else:
+        pool = multiprocessing.Pool(processes=processNum)
+        results = pool.imap_unordered(_processTrialFileWorker, argsList)
+
+    summaries = {}
+    try:
+        for summary in results:
+            summaries[summary['trialPath']] = summary
+
+            if isVerbose:
+                print 'batchProcessTrials: ' + str(len(summaries)) + '/' + str(len(argsList)) + ' ' + \
+                      summary['trialName'] + ', ' + summary['status'] + ', ' + \
+                      '%.2f second(s).' % summary['duration']
+
+            if summary['status'] != 'done' and not isSkipError:
+                raise RuntimeError('Failed to process trial: ' + summary['trialPath'] + '. ' + str(summary['error']))
+    finally:
+        if pool is not None:
+            pool.terminate()
+            pool.join()
+
+    summaries = [summaries[trialPath] for trialPath in trialPaths]
+
+    if saveFolder is not None:
+        with open(os.path.join(saveFolder, 'batch_summary.txt'), 'w') as f:
+            f.write(formatBatchSummary(summaries))
+
+    return summaries
+
+
+def formatBatchSummary(summaries):
+    """
+    generate a text table of timings and patch counts from the summaries returned by batchProcessTrials
+    """
+
+    lines = ['%-40s %-8s %8s %12s %8s  %s' % ('trialName', 'status', 'attempts', 'duration(s)', 'patches', 'error')]
+    for summary in summaries:
+        lines.append('%-40s %-8s %8d %12.2f %8d  %s' % (summary['trialName'],
+                                                       summary['status'],
+                                                       summary['attemptNum'],
+                                                       summary['duration'],
+                                                       summary['patchNum'],
+                                                       '' if summary['error'] is None else summary['error']))
+
+    durations = [s['duration'] for s in summaries if s['status'] == 'done']
+    lines.append('')
+    lines.append('processed: %d/%d, total processing time: %.2f second(s).' % (len(durations), len(summaries),
+                                                                              np.sum(durations)))
+
+    return '\n'.join(lines) + '\n'
+
+
 def visualSignMap(phasemap1, phasemap2):
     """
     calculate visual sign map from two orthogonally oriented phase maps
@@ -169,20 +556,31 @@ def dilationPatches(rawPatches, smallPatchThr=5, borderWidth=1):  # pixel width
     # removing small edges
     labeledPatches, patchNum = ni.label(newPatches)
 
-    for i in xrange(1, patchNum + 1):
-        currPatch = np.array(labeledPatches)
-        currPatch[currPatch != i] = 0
-        currPatch = currPatch / i
-
-        if (np.sum(np.multiply(currPatch, rawPatches)[:]) == 0) or (np.sum(currPatch[:]) < smallPatchThr):
-            # revCurrPatch = -1 * (currPatch - 1)
-            # newPatches = np.multiply(newPatches, revCurrPatch)
-            newPatches[currPatch == 1] = 0
-
-        else:
-            currPatch = ni.binary_closing(currPatch,
-                                          structure=np.ones((borderWidth + 2, borderWidth + 2))).astype(np.int)
-            newPatches[currPatch == 1] = 1
+    # area and overlap with raw patches of every component, indexed by label
+    patchAreas = np.bincount(labeledPatches.ravel(), minlength=patchNum + 1)
+    patchOverlaps = np.bincount(labeledPatches.ravel(), weights=np.asarray(rawPatches).ravel().astype(np.float64),
+                                minlength=patchNum + 1)
+    isRemoved = (patchOverlaps == 0) | (patchAreas < smallPatchThr)
+    isRemoved[0] = False
+
+    newPatches[isRemoved[labeledPatches]] = 0
+
+    # closing every remaining component within its bounding box, the margin is wide enough for dilation and
+    # erosion to be unaffected by the box edges. The closing of a component does not fill removed components with
+    # larger labels, as they are removed after it in label order.
+    structure = np.ones((borderWidth + 2, borderWidth + 2))
+    margin = 2 * (borderWidth + 2)
+    for i, bbox in enumerate(ni.find_objects(labeledPatches)):
+        label = i + 1
+        if bbox is None or isRemoved[label]:
+            continue
+
+        cropSlice = tuple(slice(max(sl.start - margin, 0), min(sl.stop + margin, length))
+                          for sl, length in zip(bbox, labeledPatches.shape))
+        cropLabels = labeledPatches[cropSlice]
+        cropPatch = ni.binary_closing(cropLabels == label, structure=structure)
+        cropPatch[(cropLabels > label) & isRemoved[cropLabels]] = False
+        newPatches[cropSlice][cropPatch] = 1
 
     return newPatches
 
@@ -210,17 +608,13 @@ def dilationPatches2(rawPatches, dilationIter=20, borderWidth=1):  # pixel width
     # removing small edges
     labeledPatches, patchNum = ni.label(newPatches)
 
-    newPatches2 = np.zeros(newPatches.shape, dtype=np.int)
-
-    for i in xrange(1, patchNum + 1):
-        currPatch = np.zeros(labeledPatches.shape, dtype=np.int)
-        currPatch[labeledPatches == i] = 1
-        currPatch[labeledPatches != i] = 0
+    # keep components overlapping with raw patches
+    patchOverlaps = np.bincount(labeledPatches.ravel(), weights=np.asarray(rawPatches).ravel().astype(np.float64),
+                                minlength=patchNum + 1)
+    isKept = patchOverlaps > 0
+    isKept[0] = False
 
-        if (np.sum(np.multiply(currPatch, rawPatches)[:]) > 0):
-            #            currPatch = ni.binary_closing(currPatch,
-            #                                          structure = np.ones((borderWidth+2,borderWidth+2))).astype(np.int)
-            newPatches2[currPatch == 1] = 1
+    newPatches2 = isKept[labeledPatches].astype(np.int)
 
     return newPatches2
 
@@ -266,32 +660,125 @@ def labelPatches(patchmap, signMap):
     return patches
 
 
-def phaseFilter(phaseMap, filterType='gaussian', filterSize=3, isPositive=True):
+# FFT of filter kernels, keyed by (filter type, filter size, padded map shape), shared by all calls in a process
+_FFT_KERNEL_CACHE = {}
+_FFT_KERNEL_CACHE_SIZE = 32
+
+
+def _getFilterRadius(filterType, filterSize):
+    if filterType == 'gaussian':
+        # same as the default truncate (4.0) of ni.gaussian_filter
+        return int(4. * float(filterSize) + 0.5)
+    else:
+        return int(filterSize) // 2 + 1
+
+
+def _getFFTKernel(filterType, filterSize, shape):
     """
-    smooth phaseMap in a circular fashion. filterType should be "gaussian" or "uniform"
-    isPositive: bool, if Ture return phase [0 2pi], if False return phase [-pi, pi]
+    FFT (np.fft.rfft2) of the convolution kernel of ni.gaussian_filter or ni.uniform_filter, embedded in a frame
+    with the given shape (centered at [0, 0]). The kernel is the response of the ndimage filter to a delta.
     """
 
-    phaseMapSin = np.sin(phaseMap)
-    phaseMapCos = np.cos(phaseMap)
+    key = (filterType, float(filterSize), tuple(shape))
+
+    if key not in _FFT_KERNEL_CACHE:
+        radius = _getFilterRadius(filterType, filterSize)
+        delta = np.zeros((2 * radius + 1, 2 * radius + 1), dtype=np.float64)
+        delta[radius, radius] = 1.
+        if filterType == 'gaussian':
+            kernel = ni.filters.gaussian_filter(delta, filterSize, mode='constant')
+        else:
+            kernel = ni.filters.uniform_filter(delta, filterSize, mode='constant')
 
-    if filterType == 'Gaussian':
-        phaseMapSinf = ni.filters.gaussian_filter(phaseMapSin, filterSize)
-        phaseMapCosf = ni.filters.gaussian_filter(phaseMapCos, filterSize)
+        kernelFrame = np.zeros(shape, dtype=np.float64)
+        offsets = np.arange(-radius, radius + 1)
+        kernelFrame[np.ix_(offsets % shape[0], offsets % shape[1])] = kernel
 
-    elif filterType == 'uniform':
-        phaseMapSinf = ni.filters.uniform_filter(phaseMapSin, filterSize)
-        phaseMapCosf = ni.filters.uniform_filter(phaseMapCos, filterSize)
+        if len(_FFT_KERNEL_CACHE) >= _FFT_KERNEL_CACHE_SIZE:
+            _FFT_KERNEL_CACHE.clear()
+        _FFT_KERNEL_CACHE[key] = np.fft.rfft2(kernelFrame)
 
-    else:
+    return _FFT_KERNEL_CACHE[key]
+
+
+def filterMapStack(maps, filterType='gaussian', filterSize=3, method='auto'):
+    """
+    gaussian or uniform filter every map in a stack, same as ni.filters.gaussian_filter or ni.filters.uniform_filter
+    (mode 'reflect') on each map
+
+    :param maps: 3d array (N, height, width) or list of 2d arrays with the same shape
+    :param filterType: 'gaussian' (filterSize is sigma) or 'uniform' (filterSize is the size of the window)
+    :param filterSize: sigma or window size, pixel
+    :param method: 'direct': filter map by map with ndimage,
+                   'fft': filter all maps together in frequency domain, the kernel FFT is cached for the same filter
+                          and map shape,
+                   'auto': 'fft' if the filter radius is larger than 8 pixels and there is no nan in maps, otherwise
+                           'direct'
+    :return: 3d array, (N, height, width), np.float64
+    """
+
+    filterType = filterType.lower()
+    if filterType not in ('gaussian', 'uniform'):
         raise ValueError('filterType should be either "gaussian" or "uniform".')
 
-    phaseMapf = np.arctan2(phaseMapSinf, phaseMapCosf)
+    maps = np.asarray(maps)
+    if len(maps.shape) != 3:
+        raise ValueError, 'maps should be a 3d array (N, height, width)!'
+
+    radius = _getFilterRadius(filterType, filterSize)
+
+    if method == 'auto':
+        if radius > 8 and not np.any(np.isnan(maps)):
+            method = 'fft'
+        else:
+            method = 'direct'
+
+    if method == 'direct':
+        if filterType == 'gaussian':
+            return np.array([ni.filters.gaussian_filter(m, filterSize) for m in maps], dtype=np.float64)
+        else:
+            return np.array([ni.filters.uniform_filter(m, filterSize) for m in maps], dtype=np.float64)
+    elif method == 'fft':
+        # 'symmetric' padding of numpy is the 'reflect' mode of ndimage, the circular wrap of the FFT only affects
+        # the padded margin
+        paddedMaps = np.pad(maps.astype(np.float64), ((0, 0), (radius, radius), (radius, radius)), mode='symmetric')
+        paddedShape = paddedMaps.shape[1:]
+        kernelFFT = _getFFTKernel(filterType, filterSize, paddedShape)
+        filteredMaps = np.fft.irfft2(np.fft.rfft2(paddedMaps) * kernelFFT, s=paddedShape)
+        return filteredMaps[:, radius:radius + maps.shape[1], radius:radius + maps.shape[2]]
+    else:
+        raise ValueError('method should be "auto", "direct" or "fft".')
+
+
+def phaseFilterStack(phaseMaps, filterType='gaussian', filterSize=3, isPositive=True, method='auto'):
+    """
+    smooth a stack of phase maps (N, height, width) in a circular fashion, sin and cos of all maps are filtered in
+    one filterMapStack call. filterType should be "gaussian" or "uniform"
+    isPositive: bool, if Ture return phase [0 2pi], if False return phase [-pi, pi]
+    """
+
+    phaseMaps = np.asarray(phaseMaps)
+    phaseMapNum = phaseMaps.shape[0]
+
+    sinCosf = filterMapStack(np.concatenate((np.sin(phaseMaps), np.cos(phaseMaps)), axis=0), filterType=filterType,
+                             filterSize=filterSize, method=method)
+
+    phaseMapsf = np.arctan2(sinCosf[:phaseMapNum], sinCosf[phaseMapNum:])
 
     if isPositive:
-        phaseMapf = phaseMapf % (2 * np.pi)
+        phaseMapsf = phaseMapsf % (2 * np.pi)
+
+    return phaseMapsf
 
-    return phaseMapf
+
+def phaseFilter(phaseMap, filterType='gaussian', filterSize=3, isPositive=True):
+    """
+    smooth phaseMap in a circular fashion. filterType should be "gaussian" or "uniform"
+    isPositive: bool, if Ture return phase [0 2pi], if False return phase [-pi, pi]
+    """
+
+    return phaseFilterStack(np.asarray(phaseMap)[None, :, :], filterType=filterType, filterSize=filterSize,
+                            isPositive=isPositive)[0]
 
 
 def visualCoverage(patch, altMap, aziMap, pixelSize=2., closeIter=None, isPlot=False):
@@ -383,33 +870,64 @@ def localMin(eccMap, binSize):
     """
     find local minimum of eccenticity map (in degree), with binning by binSize
     in degree
+
+    the map is thresholded at steps of binSize from its minimum, and the labeled map at the first threshold that
+    separates it into more than one component is returned (or the map at the last threshold if it never separates).
+    The number of components at every threshold is derived in one pass from the minimum spanning forest of the
+    4-connected pixel graph (edge weight: the larger value of the two pixels), so only one labeling is needed.
     """
 
-    eccMap2 = np.array(eccMap)
+    eccMap2 = np.array(eccMap, dtype=np.float64)
     cutStep = np.arange(np.nanmin(eccMap2[:]) - binSize,
                         np.nanmax(eccMap2[:]) + binSize * 2,
                         binSize)
-    NumOfMin = 0
-    i = 0
-    while (NumOfMin <= 1) and (i < len(cutStep)):
-        currThr = cutStep[i]
-        marker = np.zeros(eccMap.shape, dtype=np.int)
-        marker[eccMap2 <= (currThr)] = 1
-        marker, NumOfMin = ni.measurements.label(marker)
-        i = i + 1
-
-    #    if NumOfMin == 1:
-    #        print 'Only one local minumum was found!!!'
-    #    elif NumOfMin == 0:
-    #        print 'No local minumum was found!!!'
-    #    else:
-    #        print str(NumOfMin) + ' local minuma were found!!!'
-    #
-    #    if NumOfMin > 1:
-    #        plt.figure()
-    #        plt.imshow(marker,vmin=np.amin(marker), vmax=np.amax(marker),cmap='jet',interpolation='nearest')
-    #        plt.colorbar()
-    #        plt.title('marker from local min')
+
+    if len(cutStep) == 0:
+        return np.zeros(eccMap.shape, dtype=np.int)
+
+    isValid = ~np.isnan(eccMap2)
+    pixelValues = np.sort(eccMap2[isValid])
+
+    # edges between 4-connected valid pixels
+    pixelInd = np.arange(eccMap2.size).reshape(eccMap2.shape)
+    edgeStarts = []
+    edgeEnds = []
+    for axis in range(eccMap2.ndim):
+        sl0 = [slice(None)] * eccMap2.ndim
+        sl1 = [slice(None)] * eccMap2.ndim
+        sl0[axis] = slice(None, -1)
+        sl1[axis] = slice(1, None)
+        isEdge = isValid[tuple(sl0)] & isValid[tuple(sl1)]
+        edgeStarts.append(pixelInd[tuple(sl0)][isEdge])
+        edgeEnds.append(pixelInd[tuple(sl1)][isEdge])
+    edgeStarts = np.concatenate(edgeStarts)
+    edgeEnds = np.concatenate(edgeEnds)
+    edgeWeights = np.maximum(eccMap2.flat[edgeStarts], eccMap2.flat[edgeEnds])
+
+    if len(edgeWeights) > 0:
+        # use ranks as weights, zero weight means no edge in csgraph
+        edgeOrder = np.argsort(edgeWeights, kind='mergesort')
+        edgeRanks = np.empty(len(edgeWeights), dtype=np.float64)
+        edgeRanks[edgeOrder] = np.arange(1, len(edgeWeights) + 1)
+        graph = sparse.coo_matrix((edgeRanks, (edgeStarts, edgeEnds)), shape=(eccMap2.size, eccMap2.size)).tocsr()
+        forestRanks = minimum_spanning_tree(graph).data.astype(np.int64)
+        forestWeights = np.sort(edgeWeights[edgeOrder][forestRanks - 1])
+    else:
+        forestWeights = np.array([], dtype=np.float64)
+
+    # number of components = number of pixels - number of forest edges below threshold
+    componentNums = np.searchsorted(pixelValues, cutStep, side='right') - \
+                    np.searchsorted(forestWeights, cutStep, side='right')
+
+    separatedInd = np.flatnonzero(componentNums > 1)
+    if len(separatedInd) > 0:
+        currThr = cutStep[separatedInd[0]]
+    else:
+        currThr = cutStep[-1]
+
+    marker = np.zeros(eccMap.shape, dtype=np.int)
+    marker[eccMap2 <= (currThr)] = 1
+    marker, NumOfMin = ni.measurements.label(marker)
 
     return marker
 
@@ -481,6 +999,177 @@ def eccentricityMap(altMap, aziMap, altCenter, aziCenter):
     return eccMap
 
 
+def determinantMap(altMap, aziMap):
+    """
+    absolute value of the determinant of the Jacobian of the visual space (altitude, azimuth) over the cortex,
+    calculated in closed form from the gradient maps
+    """
+
+    gradAlt0, gradAlt1 = np.gradient(altMap)
+    gradAzi0, gradAzi1 = np.gradient(aziMap)
+
+    return np.abs(gradAlt0 * gradAzi1 - gradAlt1 * gradAzi0)
+
+
+def getPatchMeasurements(patches, detMap, pixelSize=0.0129, magMap=None):
+    """
+    pixel area, cortical area, sigma area and magnification of every patch, reduced in one pass over the pixels of
+    all patches (patches are allowed to overlap)
+
+    :param patches: dictionary {patchName: Patch}
+    :param detMap: determinant map, see determinantMap
+    :param pixelSize: pixel size on cortex, mm
+    :param magMap: magnification map (mm^2/deg^2 per pixel^2), if None, 1 / detMap
+    :return: dictionary {patchName: {'area': pixel number,
+                                     'corticalArea': mm^2,
+                                     'sigmaArea': sum of detMap in the patch, deg^2,
+                                     'magnification': mean magnification in the patch, mm^2/deg^2}}
+    """
+
+    keys = list(patches.keys())
+    if not keys:
+        return {}
+
+    patchInd = np.concatenate([np.zeros(len(patches[key].sparseArray.row), dtype=np.intp) + i
+                               for i, key in enumerate(keys)])
+    rows = np.concatenate([patches[key].sparseArray.row for key in keys])
+    cols = np.concatenate([patches[key].sparseArray.col for key in keys])
+
+    if magMap is None:
+        with np.errstate(divide='ignore'):
+            magMap = 1 / detMap
+
+    areas = np.bincount(patchInd, minlength=len(keys)).astype(np.float64)
+    sigmaAreas = np.bincount(patchInd, weights=detMap[rows, cols], minlength=len(keys))
+    totalMags = np.bincount(patchInd, weights=magMap[rows, cols], minlength=len(keys))
+
+    measurements = {}
+    for i, key in enumerate(keys):
+        measurements.update({key: {'area': areas[i],
+                                   'corticalArea': areas[i] * (pixelSize ** 2),
+                                   'sigmaArea': sigmaAreas[i],
+                                   'magnification': (pixelSize ** 2) * totalMags[i] / areas[i]}})
+
+    return measurements
+
+
+def getLabelMap(patches):
+    """
+    generate a single label image from a patch dictionary
+
+    :return: labelMap: 2d array, np.int32, 0 for background, i for pixels in the patch keys[i-1]. if patches overlap,
+                       the later patch in keys overwrites the earlier ones
+             keys: list of patch names, in the order of labels
+    """
+
+    keys = list(patches.keys())
+    labelMap = None
+    for i, key in enumerate(keys):
+        patchArray = patches[key].sparseArray
+        if labelMap is None:
+            labelMap = np.zeros(patchArray.shape, dtype=np.int32)
+        labelMap[patchArray.row, patchArray.col] = i + 1
+
+    return labelMap, keys
+
+
+def erodeLabelMap(labelMap, iterations=1):
+    """
+    erode all labeled patches at once, same as ni.binary_erosion (default cross structure, pixels outside the frame
+    count as background) of each patch: in each iteration, a pixel keeps its label only if its four neighbours have
+    the same label
+
+    :return: 2d array, eroded label map
+    """
+
+    erodedMap = np.array(labelMap)
+    for _ in range(iterations):
+        paddedMap = np.pad(erodedMap, 1, mode='constant')
+        isKept = (erodedMap == paddedMap[:-2, 1:-1]) & (erodedMap == paddedMap[2:, 1:-1]) & \
+                 (erodedMap == paddedMap[1:-1, :-2]) & (erodedMap == paddedMap[1:-1, 2:])
+        erodedMap = np.where(isKept, erodedMap, 0)
+
+    return erodedMap
+
+
+def getPixelVisualCenters(altMap, aziMap, labelMap, labelNum=None):
+    """
+    get the center coordinates in visual space for all labeled patches at once, same as
+    Patch.getPixelVisualCenter for each patch
+
+    :return: altCenters, aziCenters: 1d arrays with length labelNum + 1, indexed by label. index 0 (background) is nan
+    """
+
+    if labelNum is None:
+        labelNum = np.amax(labelMap)
+
+    index = np.arange(1, labelNum + 1)
+
+    centers = []
+    for currMap in (altMap, aziMap):
+        isNonZero = (currMap != 0).astype(np.float64)
+        total = np.array(ni.sum(currMap * isNonZero, labels=labelMap, index=index), dtype=np.float64)
+        count = np.array(ni.sum(isNonZero, labels=labelMap, index=index), dtype=np.float64)
+        currCenters = np.empty(labelNum + 1, dtype=np.float64)
+        currCenters[0] = np.nan
+        with np.errstate(invalid='ignore', divide='ignore'):
+            currCenters[1:] = total / count
+        centers.append(currCenters)
+
+    return centers[0], centers[1]
+
+
+def labelEccentricityMaps(altMap, aziMap, labelMap, altCenters, aziCenters, filterSize=None):
+    """
+    calculate eccentricity maps of all labeled patches at once, each pixel relative to the visual center of the patch
+    it belongs to
+
+    :param altMap: altitude map, degree
+    :param aziMap: azimuth map, degree
+    :param labelMap: label image, 0 for background
+    :param altCenters: altitude center of each label, indexed by label, degree
+    :param aziCenters: azimuth center of each label, indexed by label, degree
+    :param filterSize: size of uniform filter, if not None, also return filtered eccentricity map. For each patch,
+                       the filtered values are the same as uniform filtering the full frame eccentricity map relative
+                       to its center, but only the bounding box of the patch (plus a margin of filter size) is
+                       computed
+    :return: eccMap, eccMapf (None if filterSize is None), degree, nan outside patches
+    """
+
+    isPatch = labelMap > 0
+
+    eccMap = np.empty(labelMap.shape, dtype=np.float64)
+    eccMap[:] = np.nan
+    eccMap[isPatch] = eccentricityMap(altMap[isPatch], aziMap[isPatch],
+                                      altCenters[labelMap[isPatch]], aziCenters[labelMap[isPatch]])
+
+    if filterSize is None:
+        return eccMap, None
+
+    eccMapf = np.empty(labelMap.shape, dtype=np.float64)
+    eccMapf[:] = np.nan
+    margin = int(np.ceil(filterSize)) + 1
+
+    for i, bbox in enumerate(ni.find_objects(labelMap)):
+        if bbox is None:
+            continue
+        label = i + 1
+        rowStart = max(bbox[0].start - margin, 0)
+        rowEnd = min(bbox[0].stop + margin, labelMap.shape[0])
+        colStart = max(bbox[1].start - margin, 0)
+        colEnd = min(bbox[1].stop + margin, labelMap.shape[1])
+
+        cropEccMap = eccentricityMap(altMap[rowStart:rowEnd, colStart:colEnd],
+                                     aziMap[rowStart:rowEnd, colStart:colEnd],
+                                     altCenters[label], aziCenters[label])
+        cropEccMapf = ni.filters.uniform_filter(cropEccMap, filterSize)
+
+        cropPatch = labelMap[rowStart:rowEnd, colStart:colEnd] == label
+        eccMapf[rowStart:rowEnd, colStart:colEnd][cropPatch] = cropEccMapf[cropPatch]
+
+    return eccMap, eccMapf
+
+
 def sortPatches(patchDict):
     """
     from a patch dictionary generate an new dictionary with patches sorted by there area
@@ -938,8 +1627,187 @@ def plotPairedPatches(patch1, patch2, altMap, aziMap, title, pixelSize=1, closeI
     f_122.set_yticklabels(yticklabel)
 
 
-def getPatchDict(patch):
-    return {'sparseArray': patch.sparseArray, 'sign': patch.sign}
+def _sweepParamsWorker(args):
+    """
+    process one group of parameter combinations for RetinotopicMappingTrial.sweepParams, args: (trial, list of
+    (combination index, params), pixelSize). return {combination index: result dictionary}
+    """
+
+    trial, groupParams, pixelSize = args
+    trial = trial._copy()
+
+    results = {}
+    for ind, params in groupParams:
+        startTime = time.time()
+        trial.params = params
+        trial.processTrial(isIncremental=True)
+        duration = time.time() - startTime
+
+        areas = [patch.getArea() * (pixelSize ** 2) for patch in trial.finalPatches.itervalues()]
+
+        visualSpace = None
+        for patch in trial.finalPatches.itervalues():
+            currVisualSpace, _, _, _ = patch.getVisualSpace(trial.altPosMapf,
+                                                            trial.aziPosMapf,
+                                                            pixelSize=params['visualSpacePixelSize'],
+                                                            closeIter=params['visualSpaceCloseIter'])
+            if visualSpace is None:
+                visualSpace = currVisualSpace > 0
+            else:
+                visualSpace = np.logical_or(visualSpace, currVisualSpace > 0)
+
+        if visualSpace is None:
+            coverage = 0.
+        else:
+            coverage = np.sum(visualSpace) * (params['visualSpacePixelSize'] ** 2)
+
+        results[ind] = {'patchNum': len(areas),
+                        'totalArea': float(np.sum(areas)),
+                        'meanArea': float(np.mean(areas)) if areas else np.nan,
+                        'coverage': float(coverage),
+                        'duration': duration}
+
+        # processTrial generates figures for split and merged patches
+        plt.close('all')
+
+    return results
+
+
+def getPatchDict(patch, isRLE=False):
+    return patch.getDict(isRLE=isRLE)
+
+
+# counters of expensive operations in this process, recorded per stage in RetinotopicMappingTrial.processingReport
+_PROFILE_COUNTERS = {'getVisualSpace': 0, 'mergeIterations': 0}
+
+
+def _countProfile(name, num=1):
+    _PROFILE_COUNTERS[name] = _PROFILE_COUNTERS.get(name, 0) + num
+
+
+def _getProcessMaxRSS():
+    """
+    peak resident memory over the whole life of this process, MB, None if not available. ru_maxrss is in bytes on
+    mac os and in kilobytes on other unix systems
+    """
+    if resource is None:
+        return None
+    maxRSS = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    if sys.platform == 'darwin':
+        return maxRSS / 1024. ** 2
+    return maxRSS / 1024.
+
+
+def _getCurrentRSS():
+    """
+    current resident memory of this process, MB, None if not available (only linux, from /proc/self/statm)
+    """
+    try:
+        with open('/proc/self/statm') as f:
+            residentPages = int(f.read().split()[1])
+        return residentPages * resource.getpagesize() / 1024. ** 2
+    except (IOError, OSError, IndexError, ValueError, AttributeError):
+        return None
+
+
+class _RSSSampler(object):
+    """
+    sample the current resident memory in a background thread while a block of code runs, to get the peak memory
+    of this block. Short peaks between two samples can be missed
+    """
+
+    def __init__(self, interval=0.005):
+        self.interval = interval
+        self.startRSS = None
+        self.peakRSS = None
+        self._stopEvent = threading.Event()
+        self._thread = None
+
+    def _sample(self):
+        while not self._stopEvent.wait(self.interval):
+            self.peakRSS = max(self.peakRSS, _getCurrentRSS())
+
+    def __enter__(self):
+        self.startRSS = _getCurrentRSS()
+        self.peakRSS = self.startRSS
+        if self.startRSS is not None:
+            self._thread = threading.Thread(target=self._sample)
+            self._thread.daemon = True
+            self._thread.start()
+        return self
+
+    def __exit__(self, *args):
+        if self._thread is not None:
+            self._stopEvent.set()
+            self._thread.join()
+            self.peakRSS = max(self.peakRSS, _getCurrentRSS())
+
+    def getReport(self):
+        """
+        :return: {'peakRSS': peak resident memory during the block, MB,
+                  'rssIncrease': peak minus resident memory at the start of the block, MB,
+                  'processMaxRSS': peak resident memory of the process so far, MB}, None if not available
+        """
+        if self.peakRSS is None:
+            return {'peakRSS': None, 'rssIncrease': None, 'processMaxRSS': _getProcessMaxRSS()}
+        return {'peakRSS': self.peakRSS,
+                'rssIncrease': self.peakRSS - self.startRSS,
+                'processMaxRSS': _getProcessMaxRSS()}
+
+
+def _formatMemory(value):
+    return 'n/a' if value is None else '%.1f' % value
+
+
+def formatProcessingReport(report):
+    """
+    format RetinotopicMappingTrial.processingReport as a text table
+    """
+
+    lines = ['stage                  status      duration(s)  peakRSS(MB)  rssIncrease(MB)  counts']
+    for stage in report['stages']:
+        counts = ', '.join([k + '=' + str(v) for k, v in sorted(stage['counts'].items())])
+        lines.append('{:<22} {:<11} {:>11.3f}  {:>11}  {:>15}  {}'.format(stage['stage'], stage['status'],
+                                                                         stage['duration'],
+                                                                         _formatMemory(stage.get('peakRSS')),
+                                                                         _formatMemory(stage.get('rssIncrease')),
+                                                                         counts))
+    lines.append('total duration: {:.3f} s'.format(report['totalDuration']))
+    return '\n'.join(lines)
+
+
+# processing stages of RetinotopicMappingTrial.processTrial, in the order of execution. For each stage:
+# (method name, parameters it depends on, upstream stages it depends on, attributes it generates)
+PROCESSING_STAGES = (
+    ('_getSignMap',
+     ('phaseMapFilterSigma', 'signMapFilterSigma'),
+     (),
+     ('altPosMapf', 'aziPosMapf', 'altPowerMapf', 'aziPowerMapf', 'signMap', 'signMapf')),
+    ('_getRawPatchMap',
+     ('signMapThr', 'openIter', 'closeIter'),
+     ('_getSignMap',),
+     ('rawPatchMap',)),
+    ('_getRawPatches',
+     ('dilationIter', 'borderWidth', 'smallPatchThr'),
+     ('_getRawPatchMap',),
+     ('rawPatches',)),
+    ('_getDeterminantMap',
+     (),
+     ('_getSignMap',),
+     ('determinantMap',)),
+    ('_getEccentricityMap',
+     ('eccMapFilterSigma',),
+     ('_getRawPatches',),
+     ('eccentricityMap', 'eccentricityMapf')),
+    ('_splitPatches',
+     ('visualSpacePixelSize', 'visualSpaceCloseIter', 'splitLocalMinCutStep', 'splitOverlapThr', 'borderWidth'),
+     ('_getEccentricityMap', '_getDeterminantMap'),
+     ('patchesAfterSplit',)),
+    ('_mergePatches',
+     ('borderWidth', 'visualSpacePixelSize', 'visualSpaceCloseIter', 'mergeOverlapThr', 'smallPatchThr'),
+     ('_splitPatches',),
+     ('patchesAfterMerge', 'finalPatches')),
+)
 
 
 class RetinotopicMappingTrial(object):
@@ -980,6 +1848,70 @@ class RetinotopicMappingTrial(object):
         self.comments = comments
         self.params = params
 
+    def __getattr__(self, name):
+        """
+        load maps and patches of trials from hdf5 files on first access (see loadTrialH5)
+        """
+
+        if not name.startswith('_') and name in self.__dict__.get('_lazyKeys', ()):
+            h5File = self.__dict__.get('_lazyFile')
+            if h5File is None or not h5File.id.valid:
+                h5File = h5py.File(self._lazyPath, 'r')
+                self._lazyFile = h5File
+            value = _loadH5Value(h5File, name)
+            setattr(self, name, value)
+            self._lazyKeys.discard(name)
+            if not self._lazyKeys:
+                self._closeH5File()
+            return value
+
+        raise AttributeError, "'" + type(self).__name__ + "' object has no attribute '" + name + "'"
+
+    def __delattr__(self, name):
+        """
+        also forget maps and patches not loaded yet from hdf5 files, so they will not be read back after deletion
+        """
+
+        lazyKeys = self.__dict__.get('_lazyKeys', set())
+        if name in lazyKeys:
+            lazyKeys.discard(name)
+            self.__dict__.pop(name, None)
+            if not lazyKeys:
+                self._closeH5File()
+        else:
+            object.__delattr__(self, name)
+
+    def __getstate__(self):
+        """
+        the open hdf5 file is not pickled or copied, copies open their own file on the next lazy access
+        """
+
+        state = dict(self.__dict__)
+        state.pop('_lazyFile', None)
+        return state
+
+    def __del__(self):
+        self._closeH5File()
+
+    def _closeH5File(self):
+        """
+        close the hdf5 file kept open for lazy loading (see loadTrialH5), it will be opened again if a map or patch
+        dictionary not loaded yet is accessed
+        """
+
+        h5File = self.__dict__.pop('_lazyFile', None)
+        if h5File is not None and h5File.id.valid:
+            h5File.close()
+
+    def saveTrialH5(self, h5Path, **kwargs):
+        """
+        save the trial dictionary (see generateTrialDict, keyword arguments are passed to it) into a hdf5 file (see
+        saveTrialH5 in this module)
+        """
+        trialDict = self.generateTrialDict(**kwargs)
+        self._closeH5File()
+        saveTrialH5(trialDict, h5Path)
+
     def getName(self):
 
         trialName = str(self.dateRecorded) + \
@@ -992,29 +1924,25 @@ class RetinotopicMappingTrial(object):
 
     def _getSignMap(self, isReverse=False, isPlot=False, isFixedRange=True):
 
-        altPosMapf = ni.filters.gaussian_filter(self.altPosMap,
-                                                self.params['phaseMapFilterSigma'])
-        aziPosMapf = ni.filters.gaussian_filter(self.aziPosMap,
-                                                self.params['phaseMapFilterSigma'])
+        # position and power maps are filtered together
+        maps = [self.altPosMap, self.aziPosMap, self.altPowerMap, self.aziPowerMap]
+        mapInds = [i for i, m in enumerate(maps) if m is not None and np.shape(m) == np.shape(self.altPosMap)]
+        mapsf = [None] * len(maps)
+        for i, mapf in zip(mapInds, filterMapStack([maps[i] for i in mapInds], filterType='gaussian',
+                                                   filterSize=self.params['phaseMapFilterSigma'])):
+            mapsf[i] = mapf
+        for i, m in enumerate(maps):
+            if m is not None and mapsf[i] is None:
+                mapsf[i] = ni.filters.gaussian_filter(m, self.params['phaseMapFilterSigma'])
 
-        if self.altPowerMap is not None:
-            altPowerMapf = ni.filters.gaussian_filter(self.altPowerMap,
-                                                      self.params['phaseMapFilterSigma'])
-        else:
-            altPowerMapf = None
-
-        if self.aziPowerMap is not None:
-            aziPowerMapf = ni.filters.gaussian_filter(self.aziPowerMap,
-                                                      self.params['phaseMapFilterSigma'])
-        else:
-            aziPowerMapf = None
+        altPosMapf, aziPosMapf, altPowerMapf, aziPowerMapf = mapsf
 
         signMap = visualSignMap(altPosMapf, aziPosMapf)
 
         if isReverse: signMap = signMap * -1
 
-        signMapf = ni.filters.gaussian_filter(signMap,
-                                              self.params['signMapFilterSigma'])
+        signMapf = filterMapStack(signMap[None, :, :], filterType='gaussian',
+                                  filterSize=self.params['signMapFilterSigma'])[0]
 
         if isPlot:
             f1 = plt.figure(figsize=(18, 9))
@@ -1189,14 +2117,7 @@ class RetinotopicMappingTrial(object):
         altPosMapf = self.altPosMapf
         aziPosMapf = self.aziPosMapf
 
-        gradAltMap = np.gradient(altPosMapf)
-        gradAziMap = np.gradient(aziPosMapf)
-
-        detMap = np.array([[gradAltMap[0], gradAltMap[1]],
-                           [gradAziMap[0], gradAziMap[1]]])
-
-        detMap = detMap.transpose(2, 3, 0, 1)
-        detMap = np.abs(np.linalg.det(detMap))
+        detMap = determinantMap(altPosMapf, aziPosMapf)
 
         if isPlot:
             plt.figure()
@@ -1219,18 +2140,15 @@ class RetinotopicMappingTrial(object):
         eccMapFilterSigma = self.params['eccMapFilterSigma']
         patches = self.rawPatches
 
-        eccMap = np.zeros(altPosMapf.shape)
-        eccMapf = np.zeros(altPosMapf.shape)
-        eccMap[:] = np.nan
-        eccMapf[:] = np.nan
-
-        for key, value in patches.iteritems():
-            patchAltC, patchAziC = value.getPixelVisualCenter(altPosMapf, aziPosMapf)
-            patchEccMap = eccentricityMap(altPosMapf, aziPosMapf, patchAltC, patchAziC)
-            patchEccMapf = ni.filters.uniform_filter(patchEccMap, eccMapFilterSigma)
-
-            eccMap[value.array == 1] = patchEccMap[value.array == 1]
-            eccMapf[value.array == 1] = patchEccMapf[value.array == 1]
+        if patches:
+            labelMap, _ = getLabelMap(patches)
+            altCenters, aziCenters = getPixelVisualCenters(altPosMapf, aziPosMapf, labelMap, len(patches))
+            eccMap, eccMapf = labelEccentricityMaps(altPosMapf, aziPosMapf, labelMap, altCenters, aziCenters,
+                                                    filterSize=eccMapFilterSigma)
+        else:
+            eccMap = np.zeros(altPosMapf.shape)
+            eccMap[:] = np.nan
+            eccMapf = np.array(eccMap)
 
         if isPlot:
             plt.figure()
@@ -1244,7 +2162,14 @@ class RetinotopicMappingTrial(object):
 
         return eccMap, eccMapf
 
-    def _splitPatches(self, isPlot=False):
+    def _splitPatches(self, isPlot=False, processNum=None):
+        """
+        split raw patches with overlapping visual space at local minima of the eccentricity map
+
+        :param processNum: number of worker processes checking and splitting patches, one patch per task. if None,
+                           use the number of cpus, or 1 inside a daemonic worker process (batchProcessTrials,
+                           sweepParams), which can not start its own pool. if 1, process in current process
+        """
 
         if not hasattr(self, 'eccentricityMapf'):
             _ = self._getEccentricityMap()
@@ -1259,30 +2184,44 @@ class RetinotopicMappingTrial(object):
         patches = dict(self.rawPatches)
         detMap = self.determinantMap
 
-        visualSpacePixelSize = self.params['visualSpacePixelSize']
-        visualSpaceCloseIter = self.params['visualSpaceCloseIter']
-        splitLocalMinCutStep = self.params['splitLocalMinCutStep']
-        splitOverlapThr = self.params['splitOverlapThr']
-        borderWidth = self.params['borderWidth']
-
         overlapPatches = []
         newPatchesDict = {}
 
+        workerParams = dict([(k, self.params[k]) for k in
+                             ('visualSpacePixelSize', 'visualSpaceCloseIter', 'splitLocalMinCutStep',
+                              'splitOverlapThr', 'borderWidth')])
+        argsList = []
         for key, value in patches.iteritems():
-            visualSpace, AU, _, _ = value.getVisualSpace(altPosMapf,
-                                                         aziPosMapf,
-                                                         pixelSize=visualSpacePixelSize,
-                                                         closeIter=visualSpaceCloseIter)
-            AS = value.getSigmaArea(detMap)
-            print key, 'AU=' + str(AU), ' AS=' + str(AS), ' ratio=' + str(AS / AU)
-
-            if AS / AU >= splitOverlapThr:
+            rowStart, rowEnd, colStart, colEnd = value.getBoundingBox(margin=workerParams['borderWidth'] + 2)
+            argsList.append((key, value, (rowStart, colStart),
+                             altPosMapf[rowStart:rowEnd, colStart:colEnd],
+                             aziPosMapf[rowStart:rowEnd, colStart:colEnd],
+                             eccMapf[rowStart:rowEnd, colStart:colEnd],
+                             detMap[rowStart:rowEnd, colStart:colEnd],
+                             workerParams))
+
+        if processNum is None:
+            if multiprocessing.current_process().daemon:
+                processNum = 1
+            else:
+                processNum = multiprocessing.cpu_count()
 
-                patchEccMapf = eccMapf * value.getMask()
-                patchEccMapf[value.array == 0] = np.nan
+        if processNum == 1 or len(argsList) <= 1:
+            results = [_splitPatchWorker(args) for args in argsList]
+        else:
+            pool = multiprocessing.Pool(processes=min(processNum, len(argsList)))
+            try:
+                results = pool.map(_splitPatchWorker, argsList)
+            finally:
+                pool.close()
+                pool.join()
+            # getVisualSpace is called once for every patch in worker processes
+            _countProfile('getVisualSpace', len(argsList))
+
+        for key, AU, AS, NumOfMin, newPatches in results:
+            print key, 'AU=' + str(AU), ' AS=' + str(AS), ' ratio=' + str(AS / AU)
 
-                minMarker = localMin(patchEccMapf, splitLocalMinCutStep)
-                NumOfMin = np.amax(minMarker)
+            if NumOfMin is not None:
 
                 if NumOfMin == 1:
                     print 'Only one local minumum was found!!!'
@@ -1293,12 +2232,6 @@ class RetinotopicMappingTrial(object):
 
                     overlapPatches.append(key)
 
-                    newPatches = value.split2(patchEccMapf,
-                                              patchName=key,
-                                              cutStep=splitLocalMinCutStep,
-                                              borderWidth=borderWidth,
-                                              isplot=False)
-
                     # plotting splitted patches
                     if len(newPatches) > 1:
 
@@ -1315,20 +2248,21 @@ class RetinotopicMappingTrial(object):
                             currArray[currArray == 1] = currPatchValue
                             f121.imshow(currArray, interpolation='nearest', vmin=0, vmax=len(newPatches.keys()))
                             f121.set_axis_off()
-                            currVisualSpace, _, _, _ = value2.getVisualSpace(altPosMapf,
-                                                                             aziPosMapf,
-                                                                             pixelSize=visualSpacePixelSize,
-                                                                             closeIter=visualSpaceCloseIter)
+                            currVisualSpace, _, _, _ = value2.getVisualSpace(
+                                altPosMapf,
+                                aziPosMapf,
+                                pixelSize=workerParams['visualSpacePixelSize'],
+                                closeIter=workerParams['visualSpaceCloseIter'])
                             currVisualSpace = currVisualSpace.astype(np.float32)
                             currVisualSpace[currVisualSpace == 0] = np.nan
                             currVisualSpace[currVisualSpace == 1] = currPatchValue
                             f122.imshow(currVisualSpace, interpolation='nearest', alpha=0.5, vmin=0,
                                         vmax=len(newPatches.keys()))
 
-                        xlabel = np.arange(-20, 120, visualSpacePixelSize)
-                        ylabel = np.arange(60, -40, -visualSpacePixelSize)
+                        xlabel = np.arange(-20, 120, workerParams['visualSpacePixelSize'])
+                        ylabel = np.arange(60, -40, -workerParams['visualSpacePixelSize'])
 
-                        indSpace = int(10. / visualSpacePixelSize)
+                        indSpace = int(10. / workerParams['visualSpacePixelSize'])
 
                         xtickInd = range(0, len(xlabel), indSpace)
                         ytickInd = range(0, len(ylabel), indSpace)
@@ -1398,6 +2332,7 @@ class RetinotopicMappingTrial(object):
         while (mergeIter == 1) or (len(mergePairs) > 0):
 
             print 'merge iteration: ' + str(mergeIter)
+            _countProfile('mergeIterations')
 
             mergePairs = []
 
@@ -1600,47 +2535,295 @@ class RetinotopicMappingTrial(object):
         except AttributeError:
             pass
 
-    def processTrial(self, isPlot=False):
-        self.cleanMaps()
-        _ = self._getSignMap(isPlot=isPlot)
-        if isPlot: plt.show()
-        _ = self._getRawPatchMap(isPlot=isPlot)
-        if isPlot: plt.show()
-        _ = self._getRawPatches(isPlot=isPlot)
-        if isPlot: plt.show()
-        _ = self._getDeterminantMap(isPlot=isPlot)
-        if isPlot: plt.show()
-        _ = self._getEccentricityMap(isPlot=isPlot)
-        if isPlot: plt.show()
-        _ = self._splitPatches(isPlot=isPlot)
-        if isPlot: plt.show()
-        _ = self._mergePatches(isPlot=isPlot)
-        if isPlot: plt.show()
+        try:
+            del self._stageFingerprints
+        except AttributeError:
+            pass
+
+    def _getInputFingerprint(self):
+        """
+        return md5 digest of the input position and power maps
+        """
+
+        md5 = hashlib.md5()
+        for currMap in (self.altPosMap, self.aziPosMap, self.altPowerMap, self.aziPowerMap):
+            if currMap is None:
+                md5.update('None')
+            else:
+                currMap = np.ascontiguousarray(currMap)
+                md5.update(str(currMap.dtype) + str(currMap.shape))
+                md5.update(currMap)
+        return md5.hexdigest()
+
+    def getStageFingerprints(self):
+        """
+        return a dictionary of fingerprints for each processing stage defined in PROCESSING_STAGES. The fingerprint of
+        a stage changes if any of its parameters, any of its upstream stages or the input maps change.
+        """
+
+        fingerprints = {}
+        inputFingerprint = self._getInputFingerprint()
+
+        for stageName, stageParams, upstreamStages, _ in PROCESSING_STAGES:
+            md5 = hashlib.md5(stageName)
+            if not upstreamStages:
+                md5.update(inputFingerprint)
+            for paramName in stageParams:
+                md5.update(repr((paramName, self.params[paramName])))
+            for upstreamStage in upstreamStages:
+                md5.update(fingerprints[upstreamStage])
+            fingerprints[stageName] = md5.hexdigest()
+
+        return fingerprints
+
+    def _getCheckpointPath(self, checkpointFolder, stageName, fingerprint):
+        return os.path.join(checkpointFolder, self.getName() + stageName + '_' + fingerprint + '.pkl')
+
+    def processTrial(self, isPlot=False, isIncremental=False, checkpointFolder=None, lastStage=None, processNum=None):
+        """
+        run all processing stages defined in PROCESSING_STAGES
+
+        :param isPlot: if True, plot the results of every computed stage
+        :param isIncremental: if True, stages whose fingerprint (parameters, upstream stages and input maps) did not
+                              change since last run will be skipped, only the stages downstream of a changed parameter
+                              will be recomputed. if False, all stages will be recomputed from scratch
+        :param checkpointFolder: if not None, the output of each stage will be saved in this folder with its
+                                 fingerprint, and will be loaded from there instead of being recomputed
+        :param lastStage: name of the last stage to run, if None, run all stages
+        :param processNum: number of worker processes splitting patches, see _splitPatches
+        :return: list of names of the stages that were actually computed
+
+        a report of this run is saved in self.processingReport (see formatProcessingReport):
+        {'stages': list of {'stage': stage name,
+                            'status': 'computed', 'loaded' (from checkpoint) or 'skipped' (unchanged),
+                            'duration': wall time, second,
+                            'peakRSS': peak resident memory during this stage, MB,
+                            'rssIncrease': peakRSS minus resident memory at the start of this stage, MB,
+                            'processMaxRSS': peak resident memory of the process so far, MB,
+                            (memory values are None if not available, peakRSS and rssIncrease need linux)
+                            'counts': {'getVisualSpace': number of calls, 'mergeIterations': number of iterations}},
+         'totalDuration': second}
+        """
+
+        if isIncremental:
+            oldFingerprints = getattr(self, '_stageFingerprints', {})
+        else:
+            self.cleanMaps()
+            oldFingerprints = {}
+
+        if checkpointFolder is not None and not os.path.isdir(checkpointFolder):
+            os.makedirs(checkpointFolder)
+
+        totalStartTime = time.time()
+        fingerprints = self.getStageFingerprints()
+        self._stageFingerprints = {}
+        computedStages = []
+        stageReports = []
+
+        for stageName, _, _, outputs in PROCESSING_STAGES:
+            fingerprint = fingerprints[stageName]
+            startTime = time.time()
+            startCounts = dict(_PROFILE_COUNTERS)
+
+            with _RSSSampler() as sampler:
+                if oldFingerprints.get(stageName) == fingerprint and all([hasattr(self, o) for o in outputs]):
+                    status = 'skipped'
+                elif checkpointFolder is not None and \
+                        os.path.isfile(self._getCheckpointPath(checkpointFolder, stageName, fingerprint)):
+                    self.__dict__.update(ft.loadFile(self._getCheckpointPath(checkpointFolder, stageName,
+                                                                             fingerprint)))
+                    status = 'loaded'
+                else:
+                    if stageName == '_splitPatches':
+                        _ = self._splitPatches(isPlot=isPlot, processNum=processNum)
+                    else:
+                        _ = getattr(self, stageName)(isPlot=isPlot)
+                    if isPlot: plt.show()
+                    computedStages.append(stageName)
+                    status = 'computed'
+                    if checkpointFolder is not None:
+                        ft.saveFile(self._getCheckpointPath(checkpointFolder, stageName, fingerprint),
+                                    dict([(o, self.__dict__[o]) for o in outputs]))
+
+            stageReport = {'stage': stageName,
+                           'status': status,
+                           'duration': time.time() - startTime,
+                           'counts': dict([(k, v - startCounts.get(k, 0)) for k, v in
+                                           _PROFILE_COUNTERS.iteritems()])}
+            stageReport.update(sampler.getReport())
+            stageReports.append(stageReport)
+
+            self._stageFingerprints[stageName] = fingerprint
+
+            if stageName == lastStage:
+                break
+
+        self.processingReport = {'stages': stageReports, 'totalDuration': time.time() - totalStartTime}
+
+        # outputs of stages not run this time are not valid any more if their fingerprints changed
+        for stageName, _, _, outputs in PROCESSING_STAGES:
+            if stageName in self._stageFingerprints:
+                continue
+            if oldFingerprints.get(stageName) == fingerprints[stageName]:
+                self._stageFingerprints[stageName] = fingerprints[stageName]
+            else:
+                for output in outputs:
+                    try:
+                        delattr(self, output)
+                    except AttributeError:
+                        pass
+
+        # manually marked patches are not valid any more if final patches changed
+        if oldFingerprints.get(PROCESSING_STAGES[-1][0]) != fingerprints[PROCESSING_STAGES[-1][0]]:
+            try:
+                del self.finalPatchesMarked
+            except AttributeError:
+                pass
+
+        return computedStages
+
+    def _copy(self):
+        """
+        shallow copy of this trial with its own attribute dictionary, parameters and set of not loaded hdf5 keys.
+        Processing the copy replaces its attributes but does not change this trial
+        """
+
+        trial = copy.copy(self)
+        trial.params = dict(self.params)
+        if '_lazyKeys' in self.__dict__:
+            trial._lazyKeys = set(self._lazyKeys)
+        return trial
+
+    def sweepParams(self, paramGrid, processNum=None, pixelSize=0.0129, isVerbose=True):
+        """
+        process this trial with every combination of the parameters in paramGrid. The stages upstream of all swept
+        parameters are computed only once, combinations sharing the same upstream stages are processed incrementally
+        in the same worker process, so only the stages downstream of a changed parameter are recomputed.
+
+        :param paramGrid: dictionary, {parameter name: list of values}, parameters not in paramGrid will be taken
+                          from self.params
+        :param processNum: number of worker processes, if None, use the number of cpus. if 1, process in current
+                           process
+        :param pixelSize: cortical pixel size, mm
+        :param isVerbose: if True, print progress
+        :return: list of dictionaries, one for each parameter combination (in the order of itertools.product over
+                 sorted parameter names), with swept parameter values and:
+                 'patchNum': number of final patches
+                 'totalArea': summed cortical area of final patches, mm^2
+                 'meanArea': mean cortical area of final patches, mm^2
+                 'coverage': visual space covered by all final patches, deg^2
+                 'duration': processing time of this combination, second
+        """
+
+        paramNames = sorted(paramGrid.keys())
+        paramCombinations = [dict(zip(paramNames, values)) for values in product(*[paramGrid[n] for n in paramNames])]
+        originalParams = dict(self.params)
+
+        # process a copy so that the maps, patches and fingerprints of this trial are not changed by the sweep
+        sweepTrial = self._copy()
+
+        # fingerprints of every stage for every combination
+        stageNames = [stage[0] for stage in PROCESSING_STAGES]
+        stageFingerprints = []
+        for combination in paramCombinations:
+            sweepTrial.params = dict(originalParams)
+            sweepTrial.params.update(combination)
+            fingerprints = sweepTrial.getStageFingerprints()
+            stageFingerprints.append(tuple([fingerprints[n] for n in stageNames]))
+
+        # the first stage affected by swept parameters
+        firstSweptInd = len(stageNames) - 1
+        for ind in range(len(stageNames)):
+            if len(set([f[ind] for f in stageFingerprints])) > 1:
+                firstSweptInd = ind
+                break
+
+        # compute shared upstream stages only once
+        sweepTrial.params = dict(originalParams)
+        sweepTrial.params.update(paramCombinations[0])
+        if firstSweptInd > 0:
+            sweepTrial.processTrial(isIncremental=True, lastStage=stageNames[firstSweptInd - 1])
+
+        # group combinations sharing the first swept stage, sort each group to maximize reuse
+        groups = {}
+        for ind, fingerprints in enumerate(stageFingerprints):
+            groups.setdefault(fingerprints[firstSweptInd], []).append(ind)
+        groups = [sorted(group, key=lambda i: stageFingerprints[i]) for group in groups.values()]
+
+        argsList = []
+        for group in groups:
+            groupParams = []
+            for ind in group:
+                currParams = dict(originalParams)
+                currParams.update(paramCombinations[ind])
+                groupParams.append((ind, currParams))
+            argsList.append((sweepTrial, groupParams, pixelSize))
+
+        if processNum is None:
+            processNum = multiprocessing.cpu_count()
+
+        results = {}
+        if processNum == 1 or len(argsList) == 1:
+            for args in argsList:
+                results.update(_sweepParamsWorker(args))
+                if isVerbose:
+                    print 'sweepParams: ' + str(len(results)) + '/' + str(len(paramCombinations)) + ' combinations.'
+        else:
+            pool = multiprocessing.Pool(processes=min(processNum, len(argsList)))
+            try:
+                for groupResults in pool.imap_unordered(_sweepParamsWorker, argsList):
+                    results.update(groupResults)
+                    if isVerbose:
+                        print 'sweepParams: ' + str(len(results)) + '/' + str(len(paramCombinations)) + \
+                              ' combinations.'
+            finally:
+                pool.terminate()
+                pool.join()
+
+        table = []
+        for ind, combination in enumerate(paramCombinations):
+            row = dict(combination)
+            row.update(results[ind])
+            table.append(row)
+
+        return table
 
     def generateTrialDict(self,
                           keysToRetain=('altPosMap', 'aziPosMap', 'altPowerMap', 'aziPowerMap', 'params',
                                         'vasculatureMap', 'mouseID', 'dateRecorded', 'comments', 'signMap',
                                         'altPosMapf', 'aziPosMapf', 'altPowerMapf', 'aziPowerMapf', 'signMapf',
-                                        'rawPatchMap', 'eccentricityMapf', 'finalPatches', 'finalPatchesMarked')
+                                        'rawPatchMap', 'eccentricityMapf', 'finalPatches', 'finalPatchesMarked',
+                                        'processingReport'),
+                          isPatchRLE=False
                           ):
+        """
+        :param isPatchRLE: if True, finalPatches and finalPatchesMarked are saved as run-length encoded patch
+                           dictionaries (see Patch.getDict), which can only be read by Patch.fromDict, otherwise as
+                           'sparseArray' dictionaries readable by older versions
+        """
 
         trialDict = {}
         keysLeft = list(keysToRetain)
 
-        for key in self.__dict__.iterkeys():
+        # load retained attributes that are still in the hdf5 file
+        for key in keysToRetain:
+            if key in self.__dict__.get('_lazyKeys', ()):
+                getattr(self, key)
+
+        for key in self.__dict__.keys():
 
             if key in keysToRetain:
                 if key == 'finalPatches':
                     finalPatches = {}
                     for area, patch in self.finalPatches.iteritems():
-                        finalPatches.update({area: getPatchDict(patch)})
+                        finalPatches.update({area: getPatchDict(patch, isRLE=isPatchRLE)})
                     trialDict.update({'finalPatches': finalPatches})
                     keysLeft.remove('finalPatches')
 
-                elif key == 'finalPathcesMarked':
+                elif key == 'finalPatchesMarked':
                     finalPatchesMarked = {}
-                    for area, patch in self.finalPathcesMarked.iteritems():
-                        finalPatchesMarked.update({area: getPatchDict(patch)})
+                    for area, patch in self.finalPatchesMarked.iteritems():
+                        finalPatchesMarked.update({area: getPatchDict(patch, isRLE=isPatchRLE)})
                     trialDict.update({'finalPatchesMarked': finalPatchesMarked})
                     keysLeft.remove('finalPatchesMarked')
 
@@ -1698,31 +2881,28 @@ class RetinotopicMappingTrial(object):
         signMap = self.signMap
         signMapf = self.signMapf
 
-        altPosMapC = ia.center_image(self.altPosMap, centerPixel=centerPixel, newSize=mapSize, borderValue=borderValue)
-        altPosMapNor = ia.rotate_image(altPosMapC, rotationAngle, borderValue=borderValue)
-
-        aziPosMapC = ia.center_image(self.aziPosMap, centerPixel=centerPixel, newSize=mapSize, borderValue=borderValue)
-        aziPosMapNor = ia.rotate_image(aziPosMapC, rotationAngle, borderValue=borderValue)
-
-        if hasattr(self, 'altPowerMap') and self.altPowerMap is not None:
-            altPowerMapC = ia.center_image(self.altPowerMap, centerPixel=centerPixel, newSize=mapSize,
-                                           borderValue=borderValue)
-            altPowerMapNor = ia.rotate_image(altPowerMapC, rotationAngle, borderValue=borderValue)
-        else:
-            altPowerMapNor = None
-
-        if hasattr(self, 'aziPowerMap') and self.aziPowerMap is not None:
-            aziPowerMapC = ia.center_image(self.aziPowerMap, centerPixel=centerPixel, newSize=mapSize,
-                                           borderValue=borderValue)
-            aziPowerMapNor = ia.rotate_image(aziPowerMapC, rotationAngle, borderValue=borderValue)
-        else:
-            aziPowerMapNor = None
-
-        signMapC = ia.center_image(signMap, centerPixel=centerPixel, newSize=mapSize, borderValue=borderValue)
-        signMapNor = ia.rotate_image(signMapC, rotationAngle, borderValue=borderValue)
-
-        signMapfC = ia.center_image(signMapf, centerPixel=centerPixel, newSize=mapSize, borderValue=borderValue)
-        signMapfNor = ia.rotate_image(signMapfC, rotationAngle, borderValue=borderValue)
+        maps = [self.altPosMap, self.aziPosMap, signMap, signMapf]
+        for powerMapName in ['altPowerMap', 'aziPowerMap']:
+            if hasattr(self, powerMapName) and getattr(self, powerMapName) is not None:
+                maps.append(getattr(self, powerMapName))
+            else:
+                maps.append(None)
+
+        # integer maps (e.g. sign maps) are warped with nearest neighbour interpolation, so that casting back to
+        # their data type does not truncate interpolated values
+        norMaps = [None] * len(maps)
+        for interpolation in ['linear', 'nearest']:
+            mapInds = [i for i, m in enumerate(maps) if m is not None and
+                       (interpolation == 'nearest') == (np.issubdtype(m.dtype, np.integer) or m.dtype == np.bool)]
+            if not mapInds:
+                continue
+            mapsNor = ia.center_rotate_image_stack([maps[i] for i in mapInds], centerPixel, rotationAngle,
+                                                   newSize=mapSize, borderValue=borderValue,
+                                                   interpolation=interpolation)
+            for i, mapNor in zip(mapInds, mapsNor):
+                norMaps[i] = mapNor.astype(maps[i].dtype)
+
+        altPosMapNor, aziPosMapNor, signMapNor, signMapfNor, altPowerMapNor, aziPowerMapNor = norMaps
 
         if isPlot:
             trialName = self.getName()
@@ -1812,21 +2992,21 @@ class RetinotopicMappingTrial(object):
         centerPixel = centerPixel * zoom
 
         try:
-            vasMapNor = ia.center_image(vasMap, centerPixel=centerPixel, newSize=mapSize, borderValue=borderValue)
-            vasMapNor = ia.rotate_image(vasMapNor, rotationAngle, borderValue=borderValue)
+            vasMapNor = ia.center_rotate_image_stack(vasMap[None, :, :], centerPixel, rotationAngle,
+                                                     newSize=mapSize, borderValue=borderValue)[0]
         except NameError:
             pass
 
         patchesNor = {}
-        for key, patch in patches.iteritems():
-            patchArray = patch.array.astype(np.float)
-            patchArrayNor = ni.zoom(patchArray, zoom=zoom)
-            patchArrayNor = ia.center_image(patchArrayNor, centerPixel=centerPixel, newSize=mapSize,
-                                            borderValue=borderValue)
-            patchArrayNor = ia.rotate_image(patchArrayNor, rotationAngle, borderValue=borderValue)
-            patchArrayNor = np.round(patchArrayNor).astype(np.int8)
-            newPatch = Patch(patchArrayNor, patch.sign)
-            patchesNor.update({key: newPatch})
+        keys = list(patches.keys())
+        if keys:
+            patchStack = np.array([ni.zoom(patches[key].array.astype(np.float), zoom=zoom) for key in keys])
+            patchStackNor = ia.center_rotate_image_stack(patchStack, centerPixel, rotationAngle, newSize=mapSize,
+                                                         borderValue=borderValue)
+            for key, patchArrayNor in zip(keys, patchStackNor):
+                patchArrayNor = np.round(patchArrayNor).astype(np.int8)
+                newPatch = Patch(patchArrayNor, patches[key].sign)
+                patchesNor.update({key: newPatch})
 
         if isPlot:
             f = plt.figure(figsize=(12, 5))
@@ -2330,12 +3510,10 @@ class RetinotopicMappingTrial(object):
         except AttributeError:
             finalPatches = self.finalPatches
 
-        # get mean power amplitude for all visual areas normalized by V1
         areaDict = {}
         for key, patch in finalPatches.iteritems():
-            area = patch.getArea().astype(np.float) * (pixelSize ** 2)
-
-            areaDict.update({key: area})
+            # sparseArray of Patch has no duplicate or zero entries, nnz is the pixel number
+            areaDict.update({key: patch.sparseArray.nnz * (pixelSize ** 2)})
 
         return areaDict
 
@@ -2348,7 +3526,7 @@ class RetinotopicMappingTrial(object):
         if not hasattr(self, 'determinantMap'):
             _ = self._getDeterminantMap()
 
-        if hasattr(self, 'finalPathesMarked'):
+        if hasattr(self, 'finalPatchesMarked'):
             finalPatches = self.finalPatchesMarked
         elif hasattr(self, 'finalPatches'):
             finalPatches = self.finalPatches
@@ -2361,21 +3539,22 @@ class RetinotopicMappingTrial(object):
         if isFilter:
             magMap = ni.filters.gaussian_filter(magMap, self.params['signMapFilterSigma'])
 
-        # get mean power amplitude for all visual areas normalized by V1
-        magDict = {}
-        for key, patch in finalPatches.iteritems():
-            array = patch.array.astype(np.float)
+        if not finalPatches:
+            return {}
 
-            if erodeIter:
-                array = ni.binary_erosion(array, iterations=erodeIter)
+        labelMap, keys = getLabelMap(finalPatches)
+        if erodeIter:
+            labelMap = erodeLabelMap(labelMap, iterations=erodeIter)
 
-            area = np.sum(array)
+        isPatch = labelMap > 0
+        labels = labelMap[isPatch]
+        areas = np.bincount(labels, minlength=len(keys) + 1).astype(np.float64)
+        totalMags = np.bincount(labels, weights=magMap[isPatch], minlength=len(keys) + 1)
 
-            totalMag = np.sum(array * magMap)
+        with np.errstate(invalid='ignore', divide='ignore'):
+            magnifications = (pixelSize ** 2) * totalMags / areas
 
-            magDict.update({key: (pixelSize ** 2) * totalMag / area})
-
-        return magDict
+        return {key: magnifications[i + 1] for i, key in enumerate(keys)}
 
     def getVisualFieldOrigin(self):
         """
@@ -2668,7 +3847,11 @@ class Patch(object):
     def __init__(self, patchArray, sign):
 
         if isinstance(patchArray, sparse.coo_matrix):
-            self.sparseArray = patchArray.astype(np.uint8)
+            # one stored entry per pixel, so that row, col and nnz of sparseArray count every pixel once
+            arr = patchArray.copy()
+            arr.sum_duplicates()
+            arr.eliminate_zeros()
+            self.sparseArray = arr.astype(np.uint8)
         else:
             arr = patchArray.astype(np.int8)
             arr[arr > 0] = 1
@@ -2715,8 +3898,37 @@ class Patch(object):
         signedMask[signedMask == 0] = np.nan
         return signedMask
 
-    def getDict(self):
-        return {'sparseArray': self.sparseArray, 'sign': self.sign}
+    def getDict(self, isRLE=False):
+        """
+        dictionary of the patch, {'sparseArray', 'sign'}. if isRLE is True, compact dictionary
+        {'rleStarts', 'rleLengths', 'shape', 'sign'}, the mask is run-length encoded along the flattened frame
+        (see ImageAnalysis.pixels_to_rle). Only Patch.fromDict reads the run-length encoded format
+        """
+        if not isRLE:
+            return {'sparseArray': self.sparseArray, 'sign': self.sign}
+        rleStarts, rleLengths = ia.pixels_to_rle((self.sparseArray.row, self.sparseArray.col), self.sparseArray.shape)
+        return {'rleStarts': rleStarts, 'rleLengths': rleLengths, 'shape': self.sparseArray.shape, 'sign': self.sign}
+
+    @staticmethod
+    def fromDict(patchDict):
+        """
+        generate Patch from a patch dictionary, either run-length encoded (see getDict), or with full 'array' or
+        'sparseArray' (older formats), or with 'row' and 'col' of its pixels
+        """
+
+        if 'rleStarts' in patchDict:
+            shape = tuple(patchDict['shape'])
+            rows, cols = ia.rle_to_pixels(patchDict['rleStarts'], patchDict['rleLengths'], shape)
+            patchArray = sparse.coo_matrix((np.ones(len(rows), dtype=np.uint8), (rows, cols)), shape=shape)
+        elif 'array' in patchDict:
+            patchArray = patchDict['array']
+        elif 'sparseArray' in patchDict:
+            patchArray = patchDict['sparseArray']
+        else:
+            patchArray = sparse.coo_matrix((np.ones(len(patchDict['row']), dtype=np.uint8),
+                                            (patchDict['row'], patchDict['col'])), shape=tuple(patchDict['shape']))
+
+        return Patch(patchArray, patchDict['sign'])
 
     def getTrace(self, mov):
         """
@@ -2749,6 +3961,8 @@ class Patch(object):
         #        altRange = np.array([np.amin(altMap)-10., np.amax(altMap)+10.])
         #        aziRange = np.array([np.amin(aziMap)-10., np.amax(aziMap)+10.])
 
+        _countProfile('getVisualSpace')
+
         pixelSize = np.float(pixelSize)
 
         altRange = np.array([-40., 60.])
@@ -2797,7 +4011,7 @@ class Patch(object):
         """
         calculate sigma area for the patch given altitude and azimuth maps
         """
-        sigmaArea = np.sum((self.array * detMap)[:])
+        sigmaArea = np.sum(detMap[self.sparseArray.row, self.sparseArray.col])
         return sigmaArea
 
     def getPixelVisualCenter(self, altMap, aziMap):
@@ -2823,39 +4037,23 @@ class Patch(object):
         eccentricity map is returned in degree
         """
 
-        altMap2 = altMap * np.pi / 180
-        aziMap2 = aziMap * np.pi / 180
-
-        altCenter2 = altCenter * np.pi / 180
-        aziCenter2 = aziCenter * np.pi / 180
-
-        eccMap = np.zeros(self.array.shape)
-        #        eccMap[:] = np.nan
-        #        for i in xrange(self.array.shape[0]):
-        #            for j in xrange(self.array.shape[1]):
-        #                if self.array[i,j]:
-        #                    alt = altMap2[i,j]
-        #                    azi = aziMap2[i,j]
-        #                    eccMap[i,j] = np.arctan(np.sqrt(np.tan(alt-altCenter2)**2 + ((np.tan(azi-aziCenter2)**2)/(np.cos(alt-altCenter2)**2))))
-        eccMap = np.arctan(
-            np.sqrt(
-                np.square(np.tan(altMap2 - altCenter2))
-                +
-                np.square(np.tan(aziMap2 - aziCenter2)) / np.square(np.cos(altMap2 - altCenter2))
-            )
-        )
-        eccMap = eccMap * 180 / np.pi
-        eccMap[self.array == 0] = np.nan
+        rows, cols = self.sparseArray.row, self.sparseArray.col
+
+        eccMap = np.zeros(self.sparseArray.shape)
+        eccMap[:] = np.nan
+        eccMap[rows, cols] = eccentricityMap(altMap[rows, cols], aziMap[rows, cols], altCenter, aziCenter)
         return eccMap
 
-    def split2(self, eccMap, patchName='patch00', cutStep=1, borderWidth=2, isplot=False):
+    def split2(self, eccMap, patchName='patch00', cutStep=1, borderWidth=2, isplot=False, minMarker=None):
         """
         split this patch into two or more patch, according to the eccentricity
         map (in degree). return a dictionary of patches after split
 
         patchName: str, original patch name
+        minMarker: labeled local minima of eccMap (localMin(eccMap, cutStep)), if None, computed here
         """
-        minMarker = localMin(eccMap, cutStep)
+        if minMarker is None:
+            minMarker = localMin(eccMap, cutStep)
 
         connectivity = np.array([[1, 1, 1], [1, 1, 1], [1, 1, 1]])
 
@@ -2906,6 +4104,63 @@ class Patch(object):
 
         return newPatchDict
 
+    def getBoundingBox(self, margin=0):
+        """
+        return the bounding box of the patch, expanded by margin and clipped by the frame,
+        (rowStart, rowEnd, colStart, colEnd)
+        """
+        rows, cols = self.sparseArray.row, self.sparseArray.col
+        frameShape = self.sparseArray.shape
+        return (max(int(np.amin(rows)) - margin, 0), min(int(np.amax(rows)) + 1 + margin, frameShape[0]),
+                max(int(np.amin(cols)) - margin, 0), min(int(np.amax(cols)) + 1 + margin, frameShape[1]))
+
+    def splitLocal(self, eccMap, patchName='patch00', cutStep=1, borderWidth=2, isplot=False, offset=(0, 0),
+                   minMarker=None):
+        """
+        same as split2, but local minima, watershed and borders are computed only in the bounding box of the patch
+        (with a margin wide enough to hold the dilated borders), then the new patches are put back into the full
+        frame. eccMap is the eccentricity map (in degree) and should be nan outside the patch.
+        return a dictionary of patches after split
+
+        patchName: str, original patch name
+        offset: (row, col) of the first pixel of eccMap in the full frame, eccMap can be the full frame map (offset
+                (0, 0)) or any crop of it containing the bounding box getBoundingBox(margin=borderWidth + 2)
+        minMarker: labeled local minima of the eccMap crop in this bounding box, if None, computed by split2
+        """
+
+        rowStart, rowEnd, colStart, colEnd = self.getBoundingBox(margin=borderWidth + 2)
+
+        cropArray = np.zeros((rowEnd - rowStart, colEnd - colStart), dtype=np.int8)
+        cropArray[self.sparseArray.row - rowStart, self.sparseArray.col - colStart] = 1
+        cropEccMap = np.array(eccMap[rowStart - offset[0]:rowEnd - offset[0], colStart - offset[1]:colEnd - offset[1]],
+                              dtype=np.float64)
+        if cropEccMap.shape != cropArray.shape:
+            raise ValueError, 'eccMap does not contain the bounding box of the patch!'
+
+        cropPatchDict = Patch(cropArray, self.sign).split2(cropEccMap, patchName=patchName, cutStep=cutStep,
+                                                           borderWidth=borderWidth, minMarker=minMarker)
+
+        newPatchDict = {}
+        for currPatchName, cropPatch in cropPatchDict.iteritems():
+            currSparse = cropPatch.sparseArray
+            currArray = sparse.coo_matrix((currSparse.data, (currSparse.row + rowStart, currSparse.col + colStart)),
+                                          shape=self.sparseArray.shape)
+            newPatchDict.update({currPatchName: Patch(currArray, self.sign)})
+
+        if isplot:
+            labeledNewPatchMap = np.zeros(self.sparseArray.shape, dtype=np.int)
+            for i, currPatch in enumerate(newPatchDict.values()):
+                labeledNewPatchMap[currPatch.sparseArray.row, currPatch.sparseArray.col] = i + 1
+            plt.figure()
+            plt.subplot(121)
+            plt.imshow(self.array, interpolation='nearest')
+            plt.title(patchName + ': before split')
+            plt.subplot(122)
+            plt.imshow(labeledNewPatchMap, interpolation='nearest')
+            plt.title(patchName + ': after split')
+
+        return newPatchDict
+
     def split(self, eccMap, patchName='patch00', cutStep=1, borderWidth=2, isplot=False):
         """
         split this patch into two or more patch, according to the eccentricity
@@ -3024,6 +4279,348 @@ class Patch(object):
         return cor
 
 
+class NormalizedAtlas(object):
+    """
+    streaming aggregator of normalized trials (outputs of RetinotopicMappingTrial.normalize) for population atlases.
+    Instead of stacking all normalized images, it keeps running mean and variance (Welford's algorithm), a
+    per-pixel histogram for approximate median and per-pixel counts of each named patch, so the memory does not grow
+    with the number of trials.
+
+    The histogram takes histBinNum x height x width counts, 2 bytes each (uint16) up to 65535 images, then 4 bytes
+    (uint32), e.g. 82 MB for 64 bins at 800 x 800 pixels. Use histBinNum=None if only mean and standard deviation
+    are needed. Each patch count map takes 2 bytes per pixel, 4 bytes after 65535 patch dictionaries.
+    """
+
+    def __init__(self, histRange=(0., 1.), histBinNum=64, isNormalize=True):
+        """
+        :param histRange: value range of the per-pixel histogram, values out of range are counted in the edge bins
+        :param histBinNum: number of histogram bins for the median, if None, the histogram is not allocated and median
+                           will not be available
+        :param isNormalize: if True, each image is normalized to [0, 1] (ia.array_nor) before aggregation, same as
+                            PlottingTools.merge_normalized_images
+        """
+
+        self.histRange = histRange
+        self.histBinNum = histBinNum
+        self.isNormalize = isNormalize
+
+        self.shape = None
+        self.imageNum = 0
+        self.patchDictNum = 0
+        self.mean = None
+        self._m2 = None
+        self._hist = None
+        self.patchCounts = {}
+
+    def _checkShape(self, shape):
+
+        if self.shape is None:
+            self.shape = tuple(shape)
+            self.mean = np.zeros(self.shape, dtype=np.float64)
+            self._m2 = np.zeros(self.shape, dtype=np.float64)
+            if self.histBinNum is not None:
+                self._hist = np.zeros((self.histBinNum,) + self.shape, dtype=np.uint16)
+        elif tuple(shape) != self.shape:
+            raise ValueError, 'shape of input ' + str(tuple(shape)) + ' does not match the atlas ' + str(self.shape) + '!'
+
+    @staticmethod
+    def _widenCounts(counts, num):
+        """
+        return counts with an unsigned integer type large enough to count up to num
+        """
+        if num > np.iinfo(counts.dtype).max:
+            return counts.astype(np.uint64 if num > np.iinfo(np.uint32).max else np.uint32)
+        return counts
+
+    def addImage(self, img):
+        """
+        add one normalized image into running mean, variance and histogram
+        """
+
+        img = np.array(img, dtype=np.float64)
+        if self.isNormalize:
+            img = ia.array_nor(img)
+
+        self._checkShape(img.shape)
+
+        self.imageNum += 1
+        delta = img - self.mean
+        self.mean += delta / self.imageNum
+        self._m2 += delta * (img - self.mean)
+
+        if self._hist is not None:
+            self._hist = self._widenCounts(self._hist, self.imageNum)
+            binInd = np.floor((img - self.histRange[0]) / (self.histRange[1] - self.histRange[0]) * self.histBinNum)
+            binInd = np.clip(binInd, 0, self.histBinNum - 1).astype(np.intp)
+            self._hist.reshape((self.histBinNum, -1))[binInd.ravel(), np.arange(binInd.size)] += 1
+
+    def addPatches(self, patches):
+        """
+        add one normalized patch dictionary into per-pixel patch counts
+
+        :param patches: dictionary {patchName: Patch}
+        """
+
+        for key, patch in patches.iteritems():
+            self._checkShape(patch.sparseArray.shape)
+            if key not in self.patchCounts:
+                self.patchCounts[key] = np.zeros(self.shape, dtype=np.uint16)
+            self.patchCounts[key] = self._widenCounts(self.patchCounts[key], self.patchDictNum + 1)
+            self.patchCounts[key][patch.sparseArray.row, patch.sparseArray.col] += 1
+
+        self.patchDictNum += 1
+
+    def addTrial(self, trial, centerPatchKey='patch01', mapSize=800, borderValue=0.):
+        """
+        normalize a RetinotopicMappingTrial (with RetinotopicMappingTrial.normalize) and add its vasculature map and
+        patches into the atlas
+        """
+
+        vasMapNor, patchesNor = trial.normalize(centerPatchKey=centerPatchKey, mapSize=mapSize, isPlot=False,
+                                                borderValue=borderValue)
+        self.addImage(vasMapNor)
+        self.addPatches(patchesNor)
+
+    def getVariance(self, ddof=0):
+        """
+        per-pixel variance of added images
+        """
+        if self.imageNum - ddof <= 0:
+            raise ValueError, 'not enough images to calculate variance!'
+        return self._m2 / (self.imageNum - ddof)
+
+    def getStd(self, ddof=0):
+        """
+        per-pixel standard deviation of added images
+        """
+        return np.sqrt(self.getVariance(ddof=ddof))
+
+    def getMedian(self):
+        """
+        approximate per-pixel median of added images, center of the histogram bin containing the median
+        """
+
+        if self._hist is None:
+            raise LookupError, 'histogram is not available, histBinNum is None!'
+        if self.imageNum == 0:
+            raise ValueError, 'no image added!'
+
+        medianBin = np.argmax(np.cumsum(self._hist, axis=0) >= self.imageNum / 2., axis=0)
+        binWidth = float(self.histRange[1] - self.histRange[0]) / self.histBinNum
+        return self.histRange[0] + (medianBin + 0.5) * binWidth
+
+    def getPatchProbabilityMaps(self):
+        """
+        per-pixel probability of each named patch across added patch dictionaries (trials)
+
+        :return: dictionary {patchName: 2d array, np.float64}
+        """
+
+        return {key: value.astype(np.float64) / self.patchDictNum for key, value in self.patchCounts.iteritems()}
+
+    def save(self, saveFolder, prefix='atlas'):
+        """
+        save mean, standard deviation, median (if available) and probability map of each named patch as float32
+        tif files into saveFolder, named as: prefix_mean.tif, prefix_std.tif, prefix_median.tif,
+        prefix_probability_<patchName>.tif
+        """
+
+        if not os.path.isdir(saveFolder):
+            os.makedirs(saveFolder)
+
+        tf.imsave(os.path.join(saveFolder, prefix + '_mean.tif'), self.mean.astype(np.float32))
+        tf.imsave(os.path.join(saveFolder, prefix + '_std.tif'), self.getStd().astype(np.float32))
+        if self._hist is not None:
+            tf.imsave(os.path.join(saveFolder, prefix + '_median.tif'), self.getMedian().astype(np.float32))
+
+        for key, value in self.getPatchProbabilityMaps().iteritems():
+            tf.imsave(os.path.join(saveFolder, prefix + '_probability_' + key + '.tif'), value.astype(np.float32))
+
+
+class TrialSummaryIndex(object):
+    """
+    persistent SQLite index of per-patch summaries of processed trials for fast cross-trial queries. The index is
+    updated incrementally, a trial file is only loaded again if its modification time changed.
+
+    tables:
+        trials: trialPath (primary key), mtime, trialName, mouseID, dateRecorded, patchNum
+        patches: trialPath, patchName, sign, area (pixel number), corticalArea (mm^2), centerRow, centerCol
+                 (cortical pixel), visualCoverage (unique visual space area, deg^2), visualAltCenter,
+                 visualAziCenter (deg), magnification (mm^2/deg^2)
+    """
+
+    def __init__(self, dbPath, pixelSize=0.0129, visualSpacePixelSize=1., visualSpaceCloseIter=None):
+        """
+        :param dbPath: path of the SQLite database file, created if not exist
+        :param pixelSize: cortical pixel size, mm
+        :param visualSpacePixelSize: pixel size of the visual space for visual coverage, deg
+        :param visualSpaceCloseIter: closing iteration of the visual space for visual coverage, if None, use
+                                     'visualSpaceCloseIter' in the parameters of each trial
+        """
+
+        self.dbPath = dbPath
+        self.pixelSize = pixelSize
+        self.visualSpacePixelSize = visualSpacePixelSize
+        self.visualSpaceCloseIter = visualSpaceCloseIter
+
+        with self._connect() as conn:
+            conn.execute('CREATE TABLE IF NOT EXISTS trials (trialPath TEXT PRIMARY KEY, mtime REAL, '
+                         'trialName TEXT, mouseID TEXT, dateRecorded INTEGER, patchNum INTEGER)')
+            conn.execute('CREATE TABLE IF NOT EXISTS patches (trialPath TEXT, patchName TEXT, sign INTEGER, '
+                         'area INTEGER, corticalArea REAL, centerRow INTEGER, centerCol INTEGER, '
+                         'visualCoverage REAL, visualAltCenter REAL, visualAziCenter REAL, magnification REAL)')
+            conn.execute('CREATE INDEX IF NOT EXISTS patchesByName ON patches (patchName)')
+            conn.execute('CREATE INDEX IF NOT EXISTS patchesByTrial ON patches (trialPath)')
+
+    @contextmanager
+    def _connect(self):
+        """
+        connection to the database, committed (or rolled back on error) and closed on exit
+        """
+        conn = sqlite3.connect(self.dbPath)
+        conn.row_factory = sqlite3.Row
+        try:
+            with conn:
+                yield conn
+        finally:
+            conn.close()
+
+    def getTrialSummary(self, trial):
+        """
+        generate per-patch summaries of a processed trial (finalPatchesMarked if exist, otherwise finalPatches)
+
+        :return: list of dictionaries, one for each patch, with the columns of the 'patches' table (except
+                 trialPath)
+        """
+
+        if hasattr(trial, 'finalPatchesMarked'):
+            patches = trial.finalPatchesMarked
+        elif hasattr(trial, 'finalPatches'):
+            patches = trial.finalPatches
+        else:
+            raise LookupError, 'trial ' + trial.getName() + ' is not processed!'
+
+        if not hasattr(trial, 'altPosMapf') or not hasattr(trial, 'aziPosMapf'):
+            trial._getSignMap()
+        if not hasattr(trial, 'determinantMap'):
+            trial._getDeterminantMap()
+
+        closeIter = self.visualSpaceCloseIter
+        if closeIter is None:
+            closeIter = trial.params['visualSpaceCloseIter']
+
+        measurements = getPatchMeasurements(patches, trial.determinantMap, pixelSize=self.pixelSize)
+
+        summary = []
+        for key, patch in sorted(patches.items()):
+            _, uniqueArea, altCenter, aziCenter = patch.getVisualSpace(trial.altPosMapf, trial.aziPosMapf,
+                                                                       pixelSize=self.visualSpacePixelSize,
+                                                                       closeIter=closeIter)
+            center = patch.getCenter()
+            summary.append({'patchName': key,
+                            'sign': patch.sign,
+                            'area': int(measurements[key]['area']),
+                            'corticalArea': float(measurements[key]['corticalArea']),
+                            'centerRow': int(center[0]),
+                            'centerCol': int(center[1]),
+                            'visualCoverage': float(uniqueArea),
+                            'visualAltCenter': float(altCenter),
+                            'visualAziCenter': float(aziCenter),
+                            'magnification': float(measurements[key]['magnification'])})
+
+        return summary
+
+    def update(self, trialPaths, isPruned=False, isVerbose=True, isSkipError=True):
+        """
+        index trial files whose modification time changed since they were last indexed (or not indexed yet)
+
+        :param trialPaths: list of trial file paths, same as the input of loadTrial
+        :param isPruned: if True, remove indexed trials that are not in trialPaths or do not exist any more
+        :param isVerbose: if True, print progress
+        :param isSkipError: if True, trials that can not be loaded or summarized (e.g. not processed) are skipped and
+                            reported in self.errors, {trial path: error}, the other trials are still indexed. if False,
+                            the error is raised
+        :return: list of trial paths (absolute) that were (re)indexed
+        """
+
+        trialPaths = [os.path.abspath(p) for p in trialPaths]
+        self.errors = {}
+
+        with self._connect() as conn:
+            indexedMtimes = {row['trialPath']: row['mtime'] for row in conn.execute('SELECT trialPath, mtime '
+                                                                                    'FROM trials')}
+
+        updatedPaths = []
+        for trialPath in trialPaths:
+            if not os.path.isfile(trialPath):
+                if isVerbose:
+                    print 'TrialSummaryIndex: can not find ' + trialPath + ', skip.'
+                continue
+
+            mtime = os.path.getmtime(trialPath)
+            if indexedMtimes.get(trialPath) == mtime:
+                continue
+
+            try:
+                trial = loadTrial(trialPath)
+                summary = self.getTrialSummary(trial)
+            except Exception:
+                if not isSkipError:
+                    raise
+                self.errors[trialPath] = traceback.format_exc().strip().split('\n')[-1]
+                if isVerbose:
+                    print 'TrialSummaryIndex: can not index ' + trialPath + ', skip. ' + self.errors[trialPath]
+                continue
+
+            with self._connect() as conn:
+                conn.execute('DELETE FROM patches WHERE trialPath = ?', (trialPath,))
+                conn.execute('INSERT OR REPLACE INTO trials VALUES (?, ?, ?, ?, ?, ?)',
+                             (trialPath, mtime, trial.getName(), str(trial.mouseID), trial.dateRecorded,
+                              len(summary)))
+                conn.executemany('INSERT INTO patches VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)',
+                                 [(trialPath, p['patchName'], p['sign'], p['area'], p['corticalArea'],
+                                   p['centerRow'], p['centerCol'], p['visualCoverage'], p['visualAltCenter'],
+                                   p['visualAziCenter'], p['magnification']) for p in summary])
+
+            updatedPaths.append(trialPath)
+            if isVerbose:
+                print 'TrialSummaryIndex: indexed ' + trialPath + ', ' + str(len(summary)) + ' patches.'
+
+        if isPruned:
+            with self._connect() as conn:
+                for trialPath in indexedMtimes.iterkeys():
+                    if trialPath not in trialPaths or not os.path.isfile(trialPath):
+                        conn.execute('DELETE FROM patches WHERE trialPath = ?', (trialPath,))
+                        conn.execute('DELETE FROM trials WHERE trialPath = ?', (trialPath,))
+
+        return updatedPaths
+
+    def query(self, sql, args=()):
+        """
+        run a SQL query on the index
+
+        :return: list of dictionaries, one for each row
+        """
+        with self._connect() as conn:
+            return [dict(row) for row in conn.execute(sql, args)]
+
+    def getPatchValues(self, patchName, column='corticalArea'):
+        """
+        value of one column of a named patch across all indexed trials
+
+        :return: list of (trialName, value), sorted by trial name
+        """
+
+        if column not in ('sign', 'area', 'corticalArea', 'centerRow', 'centerCol', 'visualCoverage',
+                          'visualAltCenter', 'visualAziCenter', 'magnification'):
+            raise LookupError, 'unknown column: ' + str(column) + '!'
+
+        rows = self.query('SELECT trials.trialName, patches.' + column + ' AS value FROM patches JOIN trials '
+                          'ON patches.trialPath = trials.trialPath WHERE patches.patchName = ? '
+                          'ORDER BY trials.trialName', (patchName,))
+        return [(row['trialName'], row['value']) for row in rows]
+
+
 if __name__ == "__main__":
     plt.ioff()
     print 'for debug ...'
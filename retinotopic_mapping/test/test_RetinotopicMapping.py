@@ -0,0 +1,532 @@
+import os
+import shutil
+import tempfile
+import unittest
+import numpy as np
+import matplotlib
+matplotlib.use('Agg')
+import retinotopic_mapping.RetinotopicMapping as rm
+import retinotopic_mapping.tools.FileTools as ft
+
+
+def get_synthetic_maps(size=80):
+    """
+    altitude decreases from top to bottom, azimuth is mirrored at the vertical midline, which generates two patches
+    with opposite visual signs
+    """
+    y, x = np.mgrid[0:size, 0:size].astype(np.float64)
+    altPosMap = 60. - y * 80. / size
+    aziPosMap = np.where(x < size / 2., x * 100. / size, (size - x) * 100. / size)
+    return altPosMap, aziPosMap
+
+
+class TestRetinotopicMapping(unittest.TestCase):
+
+    def setUp(self):
+        self.params = {'phaseMapFilterSigma': 1.,
+                       'signMapFilterSigma': 3.,
+                       'signMapThr': 0.3,
+                       'eccMapFilterSigma': 5.,
+                       'splitLocalMinCutStep': 5.,
+                       'mergeOverlapThr': 0.1,
+                       'closeIter': 3,
+                       'openIter': 3,
+                       'dilationIter': 5,
+                       'borderWidth': 1,
+                       'smallPatchThr': 20,
+                       'visualSpacePixelSize': 1.,
+                       'visualSpaceCloseIter': 3,
+                       'splitOverlapThr': 1.1}
+
+        self.altPosMap, self.aziPosMap = get_synthetic_maps()
+        self.tempFolder = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.tempFolder)
+
+    def _get_trial(self):
+        return rm.RetinotopicMappingTrial(altPosMap=self.altPosMap, aziPosMap=self.aziPosMap, altPowerMap=None,
+                                          aziPowerMap=None, vasculatureMap=None, mouseID='test',
+                                          dateRecorded=20160101, params=dict(self.params))
+
+    def _save_trial(self, fileName):
+        trial = self._get_trial()
+        trialPath = os.path.join(self.tempFolder, fileName)
+        ft.saveFile(trialPath, trial.generateTrialDict())
+        return trialPath
+
+    def test_processTrial(self):
+        trial = self._get_trial()
+        trial.processTrial()
+        assert (len(trial.finalPatches) == 2)
+        assert (sorted([p.sign for p in trial.finalPatches.values()]) == [-1, 1])
+
+    def test_batchProcessTrials(self):
+        trialPaths = [self._save_trial('trial1.pkl'), self._save_trial('trial2.pkl'),
+                      os.path.join(self.tempFolder, 'missing.pkl')]
+        saveFolder = os.path.join(self.tempFolder, 'processed')
+
+        summaries = rm.batchProcessTrials(trialPaths, params=self.params, saveFolder=saveFolder, processNum=2,
+                                          retryNum=1, isVerbose=False)
+
+        assert ([s['trialPath'] for s in summaries] == trialPaths)
+        assert ([s['status'] for s in summaries] == ['done', 'done', 'failed'])
+        assert ([s['patchNum'] for s in summaries] == [2, 2, 0])
+        assert (summaries[2]['attemptNum'] == 2)
+        assert (os.path.isfile(os.path.join(saveFolder, 'trial1.pkl')))
+        assert (os.path.isfile(os.path.join(saveFolder, 'batch_summary.txt')))
+        assert (len(rm.loadTrial(summaries[0]['savePath']).finalPatches) == 2)
+
+        with self.assertRaises(RuntimeError):
+            rm.batchProcessTrials(trialPaths, processNum=1, isSkipError=False, isVerbose=False)
+
+        # trials with the same file name would overwrite each other in saveFolder
+        os.makedirs(os.path.join(self.tempFolder, 'other'))
+        otherPath = os.path.join(self.tempFolder, 'other', 'trial1.pkl')
+        shutil.copy(trialPaths[0], otherPath)
+        with self.assertRaises(ValueError):
+            rm.batchProcessTrials([trialPaths[0], otherPath], saveFolder=saveFolder, processNum=1, isVerbose=False)
+        with self.assertRaises(ValueError):
+            rm.batchProcessTrials([trialPaths[0], trialPaths[0]], processNum=1, isVerbose=False)
+        summaries = rm.batchProcessTrials([trialPaths[0], otherPath], processNum=1, isVerbose=False)
+        assert ([s['status'] for s in summaries] == ['done', 'done'])
+
+    def test_processTrial_incremental(self):
+        trial = self._get_trial()
+        computedStages = trial.processTrial()
+        assert (computedStages == [s[0] for s in rm.PROCESSING_STAGES])
+
+        assert (trial.processTrial(isIncremental=True) == [])
+
+        trial.params['mergeOverlapThr'] = 0.2
+        assert (trial.processTrial(isIncremental=True) == ['_mergePatches'])
+
+        trial.params['eccMapFilterSigma'] = 3.
+        assert (trial.processTrial(isIncremental=True) == ['_getEccentricityMap', '_splitPatches', '_mergePatches'])
+
+    def test_processTrial_checkpoint(self):
+        checkpointFolder = os.path.join(self.tempFolder, 'checkpoints')
+        trial = self._get_trial()
+        trial.processTrial(checkpointFolder=checkpointFolder)
+
+        trial2 = self._get_trial()
+        assert (trial2.processTrial(checkpointFolder=checkpointFolder) == [])
+        assert (sorted(trial2.finalPatches.keys()) == sorted(trial.finalPatches.keys()))
+        assert (np.array_equal(trial2.signMapf, trial.signMapf))
+
+        trial3 = self._get_trial()
+        trial3.params['signMapThr'] = 0.35
+        assert (trial3.processTrial(checkpointFolder=checkpointFolder) ==
+                ['_getRawPatchMap', '_getRawPatches', '_getEccentricityMap', '_splitPatches', '_mergePatches'])
+
+    def test_sweepParams(self):
+        trial = self._get_trial()
+        paramGrid = {'signMapThr': [0.3, 0.35], 'mergeOverlapThr': [0.1, 0.2]}
+        table = trial.sweepParams(paramGrid, processNum=2, isVerbose=False)
+
+        assert ([(r['mergeOverlapThr'], r['signMapThr']) for r in table] ==
+                [(0.1, 0.3), (0.1, 0.35), (0.2, 0.3), (0.2, 0.35)])
+        assert (all([r['patchNum'] == 2 for r in table]))
+        assert (all([r['coverage'] > 0 for r in table]))
+        assert (trial.params == self.params)
+
+        table2 = trial.sweepParams({'mergeOverlapThr': [0.1, 0.2]}, processNum=1, isVerbose=False)
+        assert (table2[0]['totalArea'] == table[0]['totalArea'])
+
+        # sweeping does not change a processed (and lazily loaded) trial
+        trial.processTrial()
+        trial.finalPatchesMarked = {'V1': trial.finalPatches.values()[0]}
+        h5Path = os.path.join(self.tempFolder, 'trial.h5')
+        trial.saveTrialH5(h5Path)
+        for isLazy in [False, True]:
+            trial2 = rm.loadTrial(h5Path, isLazy=isLazy)
+            keys = sorted(trial2.__dict__.keys())
+            lazyKeys = set(trial2.__dict__.get('_lazyKeys', ()))
+            trial2.sweepParams({'mergeOverlapThr': [0.1, 0.2], 'signMapThr': [0.3, 0.35]}, processNum=1,
+                               isVerbose=False)
+            assert (sorted(trial2.__dict__.keys()) == keys)
+            assert (set(trial2.__dict__.get('_lazyKeys', ())) == lazyKeys)
+            assert (trial2.params == self.params)
+            assert (np.array_equal(trial2.finalPatchesMarked['V1'].array, trial.finalPatchesMarked['V1'].array))
+
+    def test_labelEccentricityMaps(self):
+        trial = self._get_trial()
+        trial.processTrial(lastStage='_getRawPatches')
+        patches = trial.rawPatches
+        altMap = trial.altPosMapf
+        aziMap = trial.aziPosMapf
+
+        labelMap, keys = rm.getLabelMap(patches)
+        altCenters, aziCenters = rm.getPixelVisualCenters(altMap, aziMap, labelMap)
+        eccMap, eccMapf = rm.labelEccentricityMaps(altMap, aziMap, labelMap, altCenters, aziCenters, filterSize=5.)
+
+        for i, key in enumerate(keys):
+            patch = patches[key]
+            altC, aziC = patch.getPixelVisualCenter(altMap, aziMap)
+            assert (np.allclose([altCenters[i + 1], aziCenters[i + 1]], [altC, aziC]))
+
+            patchEccMap = rm.eccentricityMap(altMap, aziMap, altC, aziC)
+            patchEccMapf = rm.ni.filters.uniform_filter(patchEccMap, 5.)
+            isPatch = patch.array == 1
+            assert (np.allclose(eccMap[isPatch], patchEccMap[isPatch]))
+            assert (np.allclose(eccMapf[isPatch], patchEccMapf[isPatch]))
+            assert (np.allclose(patch.eccentricityMap(altMap, aziMap, altC, aziC)[isPatch], patchEccMap[isPatch]))
+
+        assert (np.all(np.isnan(eccMapf[labelMap == 0])))
+
+    def test_splitLocal(self):
+        y, x = np.mgrid[0:60, 0:80].astype(np.float64)
+        patchArray = np.zeros((60, 80), dtype=np.int8)
+        patchArray[20:41, 10:71] = 1
+        eccMap = np.minimum(np.hypot(y - 30, x - 25), np.hypot(y - 30, x - 55))
+        eccMap[patchArray == 0] = np.nan
+        patch = rm.Patch(patchArray, 1)
+
+        newPatches = patch.splitLocal(eccMap, patchName='patch01', cutStep=1, borderWidth=2)
+        newPatches2 = patch.split2(eccMap, patchName='patch01', cutStep=1, borderWidth=2)
+
+        newPatches3 = patch.splitLocal(eccMap[15:46, 5:76], patchName='patch01', cutStep=1, borderWidth=2,
+                                       offset=(15, 5))
+
+        assert (sorted(newPatches.keys()) == ['patch01.1', 'patch01.2'])
+        assert (sorted(newPatches.keys()) == sorted(newPatches2.keys()))
+        assert (sorted(newPatches.keys()) == sorted(newPatches3.keys()))
+        for key, value in newPatches.iteritems():
+            assert (np.array_equal(value.array, newPatches2[key].array))
+            assert (np.array_equal(value.array, newPatches3[key].array))
+
+        with self.assertRaises(ValueError):
+            patch.splitLocal(eccMap[20:41, 10:71], offset=(20, 10))
+
+    def test_splitPatches_processNum(self):
+        trial = self._get_trial()
+        trial.params['splitOverlapThr'] = 0.
+        trial.processTrial(lastStage='_getEccentricityMap')
+        patches = trial._splitPatches(processNum=1)
+        patches2 = trial._splitPatches(processNum=2)
+        assert (sorted(patches.keys()) == sorted(patches2.keys()))
+        for key, value in patches.iteritems():
+            assert (np.array_equal(value.array, patches2[key].array))
+
+    def test_localMin(self):
+
+        def localMin_loop(eccMap, binSize):
+            cutStep = np.arange(np.nanmin(eccMap) - binSize, np.nanmax(eccMap) + binSize * 2, binSize)
+            NumOfMin = 0
+            i = 0
+            while (NumOfMin <= 1) and (i < len(cutStep)):
+                marker, NumOfMin = rm.ni.measurements.label(eccMap <= cutStep[i])
+                i = i + 1
+            return marker
+
+        np.random.seed(0)
+        for binSize in [0.5, 2., 5.]:
+            eccMap = rm.ni.gaussian_filter(np.random.rand(50, 60), 3) * 100
+            eccMap[:5, :] = np.nan
+            eccMap[20:25, 10:15] = np.nan
+            assert (np.array_equal(rm.localMin(eccMap, binSize), localMin_loop(eccMap, binSize)))
+
+        y, x = np.mgrid[0:30, 0:30].astype(np.float64)
+        eccMap = np.hypot(y - 15, x - 15)
+        assert (np.amax(rm.localMin(eccMap, 1.)) == 1)
+        assert (np.array_equal(rm.localMin(eccMap, 1.), localMin_loop(eccMap, 1.)))
+
+    def test_dilationPatches(self):
+
+        def get_new_patches(rawPatches, total_area, borderWidth):
+            patchBorder = rm.sm.skeletonize(total_area - rawPatches)
+            if borderWidth > 1:
+                patchBorder = rm.ni.binary_dilation(patchBorder, iterations=borderWidth - 1).astype(np.int)
+            return np.multiply(-1 * (patchBorder - 1), total_area)
+
+        def dilationPatches_loop(rawPatches, smallPatchThr, borderWidth):
+            total_area = rm.sm.convex_hull_image(rawPatches).astype(np.int)
+            newPatches = get_new_patches(rawPatches, total_area, borderWidth)
+            labeledPatches, patchNum = rm.ni.label(newPatches)
+            for i in xrange(1, patchNum + 1):
+                currPatch = (labeledPatches == i).astype(np.int)
+                if (np.sum(currPatch * rawPatches) == 0) or (np.sum(currPatch) < smallPatchThr):
+                    newPatches[currPatch == 1] = 0
+                else:
+                    currPatch = rm.ni.binary_closing(currPatch, structure=np.ones((borderWidth + 2,
+                                                                                   borderWidth + 2)))
+                    newPatches[currPatch] = 1
+            return newPatches
+
+        def dilationPatches2_loop(rawPatches, dilationIter, borderWidth):
+            total_area = rm.ni.binary_dilation(rawPatches, iterations=dilationIter).astype(np.int)
+            labeledPatches, patchNum = rm.ni.label(get_new_patches(rawPatches, total_area, borderWidth))
+            newPatches2 = np.zeros(rawPatches.shape, dtype=np.int)
+            for i in xrange(1, patchNum + 1):
+                if np.sum((labeledPatches == i) * rawPatches) > 0:
+                    newPatches2[labeledPatches == i] = 1
+            return newPatches2
+
+        np.random.seed(1)
+        rawPatches = (rm.ni.gaussian_filter(np.random.rand(80, 90), 3) > 0.53).astype(np.int)
+        rawPatches[:3, :] = 0
+        for borderWidth in [1, 2]:
+            assert (np.array_equal(rm.dilationPatches(rawPatches, smallPatchThr=20, borderWidth=borderWidth),
+                                   dilationPatches_loop(rawPatches, 20, borderWidth)))
+            assert (np.array_equal(rm.dilationPatches2(rawPatches, dilationIter=5, borderWidth=borderWidth),
+                                   dilationPatches2_loop(rawPatches, 5, borderWidth)))
+
+    def test_generateNormalizedMaps(self):
+        trial = self._get_trial()
+        trial.processTrial()
+        centerKey = sorted(trial.finalPatches.keys())[0]
+        norMaps = trial.generateNormalizedMaps(centerPatchKey=centerKey, mapSize=100)
+        assert ([m is None for m in norMaps] == [False, False, True, True, False, False])
+        assert (norMaps[0].shape == (100, 100))
+
+        centerPixel, rotationAngle = trial.getNormalizeTransform(centerPatchKey=centerKey)
+        signMapC = rm.ia.center_image(trial.signMapf, centerPixel=centerPixel, newSize=100)
+        signMapNor = rm.ia.rotate_image(signMapC, rotationAngle)
+        assert (np.allclose(norMaps[5][30:70, 30:70], signMapNor[30:70, 30:70]))
+
+        # integer maps are not interpolated
+        trial.signMap = (rm.getLabelMap(trial.finalPatches)[0] * 10).astype(np.int32)
+        trial.getNormalizeTransform = lambda centerPatchKey: (np.array([40.5, 20.3]), 33.)
+        signMapNor = trial.generateNormalizedMaps(centerPatchKey=centerKey, mapSize=100)[4]
+        assert (signMapNor.dtype == np.int32)
+        assert (set(np.unique(signMapNor)) <= set(np.unique(trial.signMap)))
+        assert (len(np.unique(signMapNor)) > 2)
+
+        trial.vasculatureMap = np.ones(self.altPosMap.shape)
+        vasMapNor, patchesNor = trial.normalize(centerPatchKey=centerKey, mapSize=100)
+        assert (vasMapNor.shape == (100, 100))
+        assert (sorted(patchesNor.keys()) == sorted(trial.finalPatches.keys()))
+
+    def test_NormalizedAtlas(self):
+        np.random.seed(2)
+        imgs = np.random.rand(9, 20, 30)
+        atlas = rm.NormalizedAtlas(histBinNum=200, isNormalize=False)
+        for img in imgs:
+            atlas.addImage(img)
+        assert (np.allclose(atlas.mean, np.mean(imgs, axis=0)))
+        assert (np.allclose(atlas.getVariance(ddof=1), np.var(imgs, axis=0, ddof=1)))
+        assert (np.amax(np.abs(atlas.getMedian() - np.median(imgs, axis=0))) <= 1. / 200)
+        with self.assertRaises(ValueError):
+            atlas.addImage(np.zeros((5, 5)))
+
+        # histogram counts are widened instead of overflowing
+        atlas3 = rm.NormalizedAtlas(histBinNum=4, isNormalize=False)
+        atlas3.addImage(np.zeros((2, 3)) + 0.6)
+        atlas3._hist = atlas3._hist.astype(np.uint8)
+        for _ in range(299):
+            atlas3.addImage(np.zeros((2, 3)) + 0.6)
+        assert (atlas3._hist.dtype == np.uint32)
+        assert (np.all(atlas3._hist[2] == 300))
+        assert (np.allclose(atlas3.getMedian(), 0.625))
+
+        trial = self._get_trial()
+        trial.processTrial()
+        trial.vasculatureMap = np.random.rand(*self.altPosMap.shape)
+        centerKey = sorted(trial.finalPatches.keys())[0]
+        atlas2 = rm.NormalizedAtlas()
+        atlas2.addTrial(trial, centerPatchKey=centerKey, mapSize=100)
+        atlas2.addTrial(trial, centerPatchKey=centerKey, mapSize=100)
+        probMaps = atlas2.getPatchProbabilityMaps()
+        assert (sorted(probMaps.keys()) == sorted(trial.finalPatches.keys()))
+        assert (np.array_equal(np.unique(probMaps[centerKey]), [0., 1.]))
+
+        atlas2.save(self.tempFolder, prefix='test')
+        assert (os.path.isfile(os.path.join(self.tempFolder, 'test_median.tif')))
+        assert (os.path.isfile(os.path.join(self.tempFolder, 'test_probability_' + centerKey + '.tif')))
+
+    def test_getPatchMeasurements(self):
+        trial = self._get_trial()
+        trial.processTrial()
+
+        gradAltMap = np.gradient(trial.altPosMapf)
+        gradAziMap = np.gradient(trial.aziPosMapf)
+        detMap = np.array([[gradAltMap[0], gradAltMap[1]], [gradAziMap[0], gradAziMap[1]]]).transpose(2, 3, 0, 1)
+        detMap = np.abs(np.linalg.det(detMap))
+        assert (np.allclose(trial.determinantMap, detMap))
+
+        measurements = rm.getPatchMeasurements(trial.finalPatches, detMap, pixelSize=0.01)
+        magDict = trial.getMagnification(pixelSize=0.01)
+        areaDict = trial.getCorticalArea(pixelSize=0.01)
+        for key, patch in trial.finalPatches.iteritems():
+            array = patch.array.astype(np.float64)
+            assert (measurements[key]['area'] == np.sum(array))
+            assert (np.isclose(measurements[key]['sigmaArea'], np.sum(array * detMap)))
+            assert (np.isclose(areaDict[key], np.sum(array) * 0.0001))
+            assert (np.isclose(magDict[key], 0.0001 * np.mean(1. / detMap[array > 0])))
+
+        magDictEroded = trial.getMagnification(pixelSize=0.01, erodeIter=2)
+        for key, patch in trial.finalPatches.iteritems():
+            array = rm.ni.binary_erosion(patch.array, iterations=2)
+            assert (np.isclose(magDictEroded[key], 0.0001 * np.mean(1. / detMap[array])))
+
+        # duplicate and zero entries of a sparse patch array are not counted as pixels
+        sparseArray = rm.sparse.coo_matrix((np.array([1, 1, 1, 0]), (np.array([2, 2, 3, 4]), np.array([5, 5, 6, 7]))),
+                                           shape=(10, 10))
+        trial.finalPatches = {'patch01': rm.Patch(sparseArray, 1)}
+        assert (np.isclose(trial.getCorticalArea(pixelSize=0.01)['patch01'], 2 * 0.0001))
+
+    def test_saveTrialH5(self):
+        trial = self._get_trial()
+        trial.processTrial()
+        trial.finalPatchesMarked = {'V1': trial.finalPatches.values()[0]}
+        h5Path = os.path.join(self.tempFolder, 'trial.h5')
+        trial.saveTrialH5(h5Path)
+
+        trial2 = rm.loadTrial(h5Path)
+        assert ('altPosMap' not in trial2.__dict__)
+        assert (trial2.getName() == trial.getName())
+        assert (trial2.params == self.params)
+        assert (trial2.altPowerMap is None)
+        assert (sorted(trial2.finalPatches.keys()) == sorted(trial.finalPatches.keys()))
+        assert ('altPosMap' not in trial2.__dict__)
+        for key, patch in trial.finalPatches.iteritems():
+            assert (np.array_equal(trial2.finalPatches[key].array, patch.array))
+            assert (trial2.finalPatches[key].sign == patch.sign)
+        assert (np.array_equal(trial2.finalPatchesMarked['V1'].array, trial.finalPatchesMarked['V1'].array))
+        assert (np.array_equal(trial2.altPosMap, trial.altPosMap))
+        assert (np.array_equal(trial2.signMapf, trial.signMapf))
+
+        trial3 = rm.loadTrial(h5Path, isLazy=False)
+        assert (np.array_equal(trial3.aziPosMap, trial.aziPosMap))
+        with self.assertRaises(AttributeError):
+            trial3.finalPatchesAfterSomething
+
+        summaries = rm.batchProcessTrials([h5Path], saveFolder=os.path.join(self.tempFolder, 'processed'),
+                                          processNum=1, isVerbose=False)
+        assert (summaries[0]['status'] == 'done')
+        assert (len(rm.loadTrial(summaries[0]['savePath']).finalPatches) == 2)
+
+    def test_processTrial_lazy(self):
+        trial = self._get_trial()
+        trial.processTrial()
+        trial.finalPatchesMarked = {'V1': trial.finalPatches.values()[0]}
+        h5Path = os.path.join(self.tempFolder, 'trial.h5')
+        trial.saveTrialH5(h5Path)
+
+        trial2 = rm.loadTrial(h5Path)
+        del trial2.eccentricityMapf
+        assert (not hasattr(trial2, 'eccentricityMapf'))
+        with self.assertRaises(AttributeError):
+            del trial2.eccentricityMapf
+
+        trial2.params['signMapThr'] = 0.9
+        trial2.processTrial()
+        assert (not hasattr(trial2, 'finalPatchesMarked'))
+
+        trial3 = rm.loadTrial(h5Path)
+        trial3.params['signMapThr'] = 0.9
+        trial3.processTrial(lastStage='_getSignMap')
+        assert (not hasattr(trial3, 'finalPatches'))
+        assert (not hasattr(trial3, 'finalPatchesMarked'))
+        trialDict = trial3.generateTrialDict()
+        assert ('finalPatches' not in trialDict and 'rawPatchMap' not in trialDict)
+
+        # one open hdf5 file for all lazy accesses, not copied, closed when saving
+        trial4 = rm.loadTrial(h5Path)
+        _ = trial4.altPosMapf
+        h5File = trial4._lazyFile
+        _ = trial4.finalPatches
+        assert (trial4._lazyFile is h5File)
+        assert ('_lazyFile' not in trial4._copy().__dict__)
+        trial4.saveTrialH5(h5Path)
+        assert (not h5File.id.valid)
+        assert (np.array_equal(trial4.aziPosMapf, trial.aziPosMapf))
+        del trial4
+
+    def test_Patch_getDict(self):
+        patchArray = np.zeros((30, 40), dtype=np.int8)
+        patchArray[5:15, 10:30] = 1
+        patchArray[20, :] = 1
+        patch = rm.Patch(patchArray, -1)
+        assert (sorted(patch.getDict().keys()) == ['sign', 'sparseArray'])
+        patchDict = patch.getDict(isRLE=True)
+        assert (len(patchDict['rleStarts']) == 11)
+        patch2 = rm.Patch.fromDict(patchDict)
+        assert (np.array_equal(patch2.array, patchArray))
+        assert (patch2.sign == -1)
+        assert (np.array_equal(rm.Patch.fromDict({'sparseArray': patch.sparseArray, 'sign': 1}).array, patchArray))
+
+    def test_TrialSummaryIndex(self):
+        trialPaths = [self._save_trial('trial1.pkl'), self._save_trial('trial2.pkl')]
+        rm.batchProcessTrials(trialPaths, params=self.params, saveFolder=self.tempFolder, processNum=1,
+                              isVerbose=False)
+
+        index = rm.TrialSummaryIndex(os.path.join(self.tempFolder, 'index.db'), pixelSize=0.01)
+        assert (index.update(trialPaths, isVerbose=False) == trialPaths)
+        assert (index.update(trialPaths, isVerbose=False) == [])
+
+        trial = rm.loadTrial(trialPaths[0])
+        areaDict = trial.getCorticalArea(pixelSize=0.01)
+        values = index.getPatchValues('patch01', 'corticalArea')
+        assert (len(values) == 2)
+        assert (np.isclose(values[0][1], areaDict['patch01']))
+        rows = index.query('SELECT * FROM patches WHERE trialPath = ?', (trialPaths[0],))
+        assert (sorted([r['sign'] for r in rows]) == [-1, 1])
+        assert (all([r['visualCoverage'] > 0 and r['magnification'] > 0 for r in rows]))
+
+        os.utime(trialPaths[1], (0, 0))
+        assert (index.update(trialPaths, isVerbose=False) == trialPaths[1:])
+
+        # unprocessed and broken trials are skipped, the trials after them are still indexed
+        badPaths = [self._save_trial('unprocessed.pkl'), os.path.join(self.tempFolder, 'broken.pkl')]
+        with open(badPaths[1], 'w') as f:
+            f.write('not a trial')
+        os.utime(trialPaths[0], (1, 1))
+        assert (index.update(badPaths + trialPaths[:1], isVerbose=False) == trialPaths[:1])
+        assert (sorted(index.errors.keys()) == sorted(badPaths))
+        with self.assertRaises(Exception):
+            index.update(badPaths, isVerbose=False, isSkipError=False)
+        index.update(trialPaths[:1], isPruned=True, isVerbose=False)
+        assert (len(index.query('SELECT * FROM trials')) == 1)
+        assert (len(index.query('SELECT * FROM patches')) == 2)
+
+    def test_filterMapStack(self):
+        np.random.seed(3)
+        maps = np.random.rand(3, 60, 50)
+        for filterType, filterSize, niFilter in [('gaussian', 3., rm.ni.filters.gaussian_filter),
+                                                 ('gaussian', 9., rm.ni.filters.gaussian_filter),
+                                                 ('uniform', 5, rm.ni.filters.uniform_filter),
+                                                 ('uniform', 10., rm.ni.filters.uniform_filter)]:
+            mapsf = rm.filterMapStack(maps, filterType=filterType, filterSize=filterSize, method='fft')
+            for m, mf in zip(maps, mapsf):
+                assert (np.allclose(mf, niFilter(m, filterSize)))
+        assert (('gaussian', 9., (60 + 2 * 36, 50 + 2 * 36)) in rm._FFT_KERNEL_CACHE)
+
+        phaseMaps = np.random.rand(2, 60, 50) * 2 * np.pi
+        phaseMapsf = rm.phaseFilterStack(phaseMaps, filterType='gaussian', filterSize=10., method='fft')
+        for phaseMap, phaseMapf in zip(phaseMaps, phaseMapsf):
+            phaseMapf2 = np.arctan2(rm.ni.filters.gaussian_filter(np.sin(phaseMap), 10.),
+                                    rm.ni.filters.gaussian_filter(np.cos(phaseMap), 10.)) % (2 * np.pi)
+            assert (np.allclose(phaseMapf, phaseMapf2))
+            assert (np.allclose(rm.phaseFilter(phaseMap, filterType='Gaussian', filterSize=10.), phaseMapf2))
+
+    def test_processingReport(self):
+        trial = self._get_trial()
+        trial.processTrial()
+        report = trial.processingReport
+        assert ([s['stage'] for s in report['stages']] == [s[0] for s in rm.PROCESSING_STAGES])
+        assert (all([s['status'] == 'computed' for s in report['stages']]))
+        stages = dict([(s['stage'], s) for s in report['stages']])
+        assert (stages['_splitPatches']['counts']['getVisualSpace'] == 2)
+        assert (stages['_mergePatches']['counts']['mergeIterations'] >= 1)
+        assert (stages['_getSignMap']['counts']['getVisualSpace'] == 0)
+        assert (report['totalDuration'] >= sum([s['duration'] for s in report['stages']]))
+        assert ('_mergePatches' in rm.formatProcessingReport(report))
+        if os.path.isfile('/proc/self/statm'):
+            assert (all([0 <= s['rssIncrease'] <= s['peakRSS'] for s in report['stages']]))
+            assert (all([s['processMaxRSS'] >= s['peakRSS'] - 1. for s in report['stages']]))
+
+            with rm._RSSSampler() as sampler:
+                data = np.ones((200, 1024, 1024 // 8))
+                del data
+            assert (sampler.getReport()['rssIncrease'] > 150.)
+
+        trial.processTrial(isIncremental=True)
+        assert (all([s['status'] == 'skipped' for s in trial.processingReport['stages']]))
+
+        h5Path = os.path.join(self.tempFolder, 'trial.h5')
+        trial.saveTrialH5(h5Path)
+        assert (rm.loadTrial(h5Path).processingReport['stages'][0]['status'] == 'skipped')
+        pklPath = os.path.join(self.tempFolder, 'trial.pkl')
+        ft.saveFile(pklPath, trial.generateTrialDict())
+        assert (len(rm.loadTrial(pklPath).processingReport['stages']) == len(rm.PROCESSING_STAGES))
@@ -0,0 +1,72 @@
+import os
+import unittest
+import numpy as np
+import retinotopic_mapping.tools.DisplayAlignment as da
+
+curr_folder = os.path.dirname(os.path.realpath(__file__))
+os.chdir(curr_folder)
+
+class TestDisplayAlignment(unittest.TestCase):
+
+    def setUp(self):
+        np.random.seed(0)
+
+        # indicator flips every 3 to 20 frames, 60 Hz display with jitter
+        frame_num = 3000
+        colors = []
+        color = -1.
+        while len(colors) < frame_num:
+            colors += [color] * np.random.randint(3, 20)
+            color = -color
+        self.colors = np.array(colors[:frame_num])
+        self.time_stamp = np.arange(frame_num) / 60. + np.random.rand(frame_num) * 0.002
+        self.log = {'stimulation': {'frame_config': ('is_display', 'indicator color [-1., 1.]'),
+                                    'frames_unique': ((0, -1.), (1, 1.)),
+                                    'index_to_display': list(((self.colors + 1) / 2).astype(np.int))},
+                    'presentation': {'time_stamp': self.time_stamp}}
+
+        # photodiode at 10 kHz, 2.345 sec offset, slow clock drift
+        self.sf = 10000.
+        self.offset = 2.345
+        self.onsets = self.time_stamp * (1. + 1e-4) + self.offset
+        t = np.arange(int((self.onsets[-1] + 1.) * self.sf)) / self.sf
+        frame_ind = np.searchsorted(self.onsets, t, side='right') - 1
+        self.photodiode = np.where(frame_ind >= 0, self.colors[np.maximum(frame_ind, 0)], -1.)
+        self.photodiode = self.photodiode + np.random.randn(len(t)) * 0.1
+
+    def test_get_photodiode_transitions(self):
+        onsets, polarities = da.get_photodiode_transitions(self.photodiode, self.sf, chunk_length=10007)
+        transition_frames = np.flatnonzero(np.diff(self.colors)) + 1
+        assert (len(onsets) == len(transition_frames))
+        assert (np.allclose(onsets, self.onsets[transition_frames], atol=2. / self.sf))
+        assert (np.array_equal(polarities, np.sign(np.diff(self.colors)[transition_frames - 1])))
+
+    def test_get_frame_onsets(self):
+        alignment = da.get_frame_onsets(self.photodiode, self.sf, self.log)
+        assert (abs(alignment['offset'] - self.offset) < 0.01)
+        assert (alignment['match_ratio'] == 1.)
+        assert (np.allclose(alignment['frame_onsets'], self.onsets, atol=0.002))
+
+        alignment = da.get_frame_onsets(-self.photodiode, self.sf, self.log, is_inverted=True)
+        assert (np.allclose(alignment['frame_onsets'], self.onsets, atol=0.002))
+
+    def test_get_frame_onsets_few_transitions(self):
+        for colors in [[-1.] * 60 + [1.] * 60, [-1.] * 40 + [1.] * 40 + [-1.] * 40]:
+            colors = np.array(colors)
+            time_stamp = np.arange(len(colors)) / 60.
+            log = {'stimulation': {'frame_config': ('is_display', 'indicator color [-1., 1.]'),
+                                   'frames': [(1, color) for color in colors]},
+                   'presentation': {'time_stamp': time_stamp}}
+
+            t = np.arange(int((time_stamp[-1] + self.offset + 1.) * self.sf)) / self.sf
+            frame_ind = np.searchsorted(time_stamp + self.offset, t, side='right') - 1
+            photodiode = np.where(frame_ind >= 0, colors[np.maximum(frame_ind, 0)], -1.)
+
+            alignment = da.get_frame_onsets(photodiode, self.sf, log)
+            assert (abs(alignment['offset'] - self.offset) < 0.01)
+            assert (alignment['match_ratio'] == 1.)
+            assert (np.allclose(alignment['frame_onsets'], time_stamp + self.offset, atol=0.001))
+
+
+if __name__ == '__main__':
+    unittest.main()
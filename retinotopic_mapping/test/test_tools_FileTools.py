@@ -0,0 +1,147 @@
+import os
+import shutil
+import tempfile
+import unittest
+import numpy as np
+import retinotopic_mapping.tools.FileTools as ft
+
+curr_folder = os.path.dirname(os.path.realpath(__file__))
+os.chdir(curr_folder)
+
+class TestFileTools(unittest.TestCase):
+
+    def setUp(self):
+        np.random.seed(0)
+        self.tempFolder = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.tempFolder)
+
+    def test_getRisingEdges(self):
+        read = np.tile(np.array([0., 0., 5., 5., 5.]), 200)
+        read[500:503] = 3.
+        edges = [i for i in range(1, len(read)) if read[i - 1] < 3. and read[i] >= 3.]
+        assert (np.array_equal(ft.getRisingEdges(read, thr=3., chunkLength=7), edges))
+        assert (np.array_equal(ft.getRisingEdges(read, thr=3.), edges))
+        assert (len(ft.getRisingEdges(np.zeros(10))) == 0)
+
+    def test_getPhotodiodeOnset(self):
+        photodiode = np.random.rand(3000) * 0.2
+        photodiode[:50] = 1.5  # before startIndex
+        photodiode[2000:] = 1.5
+        assert (ft.getPhotodiodeOnset(photodiode, thr=.95, chunkLength=33) == 2000)
+        assert (ft.getPhotodiodeOnset(photodiode, thr=.95) == 2000)
+        assert (ft.getPhotodiodeOnset(photodiode[:1500], thr=.95) is None)
+
+    def test_importRawJPhys2(self):
+        sampleNum = 5000
+        read = np.tile(np.array([0.] * 50 + [5.] * 50), sampleNum // 100)
+        photodiode = np.zeros(sampleNum)
+        photodiode[3000:] = 2.
+        traces = np.array([np.random.rand(sampleNum), read, np.random.rand(sampleNum), photodiode])
+        traces = np.concatenate((np.zeros((4, 96)), traces), axis=1)
+
+        oldPath = os.path.join(self.tempFolder, 'old.jphys')
+        traces.astype('>f').tofile(oldPath)
+        frameTS, visualStart = ft.importRawJPhys2(oldPath, 40)
+        assert (np.allclose(frameTS, np.arange(50, 4000, 100) / 10000.))
+        assert (visualStart == 0.3)
+
+        newPath = os.path.join(self.tempFolder, 'new.jphys')
+        channels = ('photodiode2', 'read', 'trigger', 'photodiode')
+        traces.T.astype('>f').tofile(newPath)
+        frameTS, visualStart = ft.importRawNewJPhys2(newPath, 40, channels=channels)
+        assert (np.allclose(frameTS, np.arange(50, 4000, 100) / 10000.))
+        assert (visualStart == 0.3)
+
+        self.assertRaises(LookupError, ft.importRawJPhys2, oldPath, 60)
+
+    def test_RawJCamFReader(self):
+        header = np.arange(116, dtype='<u2')
+        mov = np.random.randint(0, 4096, size=(3, 4, 5)).astype('<u2')
+        tailer = np.arange(218, dtype='<u2') + 1000
+        path = os.path.join(self.tempFolder, 'test.jcamf')
+        np.concatenate((header, mov.ravel(), tailer)).tofile(path)
+
+        reader = ft.RawJCamFReader(path, column=4, row=5)
+        assert (reader.shape == (3, 4, 5))
+        assert (np.array_equal(reader[1:, 2:], mov[1:, 2:]))
+        assert (np.array_equal(reader.getHeader(), header))
+        assert (np.array_equal(reader.getTailer(), tailer))
+        reader.close()
+
+        mov2, header2, tailer2 = ft.importRawJCamF(path, column=4, row=5)
+        assert (np.array_equal(mov2, mov) and np.array_equal(header2, header) and np.array_equal(tailer2, tailer))
+        mov2, _, tailer2 = ft.importRawJCamF(path, column=4, row=5, frame=2)
+        assert (np.array_equal(mov2, mov[:2]) and len(tailer2) == 0)
+        self.assertRaises(ValueError, ft.RawJCamFReader, path, column=4, row=5, frame=20)
+
+    def test_RawJPhysReader(self):
+        channels = ('photodiode2', 'read', 'trigger', 'photodiode')
+        traces = np.random.rand(4, 96 + 1234).astype(np.float32)
+
+        for isInterleaved in [False, True]:
+            path = os.path.join(self.tempFolder, 'test.jphys')
+            (traces.T if isInterleaved else traces).astype('>f').tofile(path)
+            if isInterleaved:
+                header, body = ft.importRawNewJPhys(path, channels=channels)
+            else:
+                header, body = ft.importRawJPhys(path, channels=channels)
+
+            reader = ft.RawJPhysReader(path, channels=channels, isInterleaved=isInterleaved)
+            assert (len(reader) == 1234)
+            assert (np.array_equal(reader.getHeader('trigger'), header['trigger']))
+            assert (np.array_equal(reader['read'], body['read']))
+            assert (sorted(reader.getChannels(['read', 'photodiode']).keys()) == ['photodiode', 'read'])
+            self.assertRaises(LookupError, reader.getChannel, 'licking')
+
+            assert (reader.duration == 0.1234)
+            assert (np.allclose(reader.getTimeStamps(1230), [0.123, 0.1231, 0.1232, 0.1233]))
+
+            chunks = list(reader.iterChunks(['read', 'photodiode'], chunkLength=500))
+            assert ([chunkStart for chunkStart, _ in chunks] == [0, 500, 1000])
+            assert (chunks[-1][1]['photodiode'].dtype.isnative)
+            assert (np.array_equal(np.concatenate([chunk['photodiode'] for _, chunk in chunks]), body['photodiode']))
+            reader.close()
+
+            with open(path, 'ab') as f:
+                f.write(np.zeros(3, dtype='>f').tobytes())
+            self.assertRaises(ArithmeticError, ft.RawJPhysReader, path, channels=channels,
+                              isInterleaved=isInterleaved)
+            self.assertRaises(ArithmeticError, ft.importRawNewJPhys2 if isInterleaved else ft.importRawJPhys2,
+                              path, 1, channels=channels)
+
+    def test_RawJCamReader(self):
+        mov = np.random.rand(25, 8, 6).astype(np.float32)
+        header = np.zeros(96)
+        header[14], header[15], header[16], header[17] = 12, 16, 25, 10.
+        jcamPath = os.path.join(self.tempFolder, 'test.jcam')
+        np.concatenate((header, mov.ravel())).astype('>f').tofile(jcamPath)
+
+        reader = ft.RawJCamReader(jcamPath, decimation=2)
+        assert (reader.shape == (25, 8, 6))
+        assert (len(reader) == 25)
+        assert (reader.exposureTime == 10.)
+        chunk = reader[3:7, 2:5, 1:4]
+        assert (chunk.dtype.isnative)
+        assert (np.array_equal(chunk, mov[3:7, 2:5, 1:4]))
+        assert (np.array_equal(reader[-1], mov[-1]))
+        reader.close()
+
+        self.assertRaises(ValueError, ft.RawJCamReader, jcamPath)
+
+    def test_iterRawJCam(self):
+        mov = np.random.rand(25, 8, 6).astype(np.float32)
+        header = np.zeros(96)
+        header[14], header[15], header[16], header[17] = 12, 16, 25, 10.
+        jcamPath = os.path.join(self.tempFolder, 'test.jcam')
+        np.concatenate((header, mov.ravel())).astype('>f').tofile(jcamPath)
+
+        chunks = list(ft.iterRawJCam(jcamPath, chunkFrameNum=10, decimation=2))
+        assert ([startFrame for startFrame, _ in chunks] == [0, 10, 20])
+        assert ([chunk.shape[0] for _, chunk in chunks] == [10, 10, 5])
+        assert (np.array_equal(np.concatenate([chunk for _, chunk in chunks]), mov))
+
+
+if __name__ == '__main__':
+    unittest.main()
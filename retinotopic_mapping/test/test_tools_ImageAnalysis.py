@@ -1,5 +1,9 @@
 import os
+import shutil
+import tempfile
 import unittest
+import h5py
+import numpy as np
 import retinotopic_mapping.tools.ImageAnalysis as ia
 
 curr_folder = os.path.dirname(os.path.realpath(__file__))
@@ -12,4 +16,219 @@ class TestSimulation(unittest.TestCase):
 
     def test_distance(self):
         assert (ia.distance(3., 4.) == 1.)
-        assert (ia.distance([5., 8.], [9., 11.]) == 5.)
\ No newline at end of file
+        assert (ia.distance([5., 8.], [9., 11.]) == 5.)
+
+    def test_center_rotate_image_stack(self):
+        np.random.seed(0)
+        imgs = np.random.rand(3, 60, 70)
+        centerPixel = np.array([25, 40])
+        newSize = 80
+        for angle, borderValue in [(0., 0.), (30., 0.), (-75., 2.)]:
+            imgsNor = ia.center_rotate_image_stack(imgs, centerPixel, angle, newSize=newSize,
+                                                   borderValue=borderValue)
+            assert (imgsNor.shape == (3, newSize, newSize))
+
+            # the two-step transform crops the intermediate canvas, only compare within the inscribed circle
+            y, x = np.mgrid[0:newSize, 0:newSize]
+            isInside = np.hypot(y - newSize / 2, x - newSize / 2) < newSize / 2 - 2
+            for img, imgNor in zip(imgs, imgsNor):
+                imgC = ia.center_image(img, centerPixel=centerPixel, newSize=newSize, borderValue=borderValue)
+                imgNor2 = ia.rotate_image(imgC, angle, borderValue=borderValue)
+                assert (np.allclose(imgNor[isInside], imgNor2[isInside]))
+            assert (np.allclose(imgsNor[:, 0, 0], borderValue))
+
+    def test_rle(self):
+        np.random.seed(1)
+        mask = (np.random.rand(30, 40) > 0.6).astype(np.uint8)
+        mask[10:20, 5:35] = 1
+        starts, lengths = ia.mask_to_rle(mask)
+        assert (np.sum(lengths) == np.sum(mask))
+        assert (np.array_equal(ia.rle_to_mask(starts, lengths, mask.shape), mask))
+        pixels = ia.rle_to_pixels(starts, lengths, mask.shape)
+        assert (np.array_equal(np.array(pixels), np.array(np.where(mask))))
+
+        starts, lengths = ia.mask_to_rle(np.zeros((5, 5)))
+        assert (len(starts) == 0 and np.sum(ia.rle_to_mask(starts, lengths, (5, 5))) == 0)
+
+    def test_ROI_h5(self):
+        np.random.seed(2)
+        weightedMask = np.random.rand(30, 40) * (np.random.rand(30, 40) > 0.5)
+        tempFolder = tempfile.mkdtemp()
+        try:
+            h5Path = os.path.join(tempFolder, 'rois.hdf5')
+            with h5py.File(h5Path, 'w') as f:
+                ia.ROI(weightedMask, pixelSize=2., pixelSizeUnit='um').to_h5_group(f.create_group('roi'))
+                ia.WeightedROI(weightedMask).to_h5_group(f.create_group('weighted_roi'), is_rle=True)
+                assert ('pixels' in f['roi'].keys() and 'rle_starts' not in f['roi'].keys())
+                assert ('pixels' not in f['weighted_roi'].keys())
+            with h5py.File(h5Path, 'r') as f:
+                roi = ia.ROI.from_h5_group(f['roi'])
+                weightedROI = ia.WeightedROI.from_h5_group(f['weighted_roi'])
+                weightedROI2 = ia.ROI.from_h5_group(f['weighted_roi'])
+            assert (np.array_equal(roi.get_binary_mask(), (weightedMask > 0).astype(np.uint8)))
+            assert (roi.pixelSizeUnit == 'um')
+            assert (np.allclose(weightedROI.get_weighted_mask(), weightedMask.astype(np.float32)))
+            assert (np.allclose(weightedROI2.get_weighted_mask(), weightedMask.astype(np.float32)))
+        finally:
+            shutil.rmtree(tempFolder)
+
+    def test_get_traces(self):
+        np.random.seed(0)
+        mov = np.random.rand(30, 12, 10)
+        binary = np.zeros((12, 10))
+        binary[2:5, 3:7] = 1
+        binaryNan = np.ones((12, 10))
+        binaryNan[binary == 0] = np.nan
+        weighted = np.random.rand(12, 10) * binary
+        weightedNan = weighted.copy()
+        weightedNan[binary == 0] = np.nan
+
+        for mask, mode in [(binary, 'binary'), (binaryNan, 'binaryNan'), (weighted, 'weighted'),
+                           (weightedNan, 'weightedNan')]:
+            weightMatrix = ia.get_roi_weight_matrix([mask, mask[::-1]], mask_mode=mode)
+            assert (weightMatrix.shape == (2, 120))
+            traces = ia.get_traces(mov, weightMatrix)
+            assert (np.allclose(traces[0], ia.get_trace(mov, mask, maskMode=mode)))
+            assert (np.allclose(traces[1], ia.get_trace(mov, mask[::-1], maskMode=mode)))
+
+        traces = ia.get_traces(mov, ia.get_roi_weight_matrix([binary, np.zeros((12, 10))]))
+        assert (np.isnan(traces[1]).all())
+
+        progress = []
+        traces = ia.get_trace_binaryslicer3(mov, {'a': binary, 'b': 1 - binary}, loading_frame_num=7,
+                                            progress_callback=lambda *args: progress.append(args))
+        assert (np.allclose(traces['trace_a'], ia.get_trace(mov, binary)))
+        assert (np.allclose(traces['trace_b'], ia.get_trace(mov, 1 - binary)))
+        assert (progress == [(i, min(i + 7, len(mov)), len(mov)) for i in range(0, len(mov), 7)])
+
+        trace = ia.get_trace_binaryslicer2(mov, binary, loading_frame_num=7, progress_callback=lambda *args: None)
+        assert (np.allclose(trace, ia.get_trace(mov, binary)))
+
+    def test_get_trace_binaryslicer_parallel(self):
+        np.random.seed(0)
+        mov = np.random.rand(95, 12, 10)
+        binary = np.zeros((12, 10))
+        binary[2:5, 3:7] = 1
+
+        progress = []
+        traces = ia.get_trace_binaryslicer_parallel(mov, {'a': binary, 'b': 1 - binary}, loading_frame_num=10,
+                                                    queue_depth=3,
+                                                    progress_callback=lambda *args: progress.append(args))
+        assert (np.allclose(traces['trace_a'], ia.get_trace(mov, binary)))
+        assert (np.allclose(traces['trace_b'], ia.get_trace(mov, 1 - binary)))
+        assert (progress == [(i, min(i + 10, 95), 95) for i in range(0, 95, 10)])
+
+        trace = ia.get_trace_binaryslicer_parallel(mov, binary, loading_frame_num=40)
+        assert (np.allclose(trace, ia.get_trace(mov, binary)))
+
+        class BrokenSlicer(object):
+            shape = (95, 12, 10)
+
+            def __getitem__(self, key):
+                raise IOError('can not read')
+
+        self.assertRaises(IOError, ia.get_trace_binaryslicer_parallel, BrokenSlicer(), binary)
+
+    def test_boxcartime_dff(self):
+        np.random.seed(0)
+        mov = np.random.rand(40, 3, 4) + 1.
+        for window in [0.2, 0.25]:
+            win = int(np.ceil(window / 0.05))
+            ave = np.array([np.mean(mov[n + 1:n + win + 1], axis=0) for n in range(40 - win)])
+            dff = ia.boxcartime_dff(mov, window, 50., tile_pixel_num=5)
+            assert (dff.shape == (40 - win, 3, 4))
+            assert (np.allclose(dff, (mov[win // 2:win // 2 + 40 - win] - ave) / ave))
+
+        assert (ia.boxcartime_dff(mov, 0.2, 50., dtype=np.float32).dtype == np.float32)
+
+    def test_temporal_filter_movie(self):
+
+        np.random.seed(0)
+        for frameNum in [64, 65]:
+            mov = np.random.rand(frameNum, 5, 6)
+            freqs = np.fft.fftfreq(frameNum, d=0.1)
+            for mode in ['box', '1/f']:
+                filterArray = ((np.abs(freqs) >= 1.) & (np.abs(freqs) <= 3.)).astype(np.float)
+                if mode == '1/f':
+                    filterArray[1:] = filterArray[1:] / abs(freqs[1:])
+                    filterArray = (filterArray - np.amin(filterArray)) / (np.amax(filterArray) - np.amin(filterArray))
+                movF = np.real(np.fft.ifft(np.fft.fft(mov, axis=0) * filterArray[:, None, None], axis=0))
+                assert (np.allclose(ia.temporal_filter_movie(mov, 10., 1., 3., mode=mode, tile_pixel_num=7),
+                                    movF, atol=1e-5))
+
+        tempFolder = tempfile.mkdtemp()
+        try:
+            output = np.memmap(os.path.join(tempFolder, 'filtered.dat'), dtype=np.float32, mode='w+', shape=mov.shape)
+            result = ia.temporal_filter_movie(mov, 10., 0., 3., output=output)
+            assert (result is output)
+            assert (np.allclose(np.mean(output, axis=0), np.mean(mov, axis=0), atol=1e-5))
+            del result, output
+        finally:
+            shutil.rmtree(tempFolder)
+
+    def test_normalize_movie_streaming(self):
+
+        np.random.seed(0)
+        mov = np.random.rand(101, 8, 9) * 100. + 50.
+
+        averageImage, _, dFoverFMovie = ia.normalize_movie(mov, baselineType='mean')
+        baseline, output = ia.normalize_movie_streaming(mov, baselineType='mean', chunk_frame_num=30)
+        assert (np.allclose(baseline, averageImage, rtol=1e-5))
+        assert (output.dtype == np.float32)
+        assert (np.allclose(output, dFoverFMovie, atol=1e-5))
+
+        baseline = ia.get_baseline_image(mov, baselineType='median', chunk_frame_num=30, hist_bin_num=256)
+        assert (np.allclose(baseline, np.median(mov, axis=0), atol=100. / 256))
+        baseline2 = ia.get_baseline_image(mov, baselineType='median', chunk_frame_num=30, hist_bin_num=256,
+                                          tile_pixel_num=20)
+        assert (np.allclose(baseline2, baseline))
+
+        tempFolder = tempfile.mkdtemp()
+        try:
+            output = np.memmap(os.path.join(tempFolder, 'dF.dat'), dtype=np.float32, mode='w+', shape=mov.shape)
+            baselinePic = np.zeros((8, 9)) + 100.
+            _, result = ia.normalize_movie_streaming(mov, output=output, baselinePic=baselinePic, isDFoverF=False)
+            assert (result is output)
+            assert (np.allclose(output, mov - 100., atol=1e-4))
+            del result, output
+        finally:
+            shutil.rmtree(tempFolder)
+
+    def test_get_ks_retinotopic_maps(self):
+        # display log of KSstimAllDir, 60 Hz, each iteration: 30 gap frames, 120 sweep frames, 30 gap frames
+        direction_centers = [('B2U', -30., 0.8), ('U2B', 65.2, -0.8), ('L2R', 0., 0.8), ('R2L', 95.2, -0.8)]
+        sweep_table = []
+        frames = []
+        for direction, start, step in direction_centers:
+            sweep_offset = len(sweep_table)
+            sweep_table += [(direction, start + step * i - 10., start + step * i + 10.) for i in range(120)]
+            for _ in range(2):
+                frames += [(0, None, None, -1, direction)] * 30
+                frames += [(1, 1, sweep_offset + i, 1, direction) for i in range(120)]
+                frames += [(0, None, None, -1, direction)] * 30
+        log = {'stimulation': {'sweep_table': sweep_table},
+               'presentation': {'displayed_frames': frames, 'time_stamp': np.arange(len(frames)) / 60.}}
+
+        sweep_info = ia.get_ks_sweep_info(log)
+        assert (np.isclose(sweep_info['B2U']['period'], 3.))
+        assert (np.isclose(sweep_info['U2B']['velocity'], -48.))
+        assert (np.isclose(sweep_info['L2R']['intercept'], 0.))
+
+        # imaging at 15 Hz, response peaks 0.4 second after the bar passes the position of the pixel
+        frame_ts = np.arange(0, len(frames) / 60., 1 / 15.)
+        alt, azi = np.meshgrid(np.arange(-10., 20., 5.), np.arange(30., 54., 3.), indexing='ij')
+        mov = np.zeros((len(frame_ts),) + alt.shape, dtype=np.float32) + 1000.
+        for direction, _, _ in direction_centers:
+            info = sweep_info[direction]
+            position = alt if direction in ['B2U', 'U2B'] else azi
+            peak_phase = 2 * np.pi * ((position - info['intercept']) / info['velocity'] + 0.4) / info['period']
+            phases = ia.get_ks_frame_phases(frame_ts, info)
+            for i in np.flatnonzero(~np.isnan(phases)):
+                mov[i] += 10. * np.cos(phases[i] - peak_phase)
+
+        chunks = ((i, mov[i:i + 100]) for i in range(0, len(mov), 100))
+        maps = ia.get_ks_retinotopic_maps(chunks, frame_ts, log)
+
+        assert (np.allclose(maps['altPosMap'], alt, atol=0.1))
+        assert (np.allclose(maps['aziPosMap'], azi, atol=0.1))
+        assert (np.allclose(maps['altPowerMap'], 0.01, atol=0.001))
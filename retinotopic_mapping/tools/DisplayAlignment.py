@@ -0,0 +1,230 @@
+"""
+align photodiode recordings (JPhys) with the display logs saved by DisplayStimulus.DisplaySequence
+"""
+
+import numpy as np
+from scipy.signal import fftconvolve
+
+
+def get_indicator_index(log):
+    """
+    find the position of the indicator color in each frame tuple from 'frame_config' of the stimulus, if not
+    found, the last element
+
+    :param log: display log dictionary saved by DisplaySequence.save_log
+    :return: int
+    """
+
+    frame_config = log['stimulation'].get('frame_config', ())
+    for i, config in enumerate(frame_config):
+        if 'indicator' in config:
+            return i
+    return -1
+
+
+def get_indicator_colors(log, indicator_index=None):
+    """
+    get the indicator color of every displayed frame
+
+    :param log: display log dictionary saved by DisplaySequence.save_log
+    :param indicator_index: position of the indicator color in each frame tuple, if None, found by
+                            get_indicator_index
+    :return: 1d array, indicator color of each displayed frame, same length as log['presentation']['time_stamp']
+    """
+
+    if indicator_index is None:
+        indicator_index = get_indicator_index(log)
+
+    presentation = log['presentation']
+    stimulation = log['stimulation']
+    frame_num = len(presentation['time_stamp'])
+
+    if presentation.get('displayed_frames'):
+        frames = presentation['displayed_frames']
+    elif 'index_to_display' in stimulation:
+        frames = [stimulation['frames_unique'][i] for i in stimulation['index_to_display']]
+    else:
+        frames = stimulation['frames']
+
+    colors = np.array([frame[indicator_index] for frame in frames], dtype=np.float)
+    return np.resize(colors, frame_num)
+
+
+def get_photodiode_transitions(photodiode, sf, thr_low=None, thr_high=None, chunk_length=1000000):
+    """
+    detect every indicator transition in a photodiode trace. A transition is counted when the trace goes from below
+    thr_low to above thr_high (rising) or the opposite (falling), so noise between the two thresholds is ignored.
+    The onset of each transition is the sample where the trace crosses the middle of the two thresholds. The trace
+    is processed chunk by chunk, so it can be a memory mapped channel (FileTools.RawJPhysReader)
+
+    :param photodiode: 1d array, photodiode trace
+    :param sf: sampling rate, Hz
+    :param thr_low: low threshold, if None, 1/3 between the 1st and 99th percentile of the trace
+    :param thr_high: high threshold, if None, 2/3 between the 1st and 99th percentile of the trace
+    :param chunk_length: number of samples loaded each time
+    :return: onsets: 1d array, time of each transition (sec)
+             polarities: 1d array, 1 for rising, -1 for falling
+    """
+
+    if thr_low is None or thr_high is None:
+        sample = np.asarray(photodiode[::max(1, len(photodiode) // 100000)], dtype=np.float)
+        low, high = np.percentile(sample, [1, 99])
+        if thr_low is None:
+            thr_low = low + (high - low) / 3.
+        if thr_high is None:
+            thr_high = low + (high - low) * 2. / 3.
+
+    if thr_low >= thr_high:
+        raise ValueError, 'thr_low should be smaller than thr_high!'
+    thr_mid = (thr_low + thr_high) / 2.
+
+    onsets = []
+    polarities = []
+    state = None
+
+    for chunk_start in range(0, len(photodiode), chunk_length):
+        chunk = np.asarray(photodiode[chunk_start:chunk_start + chunk_length], dtype=np.float)
+        ind = np.arange(len(chunk))
+
+        # state of each sample: the side of the last sample outside of the two thresholds
+        is_valid = (chunk >= thr_high) | (chunk <= thr_low)
+        if not is_valid.any():
+            continue
+        last_valid = np.maximum.accumulate(np.where(is_valid, ind, -1))
+        if state is None:
+            state = chunk[last_valid[np.flatnonzero(is_valid)[0]]] >= thr_high
+        curr_state = np.where(last_valid >= 0, chunk[np.maximum(last_valid, 0)] >= thr_high, state)
+
+        changes = np.flatnonzero(np.diff(np.concatenate(([state], curr_state)).astype(np.int8)))
+        if len(changes) > 0:
+            curr_polarities = np.where(curr_state[changes], 1, -1)
+
+            # move each transition back to the middle threshold crossing
+            is_high = chunk >= thr_mid
+            last_low = np.maximum.accumulate(np.where(is_high, -1, ind))
+            last_high = np.maximum.accumulate(np.where(is_high, ind, -1))
+            crossings = np.where(curr_polarities > 0, last_low[changes], last_high[changes]) + 1
+
+            onsets.append((crossings + chunk_start) / float(sf))
+            polarities.append(curr_polarities)
+
+        state = curr_state[-1]
+
+    if onsets:
+        return np.concatenate(onsets), np.concatenate(polarities)
+    else:
+        return np.array([]), np.array([], dtype=np.int)
+
+
+def _get_step_trace(times, levels, duration, resolution, initial_level):
+    """
+    sample a step function (value initial_level before times[0], levels[i] from times[i] on) at a regular grid
+    starting at 0, zero mean
+    """
+
+    grid = np.arange(int(np.ceil(duration / resolution))) * resolution
+    ind = np.searchsorted(times, grid, side='right') - 1
+    trace = np.where(ind >= 0, levels[np.maximum(ind, 0)], initial_level).astype(np.float)
+    return trace - np.mean(trace)
+
+
+def align_photodiode_to_log(onsets, polarities, log, indicator_index=None, is_inverted=False, resolution=0.001,
+                            tolerance=None):
+    """
+    align photodiode transitions (get_photodiode_transitions) with the indicator colors of the displayed frames.
+    The offset between the display clock and the photodiode clock is found by cross-correlating the two indicator
+    traces. Each indicator transition in the log is then matched to the closest photodiode transition with the same
+    polarity, and the onset of each displayed frame is interpolated between matched transitions, which also
+    corrects slow drifts between the two clocks.
+
+    :param onsets: 1d array, time of each photodiode transition (sec)
+    :param polarities: 1d array, 1 for rising, -1 for falling
+    :param log: display log dictionary saved by DisplaySequence.save_log
+    :param indicator_index: position of the indicator color in each frame tuple, see get_indicator_colors
+    :param is_inverted: if True, a brighter indicator gives a lower photodiode signal
+    :param resolution: time resolution of the cross-correlation (sec)
+    :param tolerance: maximum distance between a predicted and a detected transition (sec), if None, half of the
+                      median frame duration
+    :return: dictionary {'frame_onsets': onset of each displayed frame in photodiode time,
+                         'offset': photodiode time minus display time,
+                         'transition_frames': indices of displayed frames with an indicator transition,
+                         'transition_onsets': matched photodiode onset of each transition, nan if not matched,
+                         'match_ratio': ratio of matched transitions}
+    """
+
+    onsets = np.asarray(onsets, dtype=np.float)
+    polarities = np.asarray(polarities)
+    time_stamp = np.asarray(log['presentation']['time_stamp'], dtype=np.float)
+    colors = get_indicator_colors(log, indicator_index=indicator_index)
+    if is_inverted:
+        colors = -colors
+
+    transition_frames = np.flatnonzero(np.diff(colors)) + 1
+    transition_polarities = np.sign(colors[transition_frames] - colors[transition_frames - 1]).astype(np.int)
+
+    if len(transition_frames) == 0:
+        raise LookupError, 'No indicator transition found in the display log!'
+    if len(onsets) == 0:
+        raise LookupError, 'No photodiode transition found!'
+
+    frame_duration = np.median(np.diff(time_stamp))
+    if tolerance is None:
+        tolerance = frame_duration / 2.
+
+    # coarse offset from the cross-correlation of the two indicator traces
+    display_duration = time_stamp[-1] + frame_duration
+    display_trace = _get_step_trace(time_stamp, colors, display_duration, resolution, colors[0])
+    # photodiode level before the first transition is the opposite of the level after it, the trace is extended
+    # after the last transition by the display duration, so that every transition is a visible edge
+    photodiode_levels = np.cumsum(polarities)
+    photodiode_trace = _get_step_trace(onsets, photodiode_levels, onsets[-1] + display_duration, resolution,
+                                       photodiode_levels[0] - polarities[0])
+    corr = fftconvolve(photodiode_trace, display_trace[::-1], mode='full')
+    offset = (np.argmax(corr) - (len(display_trace) - 1)) * resolution
+
+    # match each transition to the closest photodiode transition with the same polarity
+    predicted = time_stamp[transition_frames] + offset
+    transition_onsets = np.zeros(len(transition_frames)) + np.nan
+    for polarity in [-1, 1]:
+        curr_ind = np.flatnonzero(transition_polarities == polarity)
+        curr_onsets = onsets[polarities == polarity]
+        if len(curr_ind) == 0 or len(curr_onsets) == 0:
+            continue
+        right = np.searchsorted(curr_onsets, predicted[curr_ind])
+        left = np.clip(right - 1, 0, len(curr_onsets) - 1)
+        right = np.clip(right, 0, len(curr_onsets) - 1)
+        closest = np.where(np.abs(curr_onsets[left] - predicted[curr_ind]) <=
+                           np.abs(curr_onsets[right] - predicted[curr_ind]), left, right)
+        matched = curr_onsets[closest]
+        is_matched = np.abs(matched - predicted[curr_ind]) <= tolerance
+        transition_onsets[curr_ind[is_matched]] = matched[is_matched]
+
+    is_matched = ~np.isnan(transition_onsets)
+    if not is_matched.any():
+        raise LookupError, 'Can not match any photodiode transition to the display log!'
+
+    residuals = transition_onsets[is_matched] - predicted[is_matched]
+    frame_onsets = time_stamp + offset + np.interp(np.arange(len(time_stamp)), transition_frames[is_matched],
+                                                   residuals)
+
+    return {'frame_onsets': frame_onsets,
+            'offset': offset,
+            'transition_frames': transition_frames,
+            'transition_onsets': transition_onsets,
+            'match_ratio': np.mean(is_matched)}
+
+
+def get_frame_onsets(photodiode, sf, log, thr_low=None, thr_high=None, **kwargs):
+    """
+    detect photodiode transitions and align them with a display log, see get_photodiode_transitions and
+    align_photodiode_to_log
+
+    :param photodiode: 1d array, photodiode trace, can be a memory mapped channel (FileTools.RawJPhysReader)
+    :param sf: sampling rate, Hz
+    :param log: display log dictionary saved by DisplaySequence.save_log
+    :param kwargs: other parameters of align_photodiode_to_log
+    :return: dictionary, see align_photodiode_to_log
+    """
+
+    onsets, polarities = get_photodiode_transitions(photodiode, sf, thr_low=thr_low, thr_high=thr_high)
+    return align_photodiode_to_log(onsets, polarities, log, **kwargs)
@@ -162,6 +162,116 @@ def importRawJCam(path,
     return imageFile, exposureTime
 
 
+def getRawJCamHeader(path,
+                     dtype=np.dtype('>f'),
+                     headerLength=96,  # length of the header, measured as the data type defined above
+                     columnNumIndex=14,  # index of number of rows in header
+                     rowNumIndex=15,  # index of number of columns in header
+                     frameNumIndex=16,  # index of number of frames in header
+                     decimation=None,  # decimation number
+                     exposureTimeIndex=17):  # index of exposure time in header, exposure time is measured in ms
+    """
+    read only the header of a raw JCam file (same format as importRawJCam)
+
+    return: dictionary {'columnNum', 'rowNum', 'frameNum', 'exposureTime' (ms), 'headerLength', 'dtype'}
+    """
+
+    header = readBinaryFile(path, 0, count=headerLength, dtype=dtype)
+
+    columnNum = np.int(header[columnNumIndex])
+    rowNum = np.int(header[rowNumIndex])
+
+    if decimation is not None:
+        columnNum /= decimation
+        rowNum /= decimation
+
+    frameNum = np.int(header[frameNumIndex])
+
+    if frameNum == 0:  # if it is a single frame image
+        frameNum += 1
+
+    return {'columnNum': columnNum,
+            'rowNum': rowNum,
+            'frameNum': frameNum,
+            'exposureTime': np.float(header[exposureTimeIndex]),
+            'headerLength': headerLength,
+            'dtype': dtype}
+
+
+def iterRawJCam(path, chunkFrameNum=100, **kwargs):
+    """
+    read a raw JCam file (same format as importRawJCam) chunk by chunk, only one chunk is in memory at a time
+
+    :param chunkFrameNum: number of frames in each chunk
+    :param kwargs: header definitions, see getRawJCamHeader
+    :return: generator of (index of the first frame in the chunk, chunk as 3d array (frame, row, column))
+    """
+
+    reader = RawJCamReader(path, **kwargs)
+    try:
+        for startFrame in range(0, len(reader), chunkFrameNum):
+            yield startFrame, reader[startFrame:startFrame + chunkFrameNum]
+    finally:
+        reader.close()
+
+
+class RawJCamReader(object):
+    """
+    memory mapped reader of a raw JCam file (same format as importRawJCam), nothing is read until the reader is
+    sliced, so movies larger than the memory can be handled. Slicing works the same way as a 3d array
+    (frame, row, column) and returns an in-memory array in native byte order. It has the 'shape' attribute and
+    frame slicing used by the get_trace_binaryslicer* functions in ImageAnalysis.
+
+    :param path: path of the raw JCam file
+    :param kwargs: header definitions, see getRawJCamHeader. Decimation has the same meaning as in importRawJCam:
+                   the frame size in the header is divided by it.
+    """
+
+    def __init__(self, path, **kwargs):
+
+        self.path = path
+        self.header = getRawJCamHeader(path, **kwargs)
+
+        dtype = np.dtype(self.header['dtype'])
+        shape = (self.header['frameNum'], self.header['rowNum'], self.header['columnNum'])
+        offset = self.header['headerLength'] * dtype.itemsize
+
+        if os.path.getsize(path) < offset + np.prod(shape) * dtype.itemsize:
+            raise ValueError, 'File "' + path + '" is shorter than the movie size defined in its header!'
+
+        self.data = np.memmap(path, dtype=dtype, mode='r', offset=offset, shape=shape)
+
+    @property
+    def shape(self):
+        return self.data.shape
+
+    @property
+    def dtype(self):
+        return self.data.dtype.newbyteorder('=')
+
+    @property
+    def exposureTime(self):
+        return self.header['exposureTime']
+
+    def __len__(self):
+        return self.data.shape[0]
+
+    def __getitem__(self, key):
+        return self.data[key].astype(self.dtype)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def close(self):
+        """
+        release the memory map, the reader can not be sliced afterwards
+        """
+        self.data = None
+
+
 def readBinaryFile(path,
                    position,
                    count=1,
@@ -194,6 +304,241 @@ def readBinaryFile2(f,
     return data
 
 
+class RawJCamFReader(RawJCamReader):
+    """
+    memory mapped reader of a raw JCamF file (same format as importRawJCamF): little-endian uint16 by default, the
+    frame size is not saved in the header and is given by column and row, a tailer follows the movie. Slicing works
+    the same way as RawJCamReader, with axes (frame, column, row) as in importRawJCamF.
+
+    :param frame: number of frames to read, if None, all frames between header and tailer
+    """
+
+    def __init__(self,
+                 path,
+                 dtype=np.dtype('<u2'),
+                 headerLength=116,
+                 tailerLength=218,
+                 column=2048,
+                 row=2048,
+                 frame=None):
+
+        self.path = path
+        dtype = np.dtype(dtype)
+        valueNum = os.path.getsize(path) // dtype.itemsize
+
+        if frame is None:
+            frame = (valueNum - headerLength - tailerLength) // (column * row)
+        elif headerLength + frame * column * row > valueNum:
+            raise ValueError, 'File "' + path + '" is shorter than ' + str(frame) + ' frame(s)!'
+
+        if frame < 1:
+            raise ValueError, 'File "' + path + '" does not contain any frame!'
+
+        self.header = {'columnNum': column,
+                       'rowNum': row,
+                       'frameNum': frame,
+                       'exposureTime': None,
+                       'headerLength': headerLength,
+                       'tailerLength': tailerLength,
+                       'dtype': dtype}
+
+        self.data = np.memmap(path, dtype=dtype, mode='r', offset=headerLength * dtype.itemsize,
+                              shape=(frame, column, row))
+
+    def getHeader(self):
+        """
+        :return: 1d array, values of the header
+        """
+        return readBinaryFile(self.path, 0, count=self.header['headerLength'], dtype=self.header['dtype'])
+
+    def getTailer(self):
+        """
+        :return: 1d array, values of the tailer (the last tailerLength values of the file)
+        """
+        tailerLength = self.header['tailerLength']
+        if tailerLength == 0:
+            return np.array([], dtype=self.header['dtype'])
+        return readBinaryFile(self.path, -tailerLength, count=tailerLength, dtype=self.header['dtype'],
+                              whence=os.SEEK_END)
+
+
+class RawJPhysReader(object):
+    """
+    memory mapped reader of a raw JPhys file, nothing is read until a channel is sliced. Supports both the old style
+    layout (importRawJPhys, channels stored one after another) and the new style layout (importRawNewJPhys, samples of
+    all channels interleaved). Each channel is a (strided) view of the memory map.
+
+    :param path: path of the raw JPhys file
+    :param channels: names of all channels in the file
+    :param isInterleaved: False for old style files, True for new style files
+    :param headerLength: length of the header for each channel
+    :param sf: sampling rate, Hz
+    """
+
+    def __init__(self,
+                 path,
+                 channels=('photodiode2', 'read', 'trigger', 'photodiode'),
+                 isInterleaved=False,
+                 headerLength=96,
+                 dtype=np.dtype('>f'),
+                 sf=10000.):
+
+        self.path = path
+        self.channels = tuple(channels)
+        self.isInterleaved = isInterleaved
+        self.headerLength = headerLength
+        self.sf = sf
+
+        dtype = np.dtype(dtype)
+        channelNum = len(self.channels)
+        valueNum = os.path.getsize(path) // dtype.itemsize
+        channelLength = valueNum // channelNum
+
+        if valueNum % channelNum != 0 or os.path.getsize(path) % dtype.itemsize != 0:
+            raise ArithmeticError, 'Length of the file should be divisible by channel number!'
+
+        if channelLength < headerLength:
+            raise ValueError, 'File "' + path + '" is shorter than the headers of all channels!'
+
+        if isInterleaved:
+            self.data = np.memmap(path, dtype=dtype, mode='r', shape=(channelLength, channelNum)).T
+        else:
+            self.data = np.memmap(path, dtype=dtype, mode='r', shape=(channelNum, channelLength))
+
+    def __len__(self):
+        return self.data.shape[1] - self.headerLength
+
+    def __getitem__(self, channel):
+        return self.getChannel(channel)
+
+    @property
+    def duration(self):
+        """
+        recording duration, second
+        """
+        return len(self) / float(self.sf)
+
+    def getTimeStamps(self, indStart=0, indEnd=None):
+        """
+        :return: 1d array, time (second) of the samples from indStart to indEnd (if None, to the end) of each channel
+        """
+        if indEnd is None:
+            indEnd = len(self)
+        return np.arange(indStart, min(indEnd, len(self))) / float(self.sf)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def _getIndex(self, channel):
+        if channel not in self.channels:
+            raise LookupError, 'Can not find channel "' + str(channel) + '" in ' + str(self.channels) + '!'
+        return self.channels.index(channel)
+
+    def getHeader(self, channel):
+        """
+        :return: header of one channel, as an in memory array
+        """
+        return np.array(self.data[self._getIndex(channel), :self.headerLength])
+
+    def getChannel(self, channel):
+        """
+        :return: body of one channel, as a memory mapped 1d view (strided for new style files)
+        """
+        return self.data[self._getIndex(channel), self.headerLength:]
+
+    def getChannels(self, channels=None):
+        """
+        :param channels: names of the channels, if None, all channels
+        :return: dictionary {channel name: memory mapped 1d view}
+        """
+        if channels is None:
+            channels = self.channels
+        return {channel: self.getChannel(channel) for channel in channels}
+
+    def iterChunks(self, channels=None, chunkLength=100000):
+        """
+        read the selected channels chunk by chunk, only one chunk is in memory at a time
+
+        :param channels: names of the channels, if None, all channels
+        :param chunkLength: number of samples in each chunk
+        :return: generator of (index of the first sample in the chunk, {channel name: 1d array in native byte order})
+        """
+        views = self.getChannels(channels)
+        for chunkStart in range(0, len(self), chunkLength):
+            yield chunkStart, {channel: view[chunkStart:chunkStart + chunkLength].astype(view.dtype.newbyteorder('='))
+                               for channel, view in views.iteritems()}
+
+    def close(self):
+        """
+        release the memory map, the reader can not be used afterwards
+        """
+        self.data = None
+
+
+def memmapRawJPhys(path,
+                   dtype=np.dtype('>f'),
+                   headerLength=96,  # length of the header for each channel
+                   channels=('photodiode2', 'read', 'trigger', 'photodiode'),  # name of all channels
+                   isInterleaved=False):
+    """
+    memory map the body of each channel of a raw JPhys file, nothing is read until the returned arrays are sliced
+
+    :param isInterleaved: False for old style files (importRawJPhys), channels stored one after another;
+                          True for new style files (importRawNewJPhys), samples of all channels interleaved
+    :return: dictionary {channel name: 1d memmap of the channel body}
+    """
+
+    reader = RawJPhysReader(path, channels=channels, isInterleaved=isInterleaved, headerLength=headerLength,
+                            dtype=dtype)
+    return reader.getChannels()
+
+
+def getRisingEdges(trace, thr=3.0, chunkLength=1000000):
+    """
+    find indices of rising edges of a trace: trace[i-1] < thr and trace[i] >= thr. The trace is processed chunk by
+    chunk, so it can be a memory mapped channel (memmapRawJPhys)
+
+    :param chunkLength: number of samples loaded each time
+    :return: 1d array of indices
+    """
+
+    edges = []
+    for chunkStart in range(1, len(trace), chunkLength):
+        chunk = np.asarray(trace[chunkStart - 1:chunkStart + chunkLength]) >= thr
+        edges.append(np.flatnonzero(chunk[1:] & ~chunk[:-1]) + chunkStart)
+
+    if edges:
+        return np.concatenate(edges)
+    else:
+        return np.array([], dtype=np.int)
+
+
+def getPhotodiodeOnset(trace, thr=.95, lookBack=75, startIndex=80, chunkLength=1000000):
+    """
+    find the first sample (index >= startIndex) of a big change of the photodiode signal: the signal crosses thr
+    between sample i-1 and i, and sample i-lookBack is on the other side of thr than sample i. The trace is processed
+    chunk by chunk, so it can be a memory mapped channel (memmapRawJPhys)
+
+    :param chunkLength: number of samples loaded each time
+    :return: index of the onset, None if not found
+    """
+
+    if startIndex < lookBack:
+        raise ValueError, 'startIndex should not be smaller than lookBack!'
+
+    for chunkStart in range(startIndex, len(trace), chunkLength):
+        chunk = np.asarray(trace[chunkStart - lookBack:chunkStart + chunkLength], dtype=np.float) - thr
+        curr = chunk[lookBack:]
+        isOnset = (curr * chunk[lookBack - 1:-1] < 0) & (curr * chunk[:-lookBack] < 0)
+        if isOnset.any():
+            return chunkStart + int(np.argmax(isOnset))
+
+    return None
+
+
 def importRawJPhys(path,
                    dtype=np.dtype('>f'),
                    headerLength=96,  # length of the header for each channel
@@ -286,53 +631,10 @@ def importRawJPhys2(path,
     extract important information from JPhys file
     """
 
-    JPhysFile = np.fromfile(path, dtype=dtype, count=-1)
-    channelNum = len(channels)
-
-    channelLength = len(JPhysFile) / channelNum
-
-    if channelLength % 1 != 0:
-        raise ArithmeticError, 'Bytes in each channel should be integer !'
-
-    channelLength = int(channelLength)
-
-    # get trace for each channel
-    for index, channelname in enumerate(channels):
-        channelStart = index * channelLength
-        channelEnd = channelStart + channelLength
-        #        if channelname == 'expose':
-        #            expose = JPhysFile[channelStart+headerLength:channelEnd]
-
-        if channelname == 'read':
-            read = JPhysFile[channelStart + headerLength:channelEnd]
-
-        if channelname == 'photodiode':
-            photodiode = JPhysFile[channelStart + headerLength:channelEnd]
-
-        #        if channelname == 'trigger':
-        #            trigger = JPhysFile[channelStart+headerLength:channelEnd]
-
-    # generate time stamp for each image frame
-    imageFrameTS = []
-    for i in range(1, len(read)):
-        if read[i - 1] < 3.0 and read[i] >= 3.0:
-            imageFrameTS.append(i * (1. / sf))
-
-    if len(imageFrameTS) < imageFrameNum:
-        raise LookupError, "Expose period number is smaller than image frame number!"
-    imageFrameTS = imageFrameTS[0:imageFrameNum]
-
-    # first time of visual stimulation
-    visualStart = None
-
-    for i in xrange(80, len(photodiode)):
-        if ((photodiode[i] - photodiodeThr) * (photodiode[i - 1] - photodiodeThr)) < 0 and \
-                        ((photodiode[i] - photodiodeThr) * (
-                            photodiode[i - 75] - photodiodeThr)) < 0:  # first frame of big change
-            visualStart = i * (1. / sf)
-            break
+    reader = RawJPhysReader(path, channels=channels, isInterleaved=False, headerLength=headerLength, dtype=dtype,
+                            sf=sf)
 
-    return np.array(imageFrameTS), visualStart
+    return _getJPhysTimeStamps(reader, imageFrameNum, photodiodeThr)
 
 
 def importRawNewJPhys2(path,
@@ -355,51 +657,32 @@ def importRawNewJPhys2(path,
     extract important information from new style JPhys file
     """
 
-    JPhysFile = np.fromfile(path, dtype=dtype, count=-1)
-    channelNum = len(channels)
+    reader = RawJPhysReader(path, channels=channels, isInterleaved=True, headerLength=headerLength, dtype=dtype,
+                            sf=sf)
 
-    channelLength = len(JPhysFile) / channelNum
+    return _getJPhysTimeStamps(reader, imageFrameNum, photodiodeThr)
 
-    if len(JPhysFile) % channelNum != 0:
-        raise ArithmeticError, 'Length of the file should be divisible by channel number!'
-
-    JPhysFile = JPhysFile.reshape([channelLength, channelNum])
 
-    bodyMatrix = JPhysFile[headerLength:, :]
-
-    # get trace for each channel
-    for index, channelname in enumerate(channels):
-
-        if channelname == 'read':
-            read = bodyMatrix[:, index]
-
-        if channelname == 'photodiode':
-            photodiode = bodyMatrix[:, index]
+def _getJPhysTimeStamps(reader, imageFrameNum, photodiodeThr):
+    """
+    time stamps of image frames (rising edges of the read channel) and time of the first visual stimulation
+    (photodiode onset) for importRawJPhys2 and importRawNewJPhys2
 
-        #        if channelname == 'trigger':
-        #            trigger = JPhysFile[channelStart+headerLength:channelEnd]
+    :param reader: RawJPhysReader of the file
+    """
 
-    # generate time stamp for each image frame
-    imageFrameTS = []
-    for i in range(1, len(read)):
-        if (read[i - 1] < 3.0) and (read[i] >= 3.0):
-            imageFrameTS.append(i * (1. / sf))
+    imageFrameTS = getRisingEdges(reader['read'], thr=3.0)
 
     if len(imageFrameTS) < imageFrameNum:
         raise LookupError, "Expose period number is smaller than image frame number!"
-    imageFrameTS = imageFrameTS[0:imageFrameNum]
+    imageFrameTS = imageFrameTS[0:imageFrameNum] * (1. / reader.sf)
 
     # first time of visual stimulation
-    visualStart = None
-
-    for i in xrange(80, len(photodiode)):
-        if ((photodiode[i] - photodiodeThr) * (photodiode[i - 1] - photodiodeThr)) < 0 and \
-                        ((photodiode[i] - photodiodeThr) * (
-                            photodiode[i - 75] - photodiodeThr)) < 0:  # first frame of big change
-            visualStart = i * (1. / sf)
-            break
+    visualStart = getPhotodiodeOnset(reader['photodiode'], thr=photodiodeThr, lookBack=75, startIndex=80)
+    if visualStart is not None:
+        visualStart = visualStart * (1. / reader.sf)
 
-    return np.array(imageFrameTS), visualStart
+    return imageFrameTS, visualStart
 
 
 def getLog(logPath):
@@ -483,17 +766,15 @@ def importRawJCamF(path,
                    row=2048,
                    frame=None,  # how many frame to read
                    crop=None):
+    reader = RawJCamFReader(path, dtype=dtype, headerLength=headerLength, tailerLength=tailerLength,
+                            column=column, row=row, frame=frame)
+    header = reader.getHeader()
     if frame:
-        data = np.fromfile(path, dtype=dtype, count=frame * column * row + headerLength)
-        header = data[0:headerLength]
         tailer = []
-        mov = data[headerLength:].reshape((frame, column, row))
     else:
-        data = np.fromfile(path, dtype=dtype)
-        header = data[0:headerLength]
-        tailer = data[len(data) - tailerLength:len(data)]
-        frame = (len(data) - headerLength - tailerLength) / (column * row)
-        mov = data[headerLength:len(data) - tailerLength].reshape((frame, column, row))
+        tailer = reader.getTailer()
+    mov = reader[:]
+    reader.close()
 
     if saveFolder:
         if crop:
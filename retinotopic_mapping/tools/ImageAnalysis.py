@@ -1,9 +1,12 @@
 __author__ = 'junz'
 
+import threading
+import Queue
 import matplotlib.pyplot as plt
 import numpy as np
 from scipy import interpolate
 import scipy.ndimage as ni
+import scipy.sparse as sparse
 import skimage.morphology as sm
 import FileTools as ft
 import PlottingTools as pt
@@ -332,6 +335,87 @@ def rotate_image(img, angle, borderValue=0.0):
     return newImg
 
 
+def get_center_rotate_matrix(centerPixel, angle, newSize=512):
+    """
+    affine matrix of center_image (with centerPixel and newSize) followed by rotate_image (with angle), composed
+    into one 2 x 3 matrix for cv2.warpAffine
+
+    :param centerPixel: the coordinates of center pixel in original image, same as center_image
+    :param angle: rotation angle conterclock wise, degree
+    :param newSize: the size of output image
+    :return: 2 x 3 affine matrix, np.float64
+    """
+
+    x = newSize / 2 - centerPixel[1]
+    y = newSize / 2 - centerPixel[0]
+
+    R = cv2.getRotationMatrix2D((newSize / 2, newSize / 2), angle, 1)
+
+    M = np.array(R, dtype=np.float64)
+    M[:, 2] = np.dot(R[:, :2], [x, y]) + R[:, 2]
+
+    return M
+
+
+def warp_image_stack(imgs, M, outputShape, borderValue=0., interpolation='linear'):
+    """
+    apply one affine transformation to a stack of 2d images in one cv2.warpAffine call (images are warped as
+    channels, up to 512 per call)
+
+    :param imgs: 3d array, (N, height, width)
+    :param M: 2 x 3 affine matrix
+    :param outputShape: the shape of output image, (height, width)
+    :param borderValue: value for empty pixels
+    :param interpolation: 'linear' or 'nearest', use 'nearest' to keep the values of label or integer images
+    :return: 3d array, (N, outputShape[0], outputShape[1]), np.float64
+    """
+
+    if len(imgs.shape) != 3:
+        raise ValueError, 'Input should be a 3d array (N, height, width)!'
+
+    if interpolation == 'linear':
+        flags = cv2.INTER_LINEAR
+    elif interpolation == 'nearest':
+        flags = cv2.INTER_NEAREST
+    else:
+        raise ValueError, 'interpolation should be "linear" or "nearest"!'
+
+    # opencv only uses the first channel of a scalar border value, warp the difference to borderValue instead.
+    # interpolation weights sum to one so the values are not changed.
+    channels = np.transpose(imgs, (1, 2, 0)).astype(np.float64) - borderValue
+
+    chunkSize = 512
+    newImgs = np.empty((imgs.shape[0], outputShape[0], outputShape[1]), dtype=np.float64)
+    for i in range(0, imgs.shape[0], chunkSize):
+        newChunk = cv2.warpAffine(np.ascontiguousarray(channels[:, :, i:i + chunkSize]), M,
+                                  (outputShape[1], outputShape[0]), flags=flags, borderValue=0.)
+        if len(newChunk.shape) == 2:
+            newChunk = newChunk[:, :, None]
+        newImgs[i:i + chunkSize] = np.transpose(newChunk, (2, 0, 1))
+
+    return newImgs + borderValue
+
+
+def center_rotate_image_stack(imgs, centerPixel, angle, newSize=512, borderValue=0., interpolation='linear'):
+    """
+    center and rotate a stack of 2d images in one warp, same as center_image followed by rotate_image on every
+    image. Since the two steps are composed, corners of the output that would be cut by the intermediate centered
+    canvas are filled with original pixels if there are any.
+
+    :param imgs: 3d array, (N, height, width), or list of 2d arrays with the same shape
+    :param centerPixel: the coordinates of center pixel in original image, same as center_image
+    :param angle: rotation angle conterclock wise, degree
+    :param newSize: the size of output image
+    :param borderValue: value for empty pixels
+    :param interpolation: 'linear' or 'nearest', see warp_image_stack
+    :return: 3d array, (N, newSize, newSize), np.float64
+    """
+
+    M = get_center_rotate_matrix(centerPixel, angle, newSize=newSize)
+    return warp_image_stack(np.asarray(imgs), M, (newSize, newSize), borderValue=borderValue,
+                            interpolation=interpolation)
+
+
 def rigid_transform(img, zoom=None, rotation=None, offset=None, outputShape=None, mode='constant', cval=0.0):
     """
     rigid transformation of a 2d-image or 3d-matrix by using scipy
@@ -454,44 +538,51 @@ def rigid_transform_cv2(img, zoom=None, rotation=None, offset=None, outputShape=
 
 def boxcartime_dff(data,
                    window,  # boxcar size in seconds
-                   fs  # sample rate in ms
+                   fs,  # sample rate in ms
+                   tile_pixel_num=None,  # number of pixels processed each time
+                   dtype=np.float64  # data type of output
                    ):
     """
     Created on Mon Nov 24 14:37:02 2014
 
     [dff] = boxcartime_dff(data[t,y,x], rollingwindow[in s], samplerate[in ms])
-    boxcar average uses scipy.signal package, imported locally
+
+    the baseline of frame n is the boxcar average of frames n+1 to n+win (win = ceil(window / exposure)), the output
+    frame n is the df/f of frame n + win/2 over this baseline, so the output has win frames less than the input.
+    The moving average is computed with cumulative sums over tiles of pixels, so memory use is bounded and the input
+    can be a memory mapped movie.
+
+    :param tile_pixel_num: number of pixels in each tile, if None, about 2**24 values per tile
+    :param dtype: data type of output, e.g. np.float32 to halve the memory of the output
 
     @author: mattv
     """
-    import scipy.signal as sig
 
     if data.ndim != 3:
         raise LookupError, 'input images must be a 3-dim array format [t,y,x]'
 
-    exposure = np.float(fs / 1000)  # convert exposure from ms to s
-    win = np.float(window)
-    win = win / exposure
-    win = np.ceil(win)
-
-    # rolling average
-    kernal = np.ones(win, dtype=('float'))
-    padsize = data.shape[0] + win * 2
-    mov_ave = np.zeros([padsize + win - 1], dtype=('float'))
-    mov_pad = np.zeros([padsize], dtype=('float'))
-    mov_dff = np.zeros([data.shape[0] - win, data.shape[1], data.shape[2]])
-    for y in range(data.shape[1]):
-        for x in range(data.shape[2]):
-            # put data within padded array
-            mov_pad[win:(padsize - win)] = data[:, y, x]
-            # moving average by convolution
-            mov_ave = sig.fftconvolve(mov_pad, kernal) / win
-            # cut off pad
-            mov_ave = mov_ave[win * 2:1 + mov_ave.shape[0] - win * 2]
-            # use moving average as f0 for df/f
-            mov_dff[:, y, x] = (data[(win / 2):data.shape[0] - (win / 2), y, x] - mov_ave) / mov_ave
-
-    return mov_dff
+    exposure = np.float(fs) / 1000.  # convert exposure from ms to s
+    win = int(np.ceil(np.float(window) / exposure))
+    frameNum = data.shape[0]
+
+    if win < 1 or win >= frameNum:
+        raise ValueError, 'boxcar window should be at least one frame and shorter than the movie!'
+
+    if tile_pixel_num is None:
+        tile_pixel_num = max(1, 2 ** 24 // frameNum)
+
+    pixels = data.reshape((frameNum, -1))
+    mov_dff = np.empty((frameNum - win, pixels.shape[1]), dtype=dtype)
+    for tile_start in range(0, pixels.shape[1], tile_pixel_num):
+        tile = np.asarray(pixels[:, tile_start:tile_start + tile_pixel_num], dtype=np.float64)
+        # cum_sum[k] is the sum of the first k frames
+        cum_sum = np.zeros((frameNum + 1, tile.shape[1]))
+        np.cumsum(tile, axis=0, out=cum_sum[1:])
+        # moving average of frames n+1 to n+win, use as f0 for df/f
+        mov_ave = (cum_sum[win + 1:] - cum_sum[1:frameNum - win + 1]) / win
+        mov_dff[:, tile_start:tile_start + tile_pixel_num] = (tile[win // 2:win // 2 + frameNum - win] - mov_ave) / mov_ave
+
+    return mov_dff.reshape((frameNum - win,) + data.shape[1:])
 
 
 def normalize_movie(movie,
@@ -525,24 +616,160 @@ def normalize_movie(movie,
     return averageImage, normalizedMovie, dFoverFMovie
 
 
+def _iter_frame_chunks(movie, chunk_frame_num, rows=slice(None)):
+    """
+    iterate through a movie (array or memory map) chunk by chunk, as float64 arrays, only the given rows of each
+    frame are loaded
+    """
+
+    for indStart in range(0, movie.shape[0], chunk_frame_num):
+        yield indStart, np.asarray(movie[indStart:indStart + chunk_frame_num, rows], dtype=np.float64)
+
+
+def get_baseline_image(movie,
+                       baselineType='mean',  # 'mean' or 'median'
+                       chunk_frame_num=100,  # number of frames loaded each time
+                       hist_bin_num=256,  # number of histogram bins for each pixel, only for median
+                       tile_pixel_num=2 ** 13  # number of pixels in each histogram tile, only for median
+                       ):
+    """
+    get baseline image of a movie by reading it chunk by chunk, so the movie can be a memory map larger than memory.
+    The mean is exact. The median is approximated from a histogram of each pixel between its minimum and maximum
+    and interpolated within the median bin, so the error is a fraction of (maximum - minimum) / hist_bin_num.
+
+    For the median, one pass finds the range of each pixel, then the histograms are counted for one tile of frame
+    rows (about tile_pixel_num pixels, at least one row) at a time, with one pass over these rows of the movie per
+    tile. The peak memory of the median is about (16 * hist_bin_num + 24 * chunk_frame_num) * tile_pixel_num bytes
+    (histogram and counts of one chunk, one chunk and its bin indices), about 50 MB with the defaults, independent
+    of the frame size.
+
+    :return: 2d array, float64
+    """
+
+    frameNum = movie.shape[0]
+    frameShape = movie.shape[1:]
+
+    if baselineType == 'mean':
+        sumImage = np.zeros(frameShape)
+        for _, chunk in _iter_frame_chunks(movie, chunk_frame_num):
+            sumImage += np.sum(chunk, axis=0)
+        return sumImage / frameNum
+
+    elif baselineType == 'median':
+        minImage = np.zeros(frameShape) + np.inf
+        maxImage = np.zeros(frameShape) - np.inf
+        for _, chunk in _iter_frame_chunks(movie, chunk_frame_num):
+            minImage = np.minimum(minImage, np.amin(chunk, axis=0))
+            maxImage = np.maximum(maxImage, np.amax(chunk, axis=0))
+        binWidth = (maxImage - minImage) / hist_bin_num
+        binWidth[binWidth == 0] = 1.
+
+        half = frameNum / 2.
+        medianImage = np.zeros(frameShape)
+        tileRowNum = max(1, tile_pixel_num // int(np.prod(frameShape[1:])))
+        for rowStart in range(0, frameShape[0], tileRowNum):
+            rows = slice(rowStart, rowStart + tileRowNum)
+            tileMin = minImage[rows].ravel()
+            tileBinWidth = binWidth[rows].ravel()
+            pixelNum = tileMin.size
+
+            # histogram of all pixels in the tile as one flat array, index: pixel * hist_bin_num + bin
+            binOffset = np.arange(pixelNum) * hist_bin_num
+            hist = np.zeros(pixelNum * hist_bin_num, dtype=np.int64)
+            for _, chunk in _iter_frame_chunks(movie, chunk_frame_num, rows=rows):
+                binInd = ((chunk.reshape((chunk.shape[0], -1)) - tileMin) / tileBinWidth).astype(np.int)
+                binInd = np.clip(binInd, 0, hist_bin_num - 1) + binOffset
+                hist += np.bincount(binInd.ravel(), minlength=hist.size)
+
+            # bin containing the median and fraction of the median position within this bin
+            hist = hist.reshape((pixelNum, hist_bin_num))
+            cumCount = np.cumsum(hist, axis=1, out=hist)
+            medianBin = np.argmax(cumCount >= half, axis=1)
+            pixelInd = np.arange(pixelNum)
+            countBefore = np.where(medianBin > 0, cumCount[pixelInd, np.maximum(medianBin - 1, 0)], 0)
+            binCount = (cumCount[pixelInd, medianBin] - countBefore).astype(np.float)
+            medianImage[rows] = (tileMin + (medianBin + (half - countBefore) / binCount) * tileBinWidth).reshape(
+                medianImage[rows].shape)
+
+        return np.minimum(medianImage, maxImage)
+
+    else:
+        raise LookupError, 'The "baselineType" should be "mean" or "median"!!'
+
+
+def normalize_movie_streaming(movie,
+                              output=None,  # array to save the output
+                              baselinePic=None,  # picture for baseline
+                              baselineType='mean',  # 'mean' or 'median'
+                              isDFoverF=True,  # if True, output dF over F, if False, movie minus baseline
+                              chunk_frame_num=100,  # number of frames processed each time
+                              dtype=np.float32,  # data type of output
+                              hist_bin_num=256,  # number of histogram bins for median baseline
+                              tile_pixel_num=2 ** 13  # number of pixels in each histogram tile for median baseline
+                              ):
+    """
+    out-of-core version of normalize_movie: the baseline is computed chunk by chunk (get_baseline_image, median is
+    approximated) and dF over F (or dF) is written chunk by chunk into output, so apart from the output only the
+    baseline and one chunk are in memory
+
+    :param output: array (e.g. np.memmap) with the same shape as movie, if None, a new array is created
+    :param dtype: data type of output, ignored if output is given
+    :return: baseline image, output
+    """
+
+    if len(movie.shape) != 3:
+        raise LookupError, 'The "movie" array should have 3 dimensions!'
+
+    if baselinePic is not None:
+        if movie.shape[1:] != baselinePic.shape:
+            raise LookupError, 'The shape of "baselinePic" should match the shape of the frame shape of "movie"!'
+        averageImage = baselinePic
+    else:
+        averageImage = get_baseline_image(movie, baselineType=baselineType, chunk_frame_num=chunk_frame_num,
+                                          hist_bin_num=hist_bin_num, tile_pixel_num=tile_pixel_num)
+
+    if output is None:
+        output = np.empty(movie.shape, dtype=dtype)
+    elif output.shape != movie.shape:
+        raise ValueError, 'The "output" array should have the same shape as the "movie" array!'
+
+    for indStart, chunk in _iter_frame_chunks(movie, chunk_frame_num):
+        dFChunk = chunk - averageImage
+        if isDFoverF:
+            dFChunk /= averageImage
+        output[indStart:indStart + chunk.shape[0]] = dFChunk
+
+    return averageImage, output
+
+
 def temporal_filter_movie(mov,  # array of movie
                           Fs,  # sampling rate
                           Flow,  # low cutoff frequency
                           Fhigh,  # high cutoff frequency
-                          mode='box'):  # filter mode, '1/f' or 'box'):
+                          mode='box',  # filter mode, '1/f' or 'box'
+                          tile_pixel_num=None,  # number of pixels filtered each time
+                          dtype=np.float32,  # data type of output
+                          output=None):  # array to save the output
+    """
+    filter each pixel of a movie in frequency domain. Since the movie is real and the filter is symmetric, only the
+    non-negative frequencies are computed (rfft/irfft). The movie is filtered in tiles of pixels, so memory use is
+    bounded and a movie larger than memory can be filtered from a memory map into another memory map (output).
+
+    :param tile_pixel_num: number of pixels in each tile, if None, about 2**24 values per tile
+    :param dtype: data type of output, ignored if output is given
+    :param output: array (e.g. np.memmap) with the same shape as mov to write the filtered movie, if None, a new
+                   array is created
+    :return: filtered movie
+    """
 
     if len(mov.shape) != 3:
         raise LookupError, 'The "mov" array should have 3 dimensions!'
 
     frameNum = mov.shape[0]
-    freqs = np.fft.fftfreq(frameNum, d=(1. / float(Fs)))
-
-    filterArray = np.ones(frameNum)
+    freqs = np.fft.rfftfreq(frameNum, d=(1. / float(Fs)))
 
-    for i in xrange(frameNum):
-        if ((freqs[i] > 0) and (freqs[i] < Flow) or (freqs[i] > Fhigh)) or \
-                ((freqs[i] < 0) and (freqs[i] > -Flow) or (freqs[i] < -Fhigh)):
-            filterArray[i] = 0
+    filterArray = np.ones(len(freqs))
+    filterArray[((freqs > 0) & (freqs < Flow)) | (freqs > Fhigh)] = 0
 
     if mode == '1/f':
         filterArray[1:] = filterArray[1:] / abs(freqs[1:])
@@ -556,15 +783,23 @@ def temporal_filter_movie(mov,  # array of movie
     if Flow == 0:
         filterArray[0] = 1
 
-    movFFT = np.fft.fft(mov, axis=0)
+    if output is None:
+        output = np.empty(mov.shape, dtype=dtype)
+    elif output.shape != mov.shape or not output.flags.c_contiguous:
+        raise ValueError, 'The "output" array should be C contiguous and have the same shape as the "mov" array!'
 
-    for i in xrange(mov.shape[1]):
-        for j in xrange(mov.shape[2]):
-            movFFT[:, i, j] = movFFT[:, i, j] * filterArray
+    if tile_pixel_num is None:
+        tile_pixel_num = max(1, 2 ** 24 // frameNum)
 
-    movF = np.real(np.fft.ifft(movFFT, axis=0))
+    pixels = mov.reshape((frameNum, -1))
+    outputPixels = output.reshape((frameNum, -1))
+    for tileStart in range(0, pixels.shape[1], tile_pixel_num):
+        tile = np.asarray(pixels[:, tileStart:tileStart + tile_pixel_num], dtype=np.float32)
+        tileFFT = np.fft.rfft(tile, axis=0)
+        tileFFT *= filterArray[:, None]
+        outputPixels[:, tileStart:tileStart + tile_pixel_num] = np.fft.irfft(tileFFT, n=frameNum, axis=0)
 
-    return movF
+    return output
 
 
 def generate_rectangle_mask(shape, center, width, height, isplot=False):
@@ -611,14 +846,12 @@ def generate_oval_mask(shape, center, width, height, isplot=False):
     return mask
 
 
-def get_trace(movie, mask, maskMode='binary'):
+def _get_trace_mask(mask, maskMode='binary'):
     """
-    get a trace across a movie with averaged value in a mask
+    check a mask and turn it into weights without nans, see get_trace for maskMode
 
-    maskMode: 'binary': ones in roi, zeros outside
-              'binaryNan': ones in roi, nans outside
-              'weighted': weighted values in roi, zeros outside (note: all pixels equal to zero will be considered outside roi
-              'weightedNan': weighted values in roi, nans outside
+    :return: finalMask: weights of each pixel, zeros outside roi
+             pixelNum: number of pixels in roi
     """
 
     if maskMode == 'binary':
@@ -647,11 +880,74 @@ def get_trace(movie, mask, maskMode='binary'):
     else:
         raise LookupError, 'maskMode not understood. Should be one of "binary", "binaryNan", "weighted", "weightedNan".'
 
+    return finalMask, pixelNum
+
+
+def get_trace(movie, mask, maskMode='binary'):
+    """
+    get a trace across a movie with averaged value in a mask
+
+    maskMode: 'binary': ones in roi, zeros outside
+              'binaryNan': ones in roi, nans outside
+              'weighted': weighted values in roi, zeros outside (note: all pixels equal to zero will be considered outside roi
+              'weightedNan': weighted values in roi, nans outside
+    """
+
+    finalMask, pixelNum = _get_trace_mask(mask, maskMode=maskMode)
+
     trace = np.sum(np.multiply(movie, finalMask), (1, 2)) / pixelNum
 
     return trace
 
 
+def get_roi_weight_matrix(masks, mask_mode='binary'):
+    """
+    build one sparse weight matrix for many rois, so that all traces can be extracted with one matrix multiplication
+    (see get_traces). Each row is the flattened mask of one roi divided by its pixel number, so the traces are the
+    same as from get_trace
+
+    :param masks: list of 2d masks with the same shape
+    :param mask_mode: same as 'maskMode' in function get_trace
+    :return: scipy.sparse.csr_matrix, shape (roi number, pixel number), rows of empty masks are all zeros
+    """
+
+    rows = []
+    cols = []
+    weights = []
+    for i, mask in enumerate(masks):
+        if len(mask.shape) != 2: raise ValueError, 'Mask should be 2d!'
+        if mask.shape != masks[0].shape: raise ValueError, 'All masks should have the same shape!'
+        finalMask, pixelNum = _get_trace_mask(mask, maskMode=mask_mode)
+        pixelInd = np.flatnonzero(finalMask)
+        if pixelNum > 0:
+            rows.append(np.zeros(len(pixelInd), dtype=np.int) + i)
+            cols.append(pixelInd)
+            weights.append(finalMask.flat[pixelInd] / float(pixelNum))
+
+    shape = (len(masks), masks[0].size if len(masks) > 0 else 0)
+    if len(rows) == 0:
+        return sparse.csr_matrix(shape)
+    return sparse.csr_matrix((np.concatenate(weights), (np.concatenate(rows), np.concatenate(cols))), shape=shape)
+
+
+def get_traces(movie, weight_matrix):
+    """
+    extract traces of many rois from a movie with a single sparse matrix multiplication, only roi pixels are read
+
+    :param movie: 3d array, (frame, row, column)
+    :param weight_matrix: sparse weight matrix from get_roi_weight_matrix
+    :return: 2d array, (roi, frame), traces of empty rois are nans
+    """
+
+    frames = np.asarray(movie).reshape((movie.shape[0], -1))
+    if frames.shape[1] != weight_matrix.shape[1]:
+        raise ValueError, 'the size of each frame of the movie should be the same as the size of masks'
+
+    traces = np.asarray(weight_matrix.dot(frames.T), dtype=np.float)
+    traces[np.diff(weight_matrix.indptr) == 0] = np.nan
+    return traces
+
+
 def get_trace_binaryslicer(bl_obj, mask, mask_mode='binary'):
     """
 
@@ -720,7 +1016,7 @@ def get_trace_binaryslicer(bl_obj, mask, mask_mode='binary'):
     return get_trace(mov, finalMask, maskMode='weighted')
 
 
-def get_trace_binaryslicer2(bl_obj, mask, mask_mode='binary', loading_frame_num=1000):
+def get_trace_binaryslicer2(bl_obj, mask, mask_mode='binary', loading_frame_num=1000, progress_callback=None):
     """
 
     get trace for a given mask from a BinarySlicer object, by loading chunk each time
@@ -729,6 +1025,8 @@ def get_trace_binaryslicer2(bl_obj, mask, mask_mode='binary', loading_frame_num=
     :param mask: the mask
     :param mask_mode: same as 'mask_mode' in function get_trace
     :param loading_frame_num: frame number of each chunk
+    :param progress_callback: function called with (index of the first frame, index after the last frame, total
+                              frame number) after each chunk is processed, if None, the progress is printed
 
     maskMode: 'binary': ones in roi, zeros outside
               'binaryNan': ones in roi, nans outside
@@ -746,30 +1044,35 @@ def get_trace_binaryslicer2(bl_obj, mask, mask_mode='binary', loading_frame_num=
 
     frameNum = bl_obj.shape[0]
 
-    print '\nInput movie shape:', bl_obj.shape
-
     chunkNum = frameNum // loading_frame_num
-    if frameNum % loading_frame_num == 0:
-        print 'Translating in chunks: ' + str(chunkNum) + ' x ' + str(loading_frame_num) + ' frame(s)'
-    else:
+    if frameNum % loading_frame_num != 0:
         chunkNum += 1
-        print 'Translating in chunks: ' + str(chunkNum - 1) + ' x ' + str(
-            loading_frame_num) + ' frame(s)' + ' + ' + str(frameNum % loading_frame_num) + ' frame(s)'
+
+    if progress_callback is None:
+        print '\nInput movie shape:', bl_obj.shape
+        if frameNum % loading_frame_num == 0:
+            print 'Translating in chunks: ' + str(chunkNum) + ' x ' + str(loading_frame_num) + ' frame(s)'
+        else:
+            print 'Translating in chunks: ' + str(chunkNum - 1) + ' x ' + str(
+                loading_frame_num) + ' frame(s)' + ' + ' + str(frameNum % loading_frame_num) + ' frame(s)'
 
     traces = []
     for i in range(chunkNum):
         indStart = i * loading_frame_num
         indEnd = (i + 1) * loading_frame_num
         if indEnd > frameNum: indEnd = frameNum
-        print 'Extracting signal from frame ' + str(indStart) + ' to frame ' + str(indEnd) + '.\t' + str(
-            i * 100. / chunkNum) + '%'
+        if progress_callback is None:
+            print 'Extracting signal from frame ' + str(indStart) + ' to frame ' + str(indEnd) + '.\t' + str(
+                i * 100. / chunkNum) + '%'
         currMov = bl_obj[indStart:indEnd, :, :]
         traces.append(get_trace(currMov, mask, maskMode=mask_mode))
+        if progress_callback is not None:
+            progress_callback(indStart, indEnd, frameNum)
 
     return np.concatenate(traces)
 
 
-def get_trace_binaryslicer3(bl_obj, masks, mask_mode='binary', loading_frame_num=1000):
+def get_trace_binaryslicer3(bl_obj, masks, mask_mode='binary', loading_frame_num=1000, progress_callback=None):
     """
 
     get trace for a given mask from a BinarySlicer object, by loading chunk each time
@@ -778,6 +1081,8 @@ def get_trace_binaryslicer3(bl_obj, masks, mask_mode='binary', loading_frame_num
     :param masks: a dictionary of masks
     :param mask_mode: same as 'mask_mode' in function get_trace
     :param loading_frame_num: frame number of each chunk
+    :param progress_callback: function called with (index of the first frame, index after the last frame, total
+                              frame number) after each chunk is processed, if None, the progress is printed
 
     maskMode: 'binary': ones in roi, zeros outside
               'binaryNan': ones in roi, nans outside
@@ -792,36 +1097,146 @@ def get_trace_binaryslicer3(bl_obj, masks, mask_mode='binary', loading_frame_num
 
     frameNum = bl_obj.shape[0]
 
-    print '\nInput movie shape:', bl_obj.shape
-
     chunkNum = frameNum // loading_frame_num
-    if frameNum % loading_frame_num == 0:
-        print 'Translating in chunks: ' + str(chunkNum) + ' x ' + str(loading_frame_num) + ' frame(s)'
-    else:
+    if frameNum % loading_frame_num != 0:
         chunkNum += 1
-        print 'Translating in chunks: ' + str(chunkNum - 1) + ' x ' + str(
-            loading_frame_num) + ' frame(s)' + ' + ' + str(frameNum % loading_frame_num) + ' frame(s)'
 
-    traces = {}
-    for key in masks.iterkeys(): traces.update({'trace_' + key: []})
+    if progress_callback is None:
+        print '\nInput movie shape:', bl_obj.shape
+        if frameNum % loading_frame_num == 0:
+            print 'Translating in chunks: ' + str(chunkNum) + ' x ' + str(loading_frame_num) + ' frame(s)'
+        else:
+            print 'Translating in chunks: ' + str(chunkNum - 1) + ' x ' + str(
+                loading_frame_num) + ' frame(s)' + ' + ' + str(frameNum % loading_frame_num) + ' frame(s)'
+
+    keys = masks.keys()
+    for key in keys:
+        mask = masks[key]
+        if len(mask.shape) != 2: raise ValueError, 'Mask "' + key + '" should be 2d!'
+        if bl_obj.shape[1] != mask.shape[0] or bl_obj.shape[2] != mask.shape[1]:
+            raise ValueError, 'the size of each frame of the BinarySlicer object should be the same as the size of mask "' + key + '"!'
+    weightMatrix = get_roi_weight_matrix([masks[key] for key in keys], mask_mode=mask_mode)
 
+    traces = []
     for i in range(chunkNum):
         indStart = i * loading_frame_num
         indEnd = (i + 1) * loading_frame_num
         if indEnd > frameNum: indEnd = frameNum
-        print 'Extracting signal from frame ' + str(indStart) + ' to frame ' + str(indEnd) + '.\t' + str(
-            i * 100. / chunkNum) + '%'
+        if progress_callback is None:
+            print 'Extracting signal from frame ' + str(indStart) + ' to frame ' + str(indEnd) + '.\t' + str(
+                i * 100. / chunkNum) + '%'
         currMov = bl_obj[indStart:indEnd, :, :]
-        for key, mask in masks.iteritems():
-            if len(mask.shape) != 2: raise ValueError, 'Mask "' + key + '" should be 2d!'
-            if bl_obj.shape[1] != mask.shape[0] or bl_obj.shape[2] != mask.shape[1]:
-                raise ValueError, 'the size of each frame of the BinarySlicer object should be the same as the size of mask "' + key + '"!'
-            traces['trace_' + key].append(get_trace(currMov, mask, maskMode=mask_mode))
+        traces.append(get_traces(currMov, weightMatrix))
+        if progress_callback is not None:
+            progress_callback(indStart, indEnd, frameNum)
 
-    for key in traces.iterkeys():
-        traces[key] = np.concatenate(traces[key])
+    traces = np.concatenate(traces, axis=1)
 
-    return traces
+    return {'trace_' + key: traces[i] for i, key in enumerate(keys)}
+
+
+def iter_chunks_prefetch(bl_obj, loading_frame_num=1000, queue_depth=2):
+    """
+    read a 3d BinarySlicer like object (a sliceable object with 'shape', e.g. FileTools.RawJCamReader or a numpy
+    array) chunk by chunk. A reader thread loads the next chunks while the caller processes the current one.
+
+    :param bl_obj: the binary slicer object of a large matrix
+    :param loading_frame_num: frame number of each chunk
+    :param queue_depth: maximum number of loaded chunks waiting to be processed
+    :return: generator of (index of the first frame, index after the last frame, chunk)
+    """
+
+    if loading_frame_num < 1: raise ValueError, 'loading_frame_num should be a positive integer!'
+    if queue_depth < 1: raise ValueError, 'queue_depth should be a positive integer!'
+
+    frameNum = bl_obj.shape[0]
+    chunkQueue = Queue.Queue(maxsize=queue_depth)
+    stopEvent = threading.Event()
+
+    def put(item):
+        while not stopEvent.is_set():
+            try:
+                chunkQueue.put(item, timeout=0.1)
+                return True
+            except Queue.Full:
+                pass
+        return False
+
+    def read():
+        try:
+            for indStart in range(0, frameNum, loading_frame_num):
+                indEnd = min(indStart + loading_frame_num, frameNum)
+                if not put((indStart, indEnd, bl_obj[indStart:indEnd])):
+                    return
+        except Exception as e:
+            put(e)
+            return
+        put(None)
+
+    reader = threading.Thread(target=read)
+    reader.daemon = True
+    reader.start()
+
+    try:
+        while True:
+            item = chunkQueue.get()
+            if item is None:
+                break
+            if isinstance(item, Exception):
+                raise item
+            yield item
+    finally:
+        stopEvent.set()
+        reader.join()
+
+
+def get_trace_binaryslicer_parallel(bl_obj, masks, mask_mode='binary', loading_frame_num=1000, queue_depth=2,
+                                    progress_callback=None):
+    """
+    pipelined version of get_trace_binaryslicer2 and get_trace_binaryslicer3: chunks are prefetched by a reader
+    thread (iter_chunks_prefetch) while the traces of loaded chunks are extracted (get_traces) in the calling thread.
+    Only reading overlaps with computing: file reading releases the GIL, but the sparse matrix product of get_traces
+    does not, so more computing threads would not run at the same time.
+
+    :param bl_obj: the binary slicer object of a large matrix
+    :param masks: a 2d mask, or a dictionary of masks
+    :param mask_mode: same as 'mask_mode' in function get_trace
+    :param loading_frame_num: frame number of each chunk
+    :param queue_depth: maximum number of loaded chunks waiting to be processed
+    :param progress_callback: function called with (index of the first frame, index after the last frame, total
+                              frame number) after each chunk is processed
+    :return: extracted trace for a 2d mask; for a dictionary of masks, dictionary {'trace_' + key: trace}
+    """
+
+    if len(bl_obj.shape) != 3: raise ValueError, 'BinarySlicer object should be 3d!'
+
+    isSingle = not isinstance(masks, dict)
+    if isSingle:
+        masks = {'mask': masks}
+
+    keys = masks.keys()
+    for key in keys:
+        mask = masks[key]
+        if len(mask.shape) != 2: raise ValueError, 'Mask "' + key + '" should be 2d!'
+        if bl_obj.shape[1] != mask.shape[0] or bl_obj.shape[2] != mask.shape[1]:
+            raise ValueError, 'the size of each frame of the BinarySlicer object should be the same as the size of mask "' + key + '"!'
+    weightMatrix = get_roi_weight_matrix([masks[key] for key in keys], mask_mode=mask_mode)
+
+    frameNum = bl_obj.shape[0]
+    traces = []
+    for indStart, indEnd, chunk in iter_chunks_prefetch(bl_obj, loading_frame_num, queue_depth):
+        traces.append(get_traces(chunk, weightMatrix))
+        if progress_callback is not None:
+            progress_callback(indStart, indEnd, frameNum)
+
+    if traces:
+        traces = np.concatenate(traces, axis=1)
+    else:
+        traces = np.zeros((len(keys), 0))
+
+    if isSingle:
+        return traces[0]
+    return {'trace_' + key: traces[i] for i, key in enumerate(keys)}
 
 
 def hit_or_miss(coor, mask):
@@ -1198,6 +1613,279 @@ def get_average_movie(mov, frameTS, onsetTimes, chunkDur):
     return sumMov.astype(np.float32) / n
 
 
+# pairs of opposite sweep directions of KSstimAllDir, (forward, backward, prefix of the map names)
+KS_DIRECTION_PAIRS = (('B2U', 'U2B', 'alt'), ('L2R', 'R2L', 'azi'))
+
+
+def get_ks_sweep_info(log):
+    """
+    get the timing of every sweep run of a KSstimAllDir display log
+
+    :param log: display log dictionary of KSstimAllDir, should have log['stimulation']['sweep_table'],
+                log['presentation']['displayed_frames'] and log['presentation']['time_stamp']
+    :return: dictionary {direction: {'run_starts': 1d array, time stamps of the first display frame of every sweep
+                                                   run (one run per iteration), second
+                                     'run_duration': float, duration of the display frames of one run, second
+                                     'period': float, duration of one iteration (with gaps), second
+                                     'intercept': float, bar center at the start of a run, degree
+                                     'velocity': float, speed of the bar center, degree / second}}
+    """
+
+    sweep_table = log['stimulation']['sweep_table']
+    frames = log['presentation']['displayed_frames']
+    ts = np.array(log['presentation']['time_stamp'], dtype=np.float64)
+
+    directions = np.array([f[4] for f in frames])
+    is_display = np.array([f[0] == 1 for f in frames])
+    sweep_ind = np.array([-1 if f[2] is None else f[2] for f in frames])
+    frame_dur = np.median(np.diff(ts))
+
+    sweep_info = {}
+    for direction in np.unique(directions):
+        direction_ind = np.flatnonzero(directions == direction)
+        display_ind = direction_ind[is_display[direction_ind]]
+        if len(display_ind) == 0:
+            continue
+
+        # a new run starts at a display frame after a gap frame, or if the sweep index goes back
+        is_start = np.ones(len(display_ind), dtype=np.bool)
+        is_start[1:] = (np.diff(display_ind) > 1) | (np.diff(sweep_ind[display_ind]) < 0)
+        run_starts = ts[display_ind[is_start]]
+        run_duration = float(len(display_ind)) / len(run_starts) * frame_dur
+
+        if len(run_starts) > 1:
+            period = np.median(np.diff(run_starts))
+        else:
+            period = len(direction_ind) * frame_dur
+
+        # bar center against time since the start of the run
+        run_ind = np.cumsum(is_start) - 1
+        run_time = ts[display_ind] - run_starts[run_ind]
+        centers = np.array([(sweep_table[i][1] + sweep_table[i][2]) / 2. for i in sweep_ind[display_ind]])
+        velocity, intercept = np.polyfit(run_time, centers, 1)
+
+        sweep_info.update({str(direction): {'run_starts': run_starts,
+                                            'run_duration': run_duration,
+                                            'period': float(period),
+                                            'intercept': float(intercept),
+                                            'velocity': float(velocity)}})
+
+    return sweep_info
+
+
+def get_ks_frame_phases(frame_ts, direction_info):
+    """
+    stimulus phase of every imaging frame for one sweep direction, phase = 2 * pi * (time since run start) / period.
+    every run owns a window of one period centered on the run, frames outside all windows get nan.
+
+    :param frame_ts: time stamps of imaging frames, in the same clock as the display log
+    :param direction_info: one item of the output of get_ks_sweep_info
+    :return: 1d array, phases, radian
+    """
+
+    frame_ts = np.asarray(frame_ts, dtype=np.float64)
+    run_starts = direction_info['run_starts']
+    period = direction_info['period']
+
+    window_starts = run_starts - (period - direction_info['run_duration']) / 2.
+
+    run_ind = np.searchsorted(window_starts, frame_ts, side='right') - 1
+    is_valid = (run_ind >= 0)
+    is_valid[is_valid] = frame_ts[is_valid] < window_starts[run_ind[is_valid]] + period
+
+    phases = np.empty(len(frame_ts), dtype=np.float64)
+    phases[:] = np.nan
+    phases[is_valid] = 2 * np.pi * (frame_ts[is_valid] - run_starts[run_ind[is_valid]]) / period
+
+    return phases
+
+
+class FourierPhaseAccumulator(object):
+    """
+    streaming per-pixel projection of a movie onto a periodic stimulus, movie chunks are added one by one, the
+    memory is O(height x width).
+
+    for each pixel: projection = sum over frames of (frame value * exp(-i * stimulus phase)). The phase of the
+    response is -angle(projection), i.e. the stimulus phase at which the response peaks. The leak of the mean
+    (DC) into the projection when the frames do not cover whole periods evenly is removed by subtracting
+    mean * sum(exp(-i * stimulus phase)).
+    """
+
+    def __init__(self, frame_shape):
+        self.frame_shape = tuple(frame_shape)
+        self.frame_num = 0
+        self.projection = np.zeros(self.frame_shape, dtype=np.complex128)
+        self.frame_sum = np.zeros(self.frame_shape, dtype=np.float64)
+        self.basis_sum = 0j
+
+    def add_frames(self, frames, phases):
+        """
+        :param frames: 3d array (frame, row, column)
+        :param phases: stimulus phase of each frame, radian. frames with nan phase are ignored
+        """
+
+        phases = np.asarray(phases, dtype=np.float64)
+        is_valid = ~np.isnan(phases)
+        if not np.any(is_valid):
+            return
+
+        frames = np.asarray(frames)[is_valid].astype(np.float64)
+        basis = np.exp(-1j * phases[is_valid])
+
+        self.projection += np.tensordot(basis, frames, axes=1)
+        self.frame_sum += np.sum(frames, axis=0)
+        self.basis_sum += np.sum(basis)
+        self.frame_num += len(basis)
+
+    def get_mean(self):
+        return self.frame_sum / self.frame_num
+
+    def get_corrected_projection(self):
+        return self.projection - self.get_mean() * self.basis_sum
+
+    def get_phase_map(self):
+        """
+        phase of the response, stimulus phase at response peak, radian, [-pi, pi]
+        """
+        return -np.angle(self.get_corrected_projection())
+
+    def get_amplitude_map(self, is_relative=True):
+        """
+        amplitude of the response at the stimulus frequency, if is_relative, divided by the mean of each pixel
+        """
+        amplitude = 2 * np.abs(self.get_corrected_projection()) / self.frame_num
+        if is_relative:
+            with np.errstate(divide='ignore', invalid='ignore'):
+                amplitude = amplitude / self.get_mean()
+        return amplitude
+
+
+def ks_phase_to_position(phase_forward, phase_backward, info_forward, info_backward):
+    """
+    convert the response phases of two opposite sweep directions into retinotopic position. The delay of the
+    response cancels in the difference of the two phases. As the phase difference is only known up to a whole
+    cycle, positions are wrapped around the center of the sweeps, within half of the distance the bar travels in
+    one period.
+
+    :param phase_forward: phase map of forward direction (see FourierPhaseAccumulator.get_phase_map), radian
+    :param phase_backward: phase map of backward direction, radian
+    :param info_forward: sweep info of forward direction, see get_ks_sweep_info
+    :param info_backward: sweep info of backward direction
+    :return: position map, degree
+    """
+
+    # phase / (2 * pi) = (position - intercept) / (velocity * period) + delay / period
+    scale_f = 1. / (info_forward['velocity'] * info_forward['period'])
+    scale_b = 1. / (info_backward['velocity'] * info_backward['period'])
+    offset = info_backward['intercept'] * scale_b - info_forward['intercept'] * scale_f
+
+    # phase difference (cycles) at the center of the sweeps
+    center = (info_forward['intercept'] + info_forward['velocity'] * info_forward['run_duration'] / 2. +
+              info_backward['intercept'] + info_backward['velocity'] * info_backward['run_duration'] / 2.) / 2.
+    diff_center = center * (scale_f - scale_b) + offset
+
+    diff = (np.asarray(phase_forward) - np.asarray(phase_backward)) / (2 * np.pi)
+    diff = (diff - diff_center + 0.5) % 1. - 0.5 + diff_center
+
+    return (diff - offset) / (scale_f - scale_b)
+
+
+def get_ks_retinotopic_maps(chunks, frame_ts, log):
+    """
+    compute retinotopic maps from a movie of KSstimAllDir stimulation in one streaming pass
+
+    :param chunks: iterable of (index of the first frame, 3d array chunk (frame, row, column)), for example
+                   FileTools.iterRawJCam
+    :param frame_ts: time stamps of all imaging frames, in the same clock as the display log
+    :param log: display log dictionary of KSstimAllDir, see get_ks_sweep_info
+    :return: dictionary with 'altPosMap', 'aziPosMap' (degree), 'altPowerMap', 'aziPowerMap' (mean relative
+             amplitude of two directions), ready for RetinotopicMapping.RetinotopicMappingTrial, and 'phase_maps',
+             'amplitude_maps' of every direction
+    """
+
+    frame_ts = np.asarray(frame_ts, dtype=np.float64)
+    sweep_info = get_ks_sweep_info(log)
+    phases = dict([(d, get_ks_frame_phases(frame_ts, info)) for d, info in sweep_info.iteritems()])
+
+    accumulators = {}
+    for start_frame, chunk in chunks:
+        chunk_phases = dict([(d, p[start_frame:start_frame + chunk.shape[0]]) for d, p in phases.iteritems()])
+        for direction, direction_phases in chunk_phases.iteritems():
+            if direction not in accumulators:
+                accumulators[direction] = FourierPhaseAccumulator(chunk.shape[1:])
+            accumulators[direction].add_frames(chunk, direction_phases)
+
+    maps = {'phase_maps': dict([(d, a.get_phase_map()) for d, a in accumulators.iteritems()]),
+            'amplitude_maps': dict([(d, a.get_amplitude_map()) for d, a in accumulators.iteritems()])}
+
+    for forward, backward, prefix in KS_DIRECTION_PAIRS:
+        if forward in accumulators and backward in accumulators:
+            maps[prefix + 'PosMap'] = ks_phase_to_position(maps['phase_maps'][forward], maps['phase_maps'][backward],
+                                                           sweep_info[forward], sweep_info[backward])
+            maps[prefix + 'PowerMap'] = (maps['amplitude_maps'][forward] + maps['amplitude_maps'][backward]) / 2.
+        else:
+            maps[prefix + 'PosMap'] = None
+            maps[prefix + 'PowerMap'] = None
+
+    return maps
+
+
+def pixels_to_rle(pixels, shape):
+    """
+    run-length encode a set of pixels of a mask, runs are counted along the flattened (C order) mask
+
+    :param pixels: tuple of index arrays (rows, cols), as returned by np.where
+    :param shape: shape of the mask
+    :return: starts, lengths: 1d arrays, np.int64, flattened index of the first pixel and length of every run
+    """
+
+    flatInd = np.unique(np.ravel_multi_index(tuple(np.asarray(p, dtype=np.int64) for p in pixels), shape))
+
+    if len(flatInd) == 0:
+        return np.array([], dtype=np.int64), np.array([], dtype=np.int64)
+
+    breaks = np.flatnonzero(np.diff(flatInd) != 1) + 1
+    starts = flatInd[np.concatenate(([0], breaks))]
+    ends = flatInd[np.concatenate((breaks - 1, [len(flatInd) - 1]))] + 1
+
+    return starts.astype(np.int64), (ends - starts).astype(np.int64)
+
+
+def rle_to_pixels(starts, lengths, shape):
+    """
+    decode runs generated by pixels_to_rle back to pixel indices
+
+    :return: tuple of index arrays (rows, cols), in the same order as np.where
+    """
+
+    starts = np.asarray(starts, dtype=np.int64)
+    lengths = np.asarray(lengths, dtype=np.int64)
+
+    runOffsets = np.cumsum(lengths) - lengths
+    flatInd = np.arange(np.sum(lengths), dtype=np.int64) - np.repeat(runOffsets - starts, lengths)
+
+    return np.unravel_index(flatInd, shape)
+
+
+def mask_to_rle(mask):
+    """
+    run-length encode a 2d mask, non-zero and non-nan pixels are considered as foreground
+
+    :return: starts, lengths, see pixels_to_rle
+    """
+    mask = np.asarray(mask)
+    return pixels_to_rle(np.where(np.logical_and(mask != 0, ~np.isnan(mask))), mask.shape)
+
+
+def rle_to_mask(starts, lengths, shape, dtype=np.uint8):
+    """
+    decode runs generated by mask_to_rle back to a binary mask
+    """
+    mask = np.zeros(shape, dtype=dtype)
+    mask[rle_to_pixels(starts, lengths, shape)] = 1
+    return mask
+
+
 class ROI(object):
     """
     class of binary ROI
@@ -1293,9 +1981,13 @@ class ROI(object):
     def plot_binary_mask_border(self, **kwargs):
         pt.plot_mask_borders(self.get_nan_mask(), **kwargs)
 
-    def to_h5_group(self, h5Group):
+    def to_h5_group(self, h5Group, is_rle=False):
         """
         add attributes and dataset to a h5 data group
+
+        :param is_rle: if True, pixels are saved as run-length encoded datasets 'rle_starts' and 'rle_lengths' (see
+                       pixels_to_rle), which can only be read by from_h5_group of this version, otherwise as the
+                       'pixels' dataset readable by older versions
         """
         h5Group.attrs['dimension'] = self.dimension
         if self.pixelSizeX is None:
@@ -1312,12 +2004,31 @@ class ROI(object):
         _ = dataDict.pop('pixelSizeX');
         _ = dataDict.pop('pixelSizeY');
         _ = dataDict.pop('pixelSizeUnit')
+
+        if is_rle:
+            # pixels are saved as runs along the flattened mask, weights (if any) are in the same order
+            pixels = dataDict.pop('pixels')
+            rle_starts, rle_lengths = pixels_to_rle(pixels, self.dimension)
+            h5Group.create_dataset('rle_starts', data=rle_starts)
+            h5Group.create_dataset('rle_lengths', data=rle_lengths)
+
         for key, value in dataDict.iteritems():
             if value is None:
                 h5Group.create_dataset(key, data='None')
             else:
                 h5Group.create_dataset(key, data=value)
 
+    @staticmethod
+    def _get_h5_pixels(h5Group):
+        """
+        load pixel indices from a hdf5 data group, either run-length encoded or as saved pixel indices
+        """
+        if 'rle_starts' in h5Group.keys():
+            return rle_to_pixels(h5Group['rle_starts'].value, h5Group['rle_lengths'].value,
+                                 tuple(h5Group.attrs['dimension']))
+        else:
+            return tuple(h5Group['pixels'].value)
+
     @staticmethod
     def from_h5_group(h5Group):
         """
@@ -1329,7 +2040,7 @@ class ROI(object):
         if pixelSize == 'None': pixelSize = None
         pixelSizeUnit = h5Group.attrs['pixelSizeUnit']
         if pixelSizeUnit == 'None': pixelSizeUnit = None
-        pixels = h5Group['pixels'].value
+        pixels = ROI._get_h5_pixels(h5Group)
 
         if 'weights' in h5Group.keys():
             weights = h5Group['weights'].value
@@ -1402,7 +2113,7 @@ class WeightedROI(ROI):
         if pixelSize == 'None': pixelSize = None
         pixelSizeUnit = h5Group.attrs['pixelSizeUnit']
         if pixelSizeUnit == 'None': pixelSizeUnit = None
-        pixels = h5Group['pixels'].value
+        pixels = ROI._get_h5_pixels(h5Group)
         weights = h5Group['weights'].value
         mask = np.zeros(dimension, dtype=np.float32);
         mask[tuple(pixels)] = weights